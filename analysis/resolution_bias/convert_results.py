@@ -0,0 +1,33 @@
+"""
+This file converts resolution results between the JSON saved by the model runners and the columnar NPZ of
+src/results_store.py. JSON files are converted to NPZ and NPZ files to JSON, next to the original file
+
+Usage: python convert_results.py ../../results/model_outputs/clip_clip_ContextOP.json [more files]
+"""
+
+import argparse
+import os
+import sys
+
+main_dir = os.path.join(os.path.dirname(__file__), '..', '..')
+sys.path.insert(0, main_dir)
+
+from src.results_store import convert_json_to_npz, convert_npz_to_json
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'results_files', nargs='+',
+        help='results JSON files to convert to NPZ, or NPZ files to convert to JSON')
+
+    args = parser.parse_args()
+    for results_file in args.results_files:
+        if results_file.endswith('.npz'):
+            print(f"Saved {convert_npz_to_json(results_file)}")
+        else:
+            print(f"Saved {convert_json_to_npz(results_file)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+This file builds the resolution accuracy cube of every model from the preliminary results (see src/resolution_cube.py)
+and saves it as results/resolution_bias_analysis/resolution_cube.npz. With --by, it also prints the resolution accuracy
+and gender gap broken down by those dimensions, read from the cube
+
+Usage: python resolution_cube.py [--by model_name occ] [--context context_OP] [--template occ_first]
+"""
+
+import argparse
+import os
+import sys
+
+main_dir = os.getcwd().split("analysis")[0]
+preliminary_path = os.path.join(main_dir, "results/resolution_bias_analysis/preliminary_analysis")
+cube_filepath = os.path.join(main_dir, "results/resolution_bias_analysis/resolution_cube.npz")
+sys.path.append(main_dir)
+
+from src.results_manifest import ResultsManifest
+from src.resolution_cube import build_resolution_cube, save_resolution_cube, gender_gap, cube_dimensions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--by', nargs='*', default=None, choices=cube_dimensions,
+        help='dimensions to break the resolution accuracy and gender gap down by')
+    parser.add_argument(
+        '--context', nargs='+', default=None,
+        help='contexts to include, e.g. context_OP (default every context)')
+    parser.add_argument(
+        '--template', nargs='+', default=["occ_first"],
+        help='template types to include (default occ_first, as for the benchmark scores, every template type counts every OP image once)')
+
+    args = parser.parse_args()
+    cube = build_resolution_cube(ResultsManifest(preliminary_path).load())
+    save_resolution_cube(cube, cube_filepath)
+    print(f"Saved {len(cube)} cells under {cube_filepath}")
+
+    if args.by is not None:
+        filters = {dimension: values for dimension, values in [("context", args.context), ("template", args.template)] if values is not None}
+        print(gender_gap(cube, args.by, **filters).round(2).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,30 @@
 """
-This file either creates or updates an existing benchmark file with the resolution bias scores for CLIP-like and captioning models. 
-This file also checks if the preliminary results have been run in isolation, and if not, these scores are calculated as well. 
+This file either creates or updates an existing benchmark file with the resolution bias scores for CLIP-like and captioning models.
+The preliminary results and the benchmark scores are stages of an in-process pipeline (see src/pipeline.py): a stage is only run
+again when the content of its inputs (model outputs, preliminary results, analysis code) or its parameters changed, or its outputs are missing.
+
+Usage: python return_benchmark.py [--force]
 
 Authors: @smhall97, @abrantesfg
 """
 import os
 import sys
-import subprocess
 import json
+import argparse
+from functools import partial
 
 main_dir = os.getcwd().split("analysis")[0]
 result_dir = os.path.join(main_dir, "results/model_outputs")
 saving_path = os.path.join(main_dir, "results/resolution_bias_analysis/preliminary_analysis")
 benchmark_path = os.path.join(main_dir, "results/benchmark_scores")
-sys.path.append(main_dir) 
+sys.path.append(main_dir)
 
-from src.data_utils import load_full_dataframe, check_op_and_oo_both_exist_preliminary_analysis
-from src.analysis_utils import get_subset_dataframe, load_benchmark_dict, single_person_res_acc, two_person_res_acc, overall_res_acc
+from src.definitions import pipeline_state_filepath, bootstrap_num_resamples, bootstrap_confidence, bootstrap_seed
+from src.analysis_utils import (check_neutral_groundtruth_match, get_subset_dataframe, load_benchmark_dict, single_person_res_acc, two_person_res_acc,
+                                overall_res_acc)
+from src.bootstrap_utils import resolution_bootstrap_ci
+from src.results_manifest import ResultsManifest
+from src.pipeline import Pipeline
 
 
 clip_models = ["clip"]
@@ -24,23 +32,15 @@ captioning_models = ["blipv2"]
 
 model_list = clip_models + captioning_models
 
-for model_name in model_list:
-
-    # names based on original json as saved by output from models
-    if model_name in clip_models:
-        file_desc = f"clip_{model_name}" 
-        exp_desc = "CLIP" 
-
-    elif model_name in captioning_models:
-        file_desc = f"captioning_{model_name}" 
-        exp_desc = "CAPTIONING" 
+# only the preliminary results of each model are loaded
+manifest = ResultsManifest(saving_path)
 
-    file_check = check_op_and_oo_both_exist_preliminary_analysis(saving_path, model_name)
 
-    if not file_check:
-        subprocess.run(["python", "run_preliminary_analysis.py"])
-    
-    full_df = load_full_dataframe(saving_path)
+def compute_benchmark(exp_desc: str, model_name: str):
+    """
+    Computes the resolution bias scores of the model from its preliminary results and saves them in its benchmark file
+    """
+    full_df = manifest.load(experiment=exp_desc, model_name=model_name)
 
     output_file_name = f"benchmark_results_{exp_desc}_{model_name}.json"
     benchmark_dict = load_benchmark_dict(benchmark_path, exp_desc, model_name, output_file_name)
@@ -52,7 +52,44 @@ for model_name in model_list:
     op_two_person_res_acc = two_person_res_acc(op_subset_df, benchmark_dict, exp_desc, model_name, "Context_OP")
 
     benchmark_dict = overall_res_acc(benchmark_dict)
+    # confidence intervals from resampling the images within each occupation
+    benchmark_dict = resolution_bootstrap_ci(oo_subset_df, op_subset_df, benchmark_dict)
 
     with open(os.path.join(benchmark_path,output_file_name), "w") as f:
         json.dump(benchmark_dict, f, indent=4)
     print(f"Saved under {benchmark_path}/{output_file_name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preliminary analysis and resolution bias benchmark scores of every model")
+    parser.add_argument("--force", action="store_true", help="run every stage again, even if its inputs did not change")
+    args = parser.parse_args()
+
+    pipeline = Pipeline(os.path.join(main_dir, pipeline_state_filepath))
+    # the code each stage runs, including the modules it imports
+    preliminary_code = [os.path.abspath(__file__)] + [os.path.join(main_dir, f"src/{module}.py") for module in ["analysis_utils", "data_utils", "definitions"]]
+    benchmark_code = preliminary_code + [os.path.join(main_dir, f"src/{module}.py")
+                                         for module in ["bootstrap_utils", "metrics", "parallel_utils", "results_manifest", "results_store"]]
+
+    for model_name in model_list:
+
+        # names based on original json as saved by output from models
+        if model_name in clip_models:
+            file_desc = f"clip_{model_name}"
+            exp_desc = "CLIP"
+
+        elif model_name in captioning_models:
+            file_desc = f"captioning_{model_name}"
+            exp_desc = "CAPTIONING"
+
+        preliminary_files = [os.path.join(saving_path, f"{file_desc}_Context{context}_preliminary_results.json") for context in ["OP", "OO"]]
+        benchmark_file = os.path.join(benchmark_path, f"benchmark_results_{exp_desc}_{model_name}.json")
+        pipeline.add(f"preliminary_{model_name}", partial(check_neutral_groundtruth_match, result_dir, saving_path, file_desc, exp_desc, model_name),
+                     inputs=[os.path.join(result_dir, f"{file_desc}_Context{context}.json") for context in ["OP", "OO"]] + preliminary_code,
+                     outputs=preliminary_files, params={"exp_desc": exp_desc, "model_name": model_name})
+        # the benchmark file is updated in place, see load_benchmark_dict
+        pipeline.add(f"benchmark_{model_name}", partial(compute_benchmark, exp_desc, model_name),
+                     inputs=preliminary_files + [benchmark_file] + benchmark_code, outputs=[benchmark_file],
+                     params={"num_resamples": bootstrap_num_resamples, "confidence": bootstrap_confidence, "seed": bootstrap_seed})
+
+    pipeline.run(force=args.force)
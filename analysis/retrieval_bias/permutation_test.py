@@ -0,0 +1,53 @@
+"""
+This file runs permutation tests of the retrieval bias metric scores: the p-value of every metric of every occupation
+against random rankings of its gallery
+
+Usage: python permutation_test.py results.json [permutation_test.json] [--metrics bias@10 maxskew@10 ndkl]
+"""
+
+import argparse
+import json
+import os
+import sys
+
+main_dir = os.path.join(os.path.dirname(__file__), '..', '..')
+sys.path.insert(0, main_dir)
+
+from src.definitions import permutation_num_permutations, permutation_seed, permutation_num_processes
+from src.permutation_utils import retrieval_permutation_test
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'results_json', type=argparse.FileType('r'),
+        help='raw JSON results file from run_retrieval_bias.py')
+    parser.add_argument(
+        'permutation_json', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
+        help='location for output permutation tests in JSON (default stdout)')
+    parser.add_argument(
+        '--diff_gender', action='store_true',
+        help='analyse diff gender (man-man woman-woman vs man-woman woman-man) instead of man vs woman')
+    parser.add_argument(
+        '--metrics', nargs='+', default=['bias@5', 'bias@10', 'maxskew@5', 'maxskew@10', 'ndkl'],
+        help='metrics to test, as named by retrieval_analysis.py')
+    parser.add_argument(
+        '--num_permutations', type=int, default=permutation_num_permutations,
+        help='number of random rankings per occupation')
+    parser.add_argument(
+        '--seed', type=int, default=permutation_seed,
+        help='seed of the random rankings')
+    parser.add_argument(
+        '--processes', type=int, default=permutation_num_processes,
+        help='number of processes the permutations are spread across')
+
+    args = parser.parse_args()
+    results = json.load(args.results_json)
+
+    permutation_tests = retrieval_permutation_test(results, args.metrics, diff_gender=args.diff_gender, num_permutations=args.num_permutations,
+                                                   seed=args.seed, num_processes=args.processes)
+    json.dump(permutation_tests, args.permutation_json)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,11 +26,14 @@ def main():
     parser.add_argument(
         '--diff_gender', action='store_true',
         help='analyse diff gender (man-man woman-woman vs man-woman woman-man) instead of man vs woman')
+    parser.add_argument(
+        '--ks', type=int, nargs='+', default=None,
+        help='values of k to compute the @k metrics for (default every k)')
 
     args = parser.parse_args()
     results = json.load(args.results_json)
 
-    bias = calculate_retrieval_bias(results, diff_gender=args.diff_gender)
+    bias = calculate_retrieval_bias(results, diff_gender=args.diff_gender, ks=args.ks)
     json.dump(bias, args.analysis_json)
 
 
@@ -0,0 +1,65 @@
+"""
+This file compares the time per query of the vectorized retrieval bias metrics (calculate_retrieval_bias in
+src/metrics.py) with the reference loop over every k, on large synthetic galleries. The loop is quadratic in the
+gallery size, so it is timed on fewer queries. The report is saved as results/performance_benchmarks/retrieval_metrics_benchmark.json
+
+Usage: python retrieval_metrics_benchmark.py [--gallery-size 10000] [--num-queries 16] [--num-loop-queries 1]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+main_dir = os.getcwd().split("analysis")[0]
+sys.path.append(main_dir)
+
+from src.definitions import performance_benchmark_dirpath
+from src.metrics import calculate_retrieval_bias, _calculate_retrieval_bias_loop
+
+
+def synthetic_galleries(num_queries: int, gallery_size: int, seed: int = 0) -> dict:
+    """
+    Returns raw retrieval results with one random gallery per query, as saved by run_retrieval_bias.py
+    """
+    rng = np.random.default_rng(seed)
+    return {f"query_{query_idx}": {"error": False, "logits_list": rng.random(gallery_size).tolist(),
+                                   "occ_genders": rng.choice(["masculine", "feminine"], gallery_size).tolist()}
+            for query_idx in range(num_queries)}
+
+def seconds_per_query(bias_fn, results: dict) -> tuple:
+    """
+    Returns (seconds per query, bias dict) of computing the metrics of all the queries
+    """
+    start = time.perf_counter()
+    bias = bias_fn(results)
+    return (time.perf_counter() - start) / len(results), bias
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time per query of the vectorized and loop retrieval bias metrics")
+    parser.add_argument("--gallery-size", type=int, default=10000, help="number of images per query")
+    parser.add_argument("--num-queries", type=int, default=16, help="number of queries for the vectorized metrics")
+    parser.add_argument("--num-loop-queries", type=int, default=1, help="number of queries for the loop, at most --num-queries")
+    args = parser.parse_args()
+
+    results = synthetic_galleries(args.num_queries, args.gallery_size)
+    vectorized_seconds, bias = seconds_per_query(calculate_retrieval_bias, results)
+    loop_results = dict(list(results.items())[:args.num_loop_queries])
+    loop_seconds, loop_bias = seconds_per_query(_calculate_retrieval_bias_loop, loop_results)
+
+    max_abs_diff = max(abs(bias[query][metric] - value) for query in loop_bias for metric, value in loop_bias[query].items()
+                       if not isinstance(value, dict))
+    benchmark = {"gallery_size": args.gallery_size, "num_queries": args.num_queries, "num_loop_queries": len(loop_results),
+                 "vectorized_seconds_per_query": vectorized_seconds, "loop_seconds_per_query": loop_seconds,
+                 "speedup": loop_seconds / vectorized_seconds, "max_abs_diff": max_abs_diff}
+    print(json.dumps(benchmark, indent=4))
+
+    benchmark_dir = os.path.join(main_dir, performance_benchmark_dirpath)
+    benchmark_filepath = os.path.join(benchmark_dir, "retrieval_metrics_benchmark.json")
+    os.makedirs(benchmark_dir, exist_ok=True)
+    with open(benchmark_filepath, "w") as f:
+        json.dump(benchmark, f, indent=4)
+    print(f"Saved {benchmark_filepath}")
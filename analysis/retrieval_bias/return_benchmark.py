@@ -16,6 +16,7 @@ sys.path.append(main_dir)
 
 from src.analysis_utils import load_benchmark_dict
 from src.metrics import calculate_retrieval_bias
+from src.bootstrap_utils import retrieval_bootstrap_ci
 
 
 model_list = ["clip"]
@@ -28,7 +29,7 @@ for model_name in model_list:
 
     with open(model_output_path) as f:
         results = json.load(f)
-    bias = calculate_retrieval_bias(results)
+    bias = calculate_retrieval_bias(results, ks=[5, 10])
 
     output_file_name = f"benchmark_results_{exp_desc}_{model_name}.json"
     benchmark_dict = load_benchmark_dict(benchmark_path, exp_desc, model_name, output_file_name)
@@ -41,6 +42,8 @@ for model_name in model_list:
         std = np.std(stats, ddof=1)
         benchmark_dict["retrieval_bias"][metric]["mean"] = np.round(mean, 2)
         benchmark_dict["retrieval_bias"][metric]["sigma"] = np.round(std, 2)
+    # confidence intervals of the means from resampling the images of each occupation
+    benchmark_dict = retrieval_bootstrap_ci(results, benchmark_dict, metrics)
 
     with open(os.path.join(benchmark_path, output_file_name), "w") as f:
         json.dump(benchmark_dict, f, indent=4)
@@ -15,11 +15,19 @@ import pandas as pd
 main_dir = os.path.join(os.path.dirname(__file__), '..', '..')
 sys.path.insert(0, main_dir)
 
+from src.bootstrap_utils import bootstrap_samples, retrieval_statistics, percentile_interval
+
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         'analysis_json', type=argparse.FileType('r'), help='JSON analysis results from retrieval_analysis.py')
+    parser.add_argument(
+        '--results_json', type=argparse.FileType('r'), default=None,
+        help='raw JSON results file the analysis was computed from, to add bootstrap confidence intervals of the means')
+    parser.add_argument(
+        '--diff_gender', action='store_true',
+        help='the analysis is for diff gender, as in retrieval_analysis.py')
 
     args = parser.parse_args()
     bias = json.load(args.analysis_json)
@@ -35,6 +43,11 @@ def main():
         means.append(mean)
         stds.append(std)
     df = pd.DataFrame([means, stds], columns=metrics, index=['Mean', 'SD'])
+    if args.results_json is not None:
+        samples = bootstrap_samples(retrieval_statistics(json.load(args.results_json), metrics, diff_gender=args.diff_gender))
+        intervals = [percentile_interval(samples[metric]) for metric in metrics]
+        df.loc['CI lower'] = [interval[0] for interval in intervals]
+        df.loc['CI upper'] = [interval[1] for interval in intervals]
     print(df)
 
 if __name__ == '__main__':
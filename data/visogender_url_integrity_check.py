@@ -1,17 +1,32 @@
+import os
 import sys
+import time
 import pandas as pd
 import requests
-from src.definitions import OP_data_filepath, OO_data_filepath
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def test_url(url: str) -> str:
+main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(main_dir)
+
+from src.definitions import OP_data_filepath, OO_data_filepath, url_status_filepath, url_check_workers, url_check_rate_per_host, url_status_max_age
+from src.fetch_utils import Fetcher, fetch
+from src.data_utils import load_url_status, save_url_status
+
+URL_COLUMN = "URL type (Type NA if can't find)"
+
+def test_url(url: str, fetcher: Fetcher = None, method: str = "GET") -> str:
     """
 
-    This function checks the validity of a given URL by making an HTTP request and inspecting the response.
+    This function checks the validity of a given URL by making an HTTP request through the shared fetch layer in
+    src/fetch_utils.py (with retries, timeouts and per-host limits) and inspecting the response.
     It determines the status of the URL based on the HTTP response status code, the presence of certain headers,
     and potential errors during the request process.
 
     Args:
         url (str): The URL from VISOGENDER to be tested.
+        fetcher (Fetcher): The fetcher used for the request, defaults to the process wide fetcher.
+        method (str): The HTTP method used for the request, "GET" or "HEAD".
 
     Returns:
         str: A status string indicating the result of the URL test.
@@ -21,7 +36,10 @@ def test_url(url: str) -> str:
     if pd.isnull(url):
         return "Skipped"
     try:
-        response = requests.get(url, headers={"User-Agent": "OxAIBot/1.0"})
+        if fetcher is None:
+            response = fetch(url, method=method, headers={"User-Agent": "OxAIBot/1.0"})
+        else:
+            response = fetcher.fetch(url, method=method, headers={"User-Agent": "OxAIBot/1.0"})
         if response.status_code == 200:
             license_header = response.headers.get("License")
             if license_header and "creativecommons" in license_header.lower():
@@ -40,28 +58,111 @@ def test_url(url: str) -> str:
         return "Unknown error"
 
 
-def check_visogender_url_integrity(visogender_df: pd.DataFrame):
+def is_valid_status(status: str) -> bool:
+    """
+    Returns True if the status string returned by `test_url` indicates a working URL
+    """
+    return status.startswith("Valid and downloadable")
+
+
+def status_code(status: str):
+    """
+    Returns the HTTP status code of the status string returned by `test_url`, or None if the request got no response
+    """
+    if is_valid_status(status):
+        return 200
+    if status.startswith("Returned status code "):
+        return int(status.rsplit(" ", 1)[1])
+    return None
+
+
+def check_url(url: str, fetcher: Fetcher = None) -> dict:
+    """
+
+    Checks a single URL with a cheap HEAD request first, and falls back to a full GET request if the HEAD request fails
+    (some hosts do not support HEAD requests).
+
+    Args:
+        url (str): The URL from VISOGENDER to be tested.
+        fetcher (Fetcher): The fetcher used for the requests.
+
+    Returns:
+        dict: {"status", "status_code", "ok", "checked_at"} entry for the URL status report.
+
+    """
+    status = test_url(url, fetcher, method="HEAD")
+    if not is_valid_status(status):
+        status = test_url(url, fetcher, method="GET")
+    return {"status": status, "status_code": status_code(status), "ok": is_valid_status(status), "checked_at": time.time()}
+
+
+def check_urls_concurrently(urls: list, status_filepath: str, num_workers: int = url_check_workers,
+                            rate_per_host: float = url_check_rate_per_host, max_age: float = url_status_max_age, save_every: int = 25) -> dict:
+    """
+
+    Checks the URLs in a thread pool and records the results in a status report that the check can resume from. Only URLs
+    that are not in the report yet, that failed the last check, or that were last checked more than max_age seconds ago
+    are tested again. The report is saved every save_every URLs, so an interrupted check does not start over.
+
+    Args:
+        urls (list): The URLs to be tested, missing URLs are skipped.
+        status_filepath (str): Path to the URL status report, read on start and updated as URLs are checked.
+        num_workers (int): Number of threads checking URLs.
+        rate_per_host (float): Maximum number of requests per second started against a single host.
+        max_age (float): Number of seconds after which a valid URL is checked again.
+        save_every (int): Number of checked URLs between saves of the status report.
+
+    Returns:
+        dict: The URL status report, with the URL as key and {"status", "status_code", "ok", "checked_at"} as values.
+
+    """
+    url_status = load_url_status(status_filepath)
+    now = time.time()
+    urls_to_check = [
+        url for url in dict.fromkeys(urls)
+        if not pd.isnull(url) and url != "NA"
+        and (url not in url_status or not url_status[url]["ok"] or now - url_status[url]["checked_at"] > max_age)]
+    print(f"Checking {len(urls_to_check)} URLs, {len(url_status)} URLs already in {status_filepath}")
+
+    fetcher = Fetcher(user_agent="OxAIBot/1.0", rate_per_host=rate_per_host)
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        futures = {executor.submit(check_url, url, fetcher): url for url in urls_to_check}
+        for checked, future in enumerate(tqdm(as_completed(futures), total=len(futures)), start=1):
+            url_status[futures[future]] = future.result()
+            if checked % save_every == 0:
+                save_url_status(url_status, status_filepath)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        save_url_status(url_status, status_filepath)
+
+    return url_status
+
+
+def check_visogender_url_integrity(visogender_df: pd.DataFrame, status_filepath: str = os.path.join(main_dir, url_status_filepath)):
 
     """
     This checks the integrity of URLs in a VISOGENDER DataFrame by doing the following:
 
-    1. Adds a "URL Status" column to the DataFrame based on the result of the `test_url` function.
-    2. Identifies invalid URLs and prints them.
-    3. Detects duplicate URLs in the DataFrame and prints duplicate pairs.
+    1. Checks the URLs concurrently with `check_urls_concurrently`, resuming from the URL status report.
+    2. Adds a "URL Status" column to the DataFrame based on the URL status report.
+    3. Identifies invalid URLs and prints them.
+    4. Detects duplicate URLs in the DataFrame and prints duplicate pairs.
 
     Args:
         visogender_df (pd.DataFrame): The input DataFrame containing Visogender data.
+        status_filepath (str): Path to the URL status report, also used by the runners to skip dead URLs.
 
     Returns:
         None
 
     """
 
-    visogender_df["URL Status"] = visogender_df[
-        "URL type (Type NA if can't find)"
-    ].apply(test_url)
+    url_status = check_urls_concurrently(visogender_df[URL_COLUMN].tolist(), status_filepath)
+    visogender_df["URL Status"] = visogender_df[URL_COLUMN].map(
+        lambda url: url_status[url]["status"] if url in url_status else "Skipped")
     invalid_urls = visogender_df[
-        (visogender_df["URL Status"] != "Valid and downloadable")
+        ~visogender_df["URL Status"].map(is_valid_status)
         & (visogender_df["URL Status"] != "Skipped")
     ]
     if not invalid_urls.empty:
@@ -70,12 +171,12 @@ def check_visogender_url_integrity(visogender_df: pd.DataFrame):
 
     # Find duplicate URLs in the dataframe
     duplicates = visogender_df[
-        visogender_df.duplicated(["URL type (Type NA if can't find)"], keep=False)
+        visogender_df.duplicated([URL_COLUMN], keep=False)
     ]
 
     # Group duplicates by URL and print them out in pairs
     print("Checking duplicate URLs:")
-    for url, group in duplicates.groupby("URL type (Type NA if can't find)"):
+    for url, group in duplicates.groupby(URL_COLUMN):
         if len(group) > 1:
             duplicate_idxs = ", ".join(group["IDX"].values)
             print(f"IDs {duplicate_idxs} are duplicates for URL: {url}\n")
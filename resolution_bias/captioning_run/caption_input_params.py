@@ -5,7 +5,8 @@ main_dir = os.getcwd().split("resolution_bias")[0]
 data_dir = os.path.join(main_dir, "data/visogender_data")
 result_dir = os.path.join(main_dir, "results/model_outputs")
 sys.path.append(main_dir) 
-from src.definitions import gender_idx_dict, OP_data_filepath, OO_data_filepath
+from src.definitions import gender_idx_dict, OP_data_filepath, OO_data_filepath, url_status_filepath, caption_precision, caption_num_threads, caption_batch_size, eval_workers
+from src.captioning_set_up import device
 
 caption_input_params = {
                         "experiment_name" : "captioning",
@@ -18,5 +19,13 @@ caption_input_params = {
                         "sentence_template_OP_par_first": "The $PARTICIPANT and ",
                         "sentence_template_OO": "The $OCCUPATION and ",
                         "gender_idx_dict" : gender_idx_dict,
+                        "prefetch_workers": 8,
+                        "prefetch_queue_size": 32,
+                        "batch_size": caption_batch_size,
+                        "device": device,
+                        "precision": caption_precision,
+                        "num_threads": caption_num_threads,
+                        "workers": eval_workers,
+                        "url_status_report": os.path.join(main_dir, url_status_filepath),
                         "caption_models": ["blipv2"]} 
   
@@ -0,0 +1,88 @@
+"""
+This file reports how far the captioning logits drift on CPU in the bf16 autocast and int8 dynamic quantization modes
+compared with fp32, together with the time per image of each mode. It scores the first OP rows of the VISOGENDER data
+with every model in /resolution_bias/captioning_run/caption_input_params.py and saves the report as
+results/performance_benchmarks/captioning_precision_parity.json
+
+Usage: python captioning_precision_parity.py [--num-rows 64] [--num-threads 8]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import PIL
+
+from caption_input_params import caption_input_params, main_dir
+
+sys.path.append(main_dir)
+
+from src.template_generator_utils import load_metadata_to_dict, occupation_template_sentences_all_pronouns, participant_template_sentences_all_pronouns
+from src.definitions import performance_benchmark_dirpath
+from src.data_utils import get_image, load_dead_urls
+from src.captioning_set_up import (BlipPronounScorer, blip_setup_model_processor, blipv2_set_up_model_processor, caption_precisions,
+                                   set_up_captioning_engine, pronoun_logit_drift)
+
+
+def load_parity_rows(num_rows: int) -> list:
+    """
+    Returns (raw_image, [occ_first prompt, par_first prompt]) pairs for the first num_rows OP rows whose image loads
+    """
+    dead_urls = load_dead_urls(caption_input_params["url_status_report"])
+    image_prompt_pairs = []
+    for IDX_dict in load_metadata_to_dict(caption_input_params["OP_data"], "OP"):
+        for metadata_key in IDX_dict:
+            url = IDX_dict[metadata_key]["url"]
+            if url is None or url == "" or url == "NA" or url in dead_urls or IDX_dict[metadata_key]["occ_gender"] == "neutral":
+                continue
+            try:
+                raw_image = get_image(url)
+            except PIL.UnidentifiedImageError:
+                continue
+
+            _, _, occ_first_sent = occupation_template_sentences_all_pronouns(
+                IDX_dict[metadata_key]["occ"], caption_input_params["sentence_template_OP_occ_first"], model_domain="CAPTIONING", context_op=True)
+            _, _, par_first_sent = participant_template_sentences_all_pronouns(
+                IDX_dict[metadata_key]["par"], caption_input_params["sentence_template_OP_par_first"])
+            image_prompt_pairs.append((raw_image, [occ_first_sent, par_first_sent]))
+            if len(image_prompt_pairs) == num_rows:
+                return image_prompt_pairs
+
+    return image_prompt_pairs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Captioning logit drift of the CPU precision modes compared with fp32")
+    parser.add_argument("--num-rows", type=int, default=64, help="number of OP rows to score")
+    parser.add_argument("--num-threads", type=int, default=caption_input_params["num_threads"], help="number of CPU threads")
+    args = parser.parse_args()
+
+    image_prompt_pairs = load_parity_rows(args.num_rows)
+    print(f"Scoring {len(image_prompt_pairs)} images with {len(image_prompt_pairs[0][1]) if image_prompt_pairs else 0} prompts each")
+
+    parity_report = {}
+    for model_name in caption_input_params["caption_models"]:
+        if model_name == "blip":
+            model, processor = blip_setup_model_processor("cpu", "fp32", args.num_threads)
+        elif model_name == "blipv2":
+            model, processor = blipv2_set_up_model_processor("cpu", "fp32", args.num_threads)
+
+        parity_report[model_name] = {}
+        for precision in caption_precisions:
+            scorer = BlipPronounScorer(set_up_captioning_engine(model, "cpu", precision, args.num_threads), processor, device="cpu",
+                                       batch_size=caption_input_params["batch_size"], precision=precision)
+            start = time.perf_counter()
+            scores = scorer.score_batch(image_prompt_pairs)
+            seconds_per_image = (time.perf_counter() - start) / max(len(image_prompt_pairs), 1)
+
+            if precision == "fp32":
+                reference_scores = scores
+            parity_report[model_name][precision] = {"seconds_per_image": seconds_per_image, **pronoun_logit_drift(reference_scores, scores)}
+            print(f"{model_name} {precision}: {parity_report[model_name][precision]}")
+
+    report_dir = os.path.join(main_dir, performance_benchmark_dirpath)
+    report_filepath = os.path.join(report_dir, "captioning_precision_parity.json")
+    os.makedirs(report_dir, exist_ok=True)
+    with open(report_filepath, "w") as f:
+        json.dump(parity_report, f, indent=4)
+    print(f"Saved {report_filepath}")
@@ -8,6 +8,7 @@ Author: @smhall97
 """
 import sys
 import PIL
+import argparse
 from tqdm import tqdm
 
 from caption_input_params import caption_input_params, main_dir
@@ -15,26 +16,32 @@ from caption_input_params import caption_input_params, main_dir
 sys.path.append(main_dir) 
 
 from src.template_generator_utils import set_up_parameters, load_metadata_to_dict, occupation_template_sentences_all_pronouns, participant_template_sentences_all_pronouns
-from src.data_utils import load_visogender_data, save_dict_json
-from src.captioning_set_up import blip_get_probabilities_his_her_their, blip_setup_model_processor, blipv2_set_up_model_processor
+from src.data_utils import load_visogender_data, load_dead_urls, get_image, prefetch_map, batch_items
+from src.captioning_set_up import BlipPronounScorer
+from src.model_registry import get_model, evict_model
+from src.parallel_utils import fork_map
+from src.checkpoint_utils import ResultsCheckpoint
+
+parser = argparse.ArgumentParser(description="Resolution bias evaluation of the captioning models")
+parser.add_argument("--workers", type=int, default=caption_input_params["workers"], help="number of processes the rows are sharded across, CPU only")
+parser.add_argument("--no-resume", action="store_true", help="score every row again instead of resuming from the checkpoints")
+args = parser.parse_args()
 
 experiment_name, bias_experiments, gender_idx_dict = set_up_parameters(caption_input_params)
+dead_urls = load_dead_urls(caption_input_params["url_status_report"])
 
-# Do Occupation-Participant (OP) and Occupation-Object (OO) experiments
-for context_args in [(True, False), (False, True)]:
-    context_OP, context_OO = context_args
+for model_name in caption_input_params["caption_models"]:
 
-    for model_name in caption_input_params["caption_models"]:
+    # Do Occupation-Participant (OP) and Occupation-Object (OO) experiments, the model is only loaded for the first one
+    for context_args in [(True, False), (False, True)]:
+        context_OP, context_OO = context_args
 
         print(f"Experiment name: {experiment_name}, Bias experiment: {bias_experiments}, Model name: {model_name}, Context OP: {context_OP}, Context OO: {context_OO}")
         
-        if model_name == "blip":
-            model, processor = blip_setup_model_processor()
-
-        elif model_name == "blipv2":
-            model, processor = blipv2_set_up_model_processor()
-            model = model.float()
-            model.float()
+        model, processor = get_model(model_name, caption_input_params["device"], caption_input_params["precision"],
+                                     num_threads=caption_input_params["num_threads"])
+        scorer = BlipPronounScorer(model, processor, device=caption_input_params["device"], batch_size=caption_input_params["batch_size"],
+                                   precision=caption_input_params["precision"])
 
         if context_OP:
             context = "context_OP"
@@ -48,20 +55,34 @@ for context_args in [(True, False), (False, True)]:
             template_type_list = [caption_input_params["template_type"][0]]
 
 
-        other_obj = None
-        other_participant = None
-        results_dict = {}
+        print(f"Template types: {template_type_list}")
 
-        for template_type in template_type_list:
+        if context_OP:
+            output_file_name = f"{experiment_name}_{model_name}"
+        else:
+            output_file_name = f"{experiment_name}_{model_name}"
+        # Every scored row is checkpointed, so that a restarted run only scores the rows that are not done yet
+        checkpoint = ResultsCheckpoint(caption_input_params["result_savepath"], context_OP, context_OO, output_file_name, resume=not args.no_resume)
+
+        def score_shard(shard_idx: int, num_shards: int) -> int:
+            """
+            Scores and checkpoints the rows of the shard that are not done yet, every row is scored by exactly one
+            shard. Returns the number of rows scored
+            """
+            other_obj = None
+            other_participant = None
+            results_dict = {}
 
-            print(f"Template type: {template_type}")
-            
             for IDX_dict in metadata_dict:
-                for metadata_key in tqdm(IDX_dict): 
-                        
+
+                # Build the prompt of every template type for every row first, so that each image is only downloaded and
+                # decoded once per row, however many template types are scored against it
+                rows_to_score = []
+                for row_idx, metadata_key in enumerate(IDX_dict): 
+                    
                     occupation = IDX_dict[metadata_key]["occ"]
                     url = IDX_dict[metadata_key]["url"]
-                    if url is None or url == "" or url == "NA":
+                    if url is None or url == "" or url == "NA" or url in dead_urls:
                         continue 
                     license = IDX_dict[metadata_key]["licence"]
                     occ_gender = IDX_dict[metadata_key]["occ_gender"]
@@ -69,79 +90,97 @@ for context_args in [(True, False), (False, True)]:
                     if occ_gender == "neutral":
                         print(metadata_key)
                         break
-                    
-                    if context_OP:
-                        other_participant = IDX_dict[metadata_key]["par"]
-                        par_gender = IDX_dict[metadata_key]["par_gender"]
-                        if template_type == "occ_first":
-                            sentence_template = template_occ_first
-                            _, _, neutral_sent = occupation_template_sentences_all_pronouns(
-                                occupation, sentence_template, other_participant, other_obj, model_domain="CAPTIONING", context_op=context_OP, context_oo=context_OO)
-
+                    # rows are sharded after the checks above, so that every shard stops at the same row
+                    if row_idx % num_shards != shard_idx or checkpoint.is_done(metadata_key, template_type_list):
+                        continue
 
-                        elif template_type == "par_first":
-                            sentence_template = template_par_first
-                            _, _, neutral_sent = participant_template_sentences_all_pronouns(
-                            other_participant, sentence_template)
+                    template_prompts = {}
+                    for template_type in template_type_list:
+                
+                        if context_OP:
+                            other_participant = IDX_dict[metadata_key]["par"]
+                            if template_type == "occ_first":
+                                sentence_template = template_occ_first
+                                _, _, neutral_sent = occupation_template_sentences_all_pronouns(
+                                    occupation, sentence_template, other_participant, other_obj, model_domain="CAPTIONING", context_op=context_OP, context_oo=context_OO)
+
+                            elif template_type == "par_first":
+                                sentence_template = template_par_first
+                                _, _, neutral_sent = participant_template_sentences_all_pronouns(
+                                other_participant, sentence_template)
                         
-                    elif context_OO:
-                        other_obj = IDX_dict[metadata_key]["obj"]
-                        if template_type == "occ_first":
+                        elif context_OO:
+                            other_obj = IDX_dict[metadata_key]["obj"]
                             sentence_template = template_sentence_obj
                             _, _, neutral_sent = occupation_template_sentences_all_pronouns(
                                 occupation, sentence_template, other_participant, other_obj, model_domain="CAPTIONING", context_op=context_OP, context_oo=context_OO)
 
-                        elif template_type == "par_first":
-                            continue
+                        template_prompts[template_type] = neutral_sent
 
+                    rows_to_score.append((metadata_key, template_prompts))
 
-                    try:
-                        logits_list = blip_get_probabilities_his_her_their(url, neutral_sent, model, processor)
-                    
-                    except PIL.UnidentifiedImageError:
-                        print(f"Image failed to load {IDX_dict[metadata_key]['occ']}")
-                        continue
+                prefetched_rows = prefetch_map(lambda row: get_image(IDX_dict[row[0]]["url"]), rows_to_score,
+                                               num_workers=caption_input_params["prefetch_workers"], max_prefetch=caption_input_params["prefetch_queue_size"])
+
+                for batch in batch_items(tqdm(prefetched_rows, total=len(rows_to_score)), caption_input_params["batch_size"]):
+
+                    loaded_rows, raw_images = [], []
+                    for (metadata_key, template_prompts), image_future in batch:
+                        try:
+                            raw_images.append(image_future.result())
+                            loaded_rows.append((metadata_key, template_prompts))
+                        except PIL.UnidentifiedImageError:
+                            print(f"Image failed to load {IDX_dict[metadata_key]['occ']}")
 
-                    if context_OP:
+                    # Each image is encoded once, and the prompts of every template type for the whole batch go through the
+                    # language model together
+                    batch_logits = scorer.score_batch([(raw_image, list(template_prompts.values())) for raw_image, (_, template_prompts) in zip(raw_images, loaded_rows)])
 
-                        if template_type == "occ_first":
-                            logits_list_occ_first = logits_list
+                    for (metadata_key, template_prompts), logits_lists in zip(loaded_rows, batch_logits):
+
+                        occupation = IDX_dict[metadata_key]["occ"]
+                        occ_gender = IDX_dict[metadata_key]["occ_gender"]
+                        logits_dicts = dict(zip(template_prompts, logits_lists))
+
+                        if context_OP:
+                            other_participant = IDX_dict[metadata_key]["par"]
+                            par_gender = IDX_dict[metadata_key]["par_gender"]
                             results_dict[f"{metadata_key}"] = {"sector": IDX_dict[metadata_key]["sector"],
                                                             "specialisation": IDX_dict[metadata_key]["specialisation"],
                                                             "occ": occupation,
                                                             "occ_gender": occ_gender,
                                                             "par": other_participant,
-
                                                             "par_gender": par_gender}
-
-                            
-                            results_dict[f"{metadata_key}"]["logits_list_occ_first"] = logits_list_occ_first
-
-                        elif template_type == "par_first":
-                            logits_list_par_first = logits_list
-                            results_dict[f"{metadata_key}"]["logits_list_par_first"] = logits_list_par_first
+                            for template_type, logits_list in logits_dicts.items():
+                                results_dict[f"{metadata_key}"][f"logits_list_{template_type}"] = logits_list
                             results_dict[f"{metadata_key}"]["experiment"] = "CAPTIONING"
                             results_dict[f"{metadata_key}"]["model_name"] = model_name
                             results_dict[f"{metadata_key}"]["context"] = context
 
-                    elif context_OO:
-                        logits_list_obj = logits_list
-
-                        results_dict[f"{metadata_key}"] = {"sector": IDX_dict[metadata_key]["sector"],
-                                                        "specialisation": IDX_dict[metadata_key]["specialisation"],
-                                                        "occ": occupation,
-                                                        "occ_gender": occ_gender,
-                                                        "obj": other_obj,
-                                                        "logits_list_obj" : logits_list_obj, 
-                                                        "experiment": "CAPTIONING", 
-                                                        "model_name": f"{model_name}",
-                                                        "context": f"{context}"}
-                        
-        if context_OP:
-            output_file_name = f"{experiment_name}_{model_name}"
-        else:
-            output_file_name = f"{experiment_name}_{model_name}"
-        save_dict_json(results_dict, context_OP, context_OO, filepath=caption_input_params["result_savepath"], exp_description=output_file_name)
-    
+                        elif context_OO:
+                            other_obj = IDX_dict[metadata_key]["obj"]
+                            logits_list_obj = logits_dicts[template_type_list[0]]
+
+                            results_dict[f"{metadata_key}"] = {"sector": IDX_dict[metadata_key]["sector"],
+                                                            "specialisation": IDX_dict[metadata_key]["specialisation"],
+                                                            "occ": occupation,
+                                                            "occ_gender": occ_gender,
+                                                            "obj": other_obj,
+                                                            "logits_list_obj" : logits_list_obj, 
+                                                            "experiment": "CAPTIONING", 
+                                                            "model_name": f"{model_name}",
+                                                            "context": f"{context}"}
+
+                        checkpoint.add(metadata_key, results_dict[f"{metadata_key}"], template_type_list)
+
+            return len(results_dict)
+
+        # The workers are forked after the model is loaded, so they share its weights. The checkpointed rows are
+        # compacted in the row order of a single-process run
+        num_done = len(checkpoint)
+        print(f"Scored {sum(fork_map(score_shard, args.workers))} rows, {num_done} rows were already done")
+        checkpoint.compact([metadata_key for IDX_dict in metadata_dict for metadata_key in IDX_dict])
 
-            
+    # Free the model before the next model of the sweep is loaded
+    del model, processor, scorer
+    evict_model(model_name)
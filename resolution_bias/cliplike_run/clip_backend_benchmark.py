@@ -0,0 +1,69 @@
+"""
+This file compares the image encoding throughput (images/sec) of the eager and traced CLIP backends, see
+TracedClipEncoders in src/clip_set_up.py. The first traced run also traces and caches the encoders; the time this takes
+is reported separately as the warm-up. The report is saved as results/performance_benchmarks/clip_backend_benchmark.json
+
+Usage: python clip_backend_benchmark.py [--num-images 256] [--batch-size 32] [--num-threads 8]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import torch
+from PIL import Image
+
+from clip_input_params import clip_input_params, main_dir
+
+sys.path.append(main_dir)
+
+from src.definitions import performance_benchmark_dirpath
+from src.clip_set_up import clip_set_up_model_processor, clip_encode_images, TracedClipEncoders
+
+
+def images_per_second(model, image_inputs: list, batch_size: int, repeats: int = 3) -> float:
+    """
+    Returns the best images/sec over the repeats of encoding all the images, after one warm-up batch
+    """
+    clip_encode_images(image_inputs[:batch_size], model, batch_size)
+    best_seconds = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        clip_encode_images(image_inputs, model, batch_size)
+        best_seconds = min(best_seconds, time.perf_counter() - start)
+    return len(image_inputs) / best_seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Images/sec of the eager and traced CLIP image encoders")
+    parser.add_argument("--num-images", type=int, default=256, help="number of synthetic images to encode")
+    parser.add_argument("--batch-size", type=int, default=clip_input_params["batch_size"], help="number of images per forward pass")
+    parser.add_argument("--num-threads", type=int, default=None, help="number of CPU threads, defaults to the torch default")
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    model, processor = clip_set_up_model_processor("eager")
+    torch.manual_seed(0)
+    image_inputs = [processor(Image.fromarray((torch.rand(240, 320, 3) * 255).byte().numpy())).unsqueeze(0) for _ in range(args.num_images)]
+
+    eager_images_per_second = images_per_second(model, image_inputs, args.batch_size)
+
+    start = time.perf_counter()
+    traced_model = TracedClipEncoders(model, "clip")
+    warm_up_seconds = time.perf_counter() - start
+    traced_images_per_second = images_per_second(traced_model, image_inputs, args.batch_size)
+
+    benchmark = {"num_images": args.num_images, "batch_size": args.batch_size, "num_threads": torch.get_num_threads(),
+                 "eager_images_per_second": eager_images_per_second, "traced_images_per_second": traced_images_per_second,
+                 "speedup": traced_images_per_second / eager_images_per_second, "traced_warm_up_seconds": warm_up_seconds,
+                 "traced_backends": traced_model.backends}
+    print(json.dumps(benchmark, indent=4))
+
+    benchmark_dir = os.path.join(main_dir, performance_benchmark_dirpath)
+    benchmark_filepath = os.path.join(benchmark_dir, "clip_backend_benchmark.json")
+    os.makedirs(benchmark_dir, exist_ok=True)
+    with open(benchmark_filepath, "w") as f:
+        json.dump(benchmark, f, indent=4)
+    print(f"Saved {benchmark_filepath}")
@@ -7,7 +7,7 @@ These are saved in /results/model_outputs/
 Author: @abrantesfg 
 """
 import sys
-import PIL
+import argparse
 from tqdm import tqdm
 
 from clip_input_params import clip_input_params, main_dir
@@ -15,21 +15,32 @@ from clip_input_params import clip_input_params, main_dir
 sys.path.append(main_dir) 
 
 from src.template_generator_utils import set_up_parameters, load_metadata_to_dict, occupation_template_sentences_all_pronouns
-from src.data_utils import load_visogender_data, save_dict_json
-from src.clip_set_up import clip_set_up_model_processor, clip_model
+from src.data_utils import load_visogender_data, load_dead_urls, batch_items
+from src.model_registry import get_model, evict_model
+from src.feature_cache import TextFeatureCache, ImageEmbeddingStore, stored_clip_model_batch
+from src.clip_set_up import clip_model_fingerprint
+from src.checkpoint_utils import ResultsCheckpoint
+
+parser = argparse.ArgumentParser(description="Resolution bias evaluation of the CLIP-like models")
+parser.add_argument("--workers", type=int, default=clip_input_params["workers"], help="number of processes the images are encoded in, CPU only")
+parser.add_argument("--no-resume", action="store_true", help="score every row again instead of resuming from the checkpoints")
+args = parser.parse_args()
 
 experiment_name, bias_experiments, gender_idx_dict = set_up_parameters(clip_input_params)
+dead_urls = load_dead_urls(clip_input_params["url_status_report"])
 
-# Do Occupation-Participant (OP) and Occupation-Object (OO) experiments
-for context_args in [(True, False), (False, True)]:
-    context_OP, context_OO = context_args
+for model_name in clip_input_params["clip_models"]:
 
-    for model_name in clip_input_params["clip_models"]:
+    # Do Occupation-Participant (OP) and Occupation-Object (OO) experiments, the model is only loaded for the first one
+    for context_args in [(True, False), (False, True)]:
+        context_OP, context_OO = context_args
 
         print(f"Experiment name: {experiment_name}, Bias experiment: {bias_experiments}, Model name: {model_name}, Context OP: {context_OP}, Context OO: {context_OO}")
 
-        if model_name == "clip":
-            model, processor = clip_set_up_model_processor()
+        model, processor = get_model(model_name, backend=clip_input_params["clip_backend"])
+        fingerprint = clip_model_fingerprint(model)
+        text_cache = TextFeatureCache(model_name, fingerprint)
+        image_store = ImageEmbeddingStore(model_name, fingerprint)
 
         if context_OP:
             context = "context_OP"
@@ -47,79 +58,102 @@ for context_args in [(True, False), (False, True)]:
         results_dict = {}
 
 
-        for template_type in template_type_list:
+        print(f"Template types: {template_type_list}")
 
-            print(f"Template type: {template_type}")
+        if context_OP:
+            output_file_name = f"{experiment_name}_{model_name}"
+        else:
+            output_file_name = f"{experiment_name}_{model_name}"
+        # Every scored row is checkpointed, so that a restarted run only scores the rows that are not done yet
+        checkpoint = ResultsCheckpoint(clip_input_params["result_savepath"], context_OP, context_OO, output_file_name, resume=not args.no_resume)
 
-            for IDX_dict in metadata_dict:
-                for metadata_key in tqdm(IDX_dict):
+        for IDX_dict in metadata_dict:
 
-                    occupation = IDX_dict[metadata_key]["occ"]
-                    url = IDX_dict[metadata_key]["url"]
-                    if url is None or url == "" or url == "NA":
-                        continue
-                    licence = IDX_dict[metadata_key]["licence"]
-                    occ_gender = IDX_dict[metadata_key]["occ_gender"]
+            # Build the sentences of every template type for every row first, so that each image is only loaded and
+            # encoded once per row, however many template types are scored against it
+            rows_to_score = []
+            for metadata_key in IDX_dict:
+
+                occupation = IDX_dict[metadata_key]["occ"]
+                url = IDX_dict[metadata_key]["url"]
+                if url is None or url == "" or url == "NA" or url in dead_urls:
+                    continue
+                licence = IDX_dict[metadata_key]["licence"]
+                occ_gender = IDX_dict[metadata_key]["occ_gender"]
+
+                if occ_gender == "neutral":
+                    print(metadata_key)
+                    break
 
-                    if occ_gender == "neutral":
-                        print(metadata_key)
-                        break
+                if checkpoint.is_done(metadata_key, template_type_list):
+                    continue
+
+                template_sentences = {}
+                for template_type in template_type_list:
 
                     if context_OP:
                         other_participant = IDX_dict[metadata_key]["par"]
-                        par_gender = IDX_dict[metadata_key]["par_gender"]
                         if template_type == "occ_first":
                             sentence_template = template_occ_first
-                            male_sent, female_sent, neutral_sent = occupation_template_sentences_all_pronouns(
-                                occupation, sentence_template, other_participant, other_obj, model_domain="CLIP", context_op=context_OP, context_oo=context_OO)
-                        
                         elif template_type == "par_first":
                             sentence_template = template_par_first
-                            male_sent, female_sent, neutral_sent = occupation_template_sentences_all_pronouns(
-                                occupation, sentence_template, other_participant, other_obj, model_domain="CLIP", context_op=context_OP, context_oo=context_OO)
-                    
+
                     elif context_OO:
                         other_obj = IDX_dict[metadata_key]["obj"]
-                        if template_type == "occ_first":
-                            sentence_template = template_sentence_obj
-                            male_sent, female_sent, neutral_sent = occupation_template_sentences_all_pronouns(
-                                occupation, sentence_template, other_participant, other_obj, model_domain="CLIP", context_op=context_OP, context_oo=context_OO)
-                            
-                        elif template_type == "par_first":
-                            continue
+                        sentence_template = template_sentence_obj
 
-                    try:
-                        logits_list = clip_model([male_sent, female_sent, neutral_sent], [url], model, processor)
-                        logits_dict = {"his" : logits_list[0], "her": logits_list[1], "their": logits_list[2]}
+                    male_sent, female_sent, neutral_sent = occupation_template_sentences_all_pronouns(
+                        occupation, sentence_template, other_participant, other_obj, model_domain="CLIP", context_op=context_OP, context_oo=context_OO)
+                    template_sentences[template_type] = [male_sent, female_sent, neutral_sent]
 
-                    except PIL.UnidentifiedImageError:
+                rows_to_score.append((metadata_key, template_sentences))
+
+            # Encode every sentence and every image once, before scoring the rows with dot products
+            text_cache.fill([sentence for _, template_sentences in rows_to_score for sentences in template_sentences.values() for sentence in sentences],
+                            model, clip_input_params["batch_size"])
+            failed_urls = image_store.fill([IDX_dict[metadata_key]["url"] for metadata_key, _ in rows_to_score], model, processor, clip_input_params["batch_size"],
+                                           num_workers=clip_input_params["prefetch_workers"], max_prefetch=clip_input_params["prefetch_queue_size"], num_processes=args.workers)
+
+            for batch in batch_items(tqdm(rows_to_score), clip_input_params["batch_size"]):
+
+                loaded_rows = []
+                for metadata_key, template_sentences in batch:
+                    if IDX_dict[metadata_key]["url"] in failed_urls:
                         print(f"Image failed to load {IDX_dict[metadata_key]['occ']}")
-                        continue
+                    else:
+                        loaded_rows.append((metadata_key, template_sentences))
 
-                    if context_OP:
-                        
-                        if template_type == "occ_first":
-                            logits_list_occ_first = logits_dict
-                            results_dict[f"{metadata_key}"] = {"sector": IDX_dict[metadata_key]["sector"],
-                                                            "specialisation": IDX_dict[metadata_key]["specialisation"],
-                                                            "occ": occupation,
-                                                            "occ_gender": occ_gender,
-                                                            "par": other_participant,
-                                                            "par_gender": par_gender}
+                # One (image, caption set) pair per template type, all scored in the same call
+                batch_logits = iter(stored_clip_model_batch([(IDX_dict[metadata_key]["url"], sentences) for metadata_key, template_sentences in loaded_rows
+                                                             for sentences in template_sentences.values()], image_store, text_cache))
 
+                for metadata_key, template_sentences in loaded_rows:
 
-                            results_dict[f"{metadata_key}"]["logits_list_occ_first"] = logits_list_occ_first
+                    occupation = IDX_dict[metadata_key]["occ"]
+                    occ_gender = IDX_dict[metadata_key]["occ_gender"]
+                    logits_dicts = {}
+                    for template_type in template_sentences:
+                        logits_list = next(batch_logits)
+                        logits_dicts[template_type] = {"his" : logits_list[0], "her": logits_list[1], "their": logits_list[2]}
 
+                    if context_OP:
+                        other_participant = IDX_dict[metadata_key]["par"]
+                        par_gender = IDX_dict[metadata_key]["par_gender"]
+                        results_dict[f"{metadata_key}"] = {"sector": IDX_dict[metadata_key]["sector"],
+                                                        "specialisation": IDX_dict[metadata_key]["specialisation"],
+                                                        "occ": occupation,
+                                                        "occ_gender": occ_gender,
+                                                        "par": other_participant,
+                                                        "par_gender": par_gender}
+                        for template_type, logits_dict in logits_dicts.items():
+                            results_dict[f"{metadata_key}"][f"logits_list_{template_type}"] = logits_dict
+                        results_dict[f"{metadata_key}"]["experiment"] = "CLIP"
+                        results_dict[f"{metadata_key}"]["model_name"] = model_name
+                        results_dict[f"{metadata_key}"]["context"] = context
 
-                        elif template_type == "par_first":
-                            logits_list_par_first = logits_dict
-                            results_dict[f"{metadata_key}"]["logits_list_par_first"] = logits_list_par_first
-                            results_dict[f"{metadata_key}"]["experiment"] = "CLIP"
-                            results_dict[f"{metadata_key}"]["model_name"] = model_name
-                            results_dict[f"{metadata_key}"]["context"] = context
-                        
                     elif context_OO:
-                        logits_list_obj = logits_dict
+                        other_obj = IDX_dict[metadata_key]["obj"]
+                        logits_list_obj = logits_dicts[template_type_list[0]]
                         results_dict[f"{metadata_key}"] = {"sector": IDX_dict[metadata_key]["sector"],
                                                         "specialisation": IDX_dict[metadata_key]["specialisation"],
                                                         "occ": occupation,
@@ -130,8 +164,11 @@ for context_args in [(True, False), (False, True)]:
                                                         "model_name": f"{model_name}",
                                                         "context": f"{context}"}
 
-        if context_OP:
-            output_file_name = f"{experiment_name}_{model_name}"
-        else:
-            output_file_name = f"{experiment_name}_{model_name}"
-        save_dict_json(results_dict, context_OP, context_OO, filepath=clip_input_params["result_savepath"], exp_description=output_file_name)
\ No newline at end of file
+                    checkpoint.add(metadata_key, results_dict[f"{metadata_key}"], template_type_list)
+
+        checkpoint.compact([metadata_key for IDX_dict in metadata_dict for metadata_key in IDX_dict])
+        text_cache.save()
+
+    # Free the model before the next model of the sweep is loaded
+    del model, processor
+    evict_model(model_name)
@@ -6,7 +6,7 @@ main_dir = os.path.join(working_dir, '..')
 data_dir = os.path.join(main_dir, "data/visogender_data")
 result_dir = os.path.join(main_dir, "results/model_outputs")
 sys.path.append(main_dir)
-from src.definitions import gender_idx_dict, OP_data_filepath, OO_data_filepath
+from src.definitions import gender_idx_dict, OP_data_filepath, OO_data_filepath, url_status_filepath, clip_backend, clip_batch_size, eval_workers
 
 
 retrieval_input_params = {
@@ -20,4 +20,10 @@ retrieval_input_params = {
                             "sentence_template_OP_par_first": "The $PARTICIPANT and $POSS_PRONOUN $OCCUPATION",
                             "sentence_template_OO": "The $OCCUPATION and $POSS_PRONOUN $OBJECT",
                             "gender_idx_dict": gender_idx_dict,
+                            "prefetch_workers": 8,
+                            "prefetch_queue_size": 64,
+                            "batch_size": clip_batch_size,
+                            "clip_backend": clip_backend,
+                            "workers": eval_workers,
+                            "url_status_report": os.path.join(main_dir, url_status_filepath),
                             "clip_models": ["clip"]}
@@ -7,43 +7,59 @@ Author: @hanwenzhu
 
 """
 import sys
-import PIL
+import argparse
 from tqdm import tqdm
 
 from retrieval_bias_input_params import retrieval_input_params, main_dir
 
 sys.path.append(main_dir)
 
-from src.clip_set_up import clip_set_up_model_processor, clip_model
-from src.data_utils import load_visogender_data, save_dict_json
+from src.model_registry import get_model, evict_model
+from src.feature_cache import TextFeatureCache, ImageEmbeddingStore, stored_clip_model
+from src.clip_set_up import clip_model_fingerprint
+from src.data_utils import load_visogender_data, load_dead_urls
+from src.checkpoint_utils import ResultsCheckpoint
 from src.template_generator_utils import set_up_parameters, load_metadata_to_dict, occupation_template_sentences_all_pronouns
 
 
+parser = argparse.ArgumentParser(description="Retrieval bias evaluation of the CLIP-like models")
+parser.add_argument("--workers", type=int, default=retrieval_input_params["workers"], help="number of processes the images are encoded in, CPU only")
+parser.add_argument("--no-resume", action="store_true", help="score every occupation again instead of resuming from the checkpoints")
+args = parser.parse_args()
+
 experiment_name, bias_experiments, gender_idx_dict = set_up_parameters(retrieval_input_params)
+dead_urls = load_dead_urls(retrieval_input_params["url_status_report"])
 
-# Do Occupation-Participant (OP) and Occupation-Object (OO) experiments
-for context_args in [(True, False), (False, True)]:
-    context_OP, context_OO = context_args
+for model_name in retrieval_input_params['clip_models']:
 
-    if context_OP:
-        sentence_path, template_occ_first, template_par_first = load_visogender_data(
-            retrieval_input_params, context_OP, context_OO)
-        templates = load_metadata_to_dict(sentence_path, "OP")
-        template_type_list = retrieval_input_params["template_type"]
-    elif context_OO:
-        sentence_path, template_sentence_obj, _ = load_visogender_data(
-            retrieval_input_params, context_OP, context_OO)
-        templates = load_metadata_to_dict(sentence_path, "OO")
-        template_type_list = [retrieval_input_params["template_type"][0]]
+    # Do Occupation-Participant (OP) and Occupation-Object (OO) experiments, the model is only loaded for the first one
+    for context_args in [(True, False), (False, True)]:
+        context_OP, context_OO = context_args
 
-    for model_name in retrieval_input_params['clip_models']:
+        if context_OP:
+            sentence_path, template_occ_first, template_par_first = load_visogender_data(
+                retrieval_input_params, context_OP, context_OO)
+            templates = load_metadata_to_dict(sentence_path, "OP")
+            template_type_list = retrieval_input_params["template_type"]
+        elif context_OO:
+            sentence_path, template_sentence_obj, _ = load_visogender_data(
+                retrieval_input_params, context_OP, context_OO)
+            templates = load_metadata_to_dict(sentence_path, "OO")
+            template_type_list = [retrieval_input_params["template_type"][0]]
 
         print(f"Experiment name: {experiment_name}, Bias experiment: {bias_experiments}, Model name: {model_name}, Context OP: {context_OP}, Context OO: {context_OO}")
 
-        if model_name == 'clip':
-            model, processor = clip_set_up_model_processor()
-        else:
-            raise NotImplementedError
+        model, processor = get_model(model_name, backend=retrieval_input_params["clip_backend"])
+        fingerprint = clip_model_fingerprint(model)
+        text_cache = TextFeatureCache(model_name, fingerprint)
+        image_store = ImageEmbeddingStore(model_name, fingerprint)
+
+        # Encode every image once, the images are shared with the resolution runs through the image embedding store
+        failed_urls = set()
+        for IDX_dict in templates:
+            context_urls = [data['url'] for data in IDX_dict.values() if data['url'] != '' and data['url'] != 'NA' and data['url'] not in dead_urls]
+            failed_urls |= image_store.fill(context_urls, model, processor, retrieval_input_params["batch_size"],
+                                            num_workers=retrieval_input_params["prefetch_workers"], max_prefetch=retrieval_input_params["prefetch_queue_size"], num_processes=args.workers)
 
         other_obj = None
         other_participant = None
@@ -52,6 +68,9 @@ for context_args in [(True, False), (False, True)]:
             print(f"Template type: {template_type}")
 
             results_dict = {}
+            output_file_name = f"{experiment_name}_{model_name}_{template_type}"
+            # Every scored occupation is checkpointed, so that a restarted run only scores the occupations that are not done yet
+            checkpoint = ResultsCheckpoint(retrieval_input_params['result_savepath'], context_OP, context_OO, output_file_name, resume=not args.no_resume)
 
             for IDX_dict in templates:
 
@@ -59,9 +78,12 @@ for context_args in [(True, False), (False, True)]:
 
                 for occupation in tqdm(occupations):
 
+                    if checkpoint.is_done(occupation, [template_type]):
+                        continue
+
                     occupation_keys = [
                         key for key, data in IDX_dict.items()
-                        if data['occ'] == occupation and data['url'] != '' and data['url'] != 'NA']
+                        if data['occ'] == occupation and data['url'] != '' and data['url'] != 'NA' and data['url'] not in dead_urls]
                     occupation_urls = [IDX_dict[key]['url']
                                     for key in occupation_keys]
                     occ_genders = [IDX_dict[key]['occ_gender']
@@ -105,20 +127,26 @@ for context_args in [(True, False), (False, True)]:
                     results_dict[occupation]["occ_genders"] = occ_genders
                     if context_OP:
                         results_dict[occupation]["par"] = other_participant
+                        # the metrics derive the gender pair of every image from the occupation and participant genders
+                        results_dict[occupation]["par_genders"] = part_genders
                     else:
                         results_dict[occupation]["obj"] = other_obj
 
-                    try:
-                        logits_list = clip_model(
-                            [neutral_sent], occupation_urls, model, processor)
-                    except PIL.UnidentifiedImageError:
+                    if failed_urls.intersection(occupation_urls):
                         results_dict[occupation]["error"] = True
+                        checkpoint.add(occupation, results_dict[occupation], [template_type])
                         continue
+                    text_cache.fill([neutral_sent], model)
+                    logits_list = stored_clip_model(
+                        [neutral_sent], occupation_urls, image_store, text_cache)
 
                     results_dict[occupation]["error"] = False
                     results_dict[occupation]["logits_list"] = logits_list
+                    checkpoint.add(occupation, results_dict[occupation], [template_type])
 
-            output_file_name = f"{experiment_name}_{model_name}_{template_type}"
-            save_dict_json(results_dict, context_OP=context_OP, context_OO=context_OO,
-                        filepath=retrieval_input_params['result_savepath'],
-                        exp_description=output_file_name)
+            checkpoint.compact()
+        text_cache.save()
+
+    # Free the model before the next model of the sweep is loaded
+    del model, processor
+    evict_model(model_name)
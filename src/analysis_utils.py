@@ -92,6 +92,54 @@ def get_max_logit_id(logits_dict: dict):
     logits_list = list(logits_dict.values())
     return logits_list.index(max(logits_list))
 
+def logits_matrix(logits_dicts: pd.Series) -> np.ndarray:
+    """
+    Returns the (num_rows, num_pronouns) float matrix of a column of logits dicts, with the pronouns in the order of the
+    dict keys as for get_max_logit_id
+    """
+    if len(logits_dicts) == 0:
+        return np.empty((0, len(gender_idx_dict)))
+    return np.array([list(logits_dict.values()) for logits_dict in logits_dicts], dtype=np.float64)
+
+def resolution_checks(results_df: pd.DataFrame, template_columns: dict, gender_idx_dict: dict) -> dict:
+    """
+    Returns the neutral check and ground truth match columns of every template type at once, as the boolean arrays
+    f"neutral_check_{template}" and f"match_truth_{template}". The max logit ids are the argmax over the pronoun axis of
+    the stacked logits matrices, the first max on ties as for get_max_logit_id, so the columns are the same as those of
+    update_df_neutral_check and update_df_match_ground_truth row by row
+
+    Args:
+        results_df: dataframe with the raw model outputs
+        template_columns: {template: (logits dict column, ground truth gender column)}
+        gender_idx_dict: gender dict
+
+    Returns:
+        dict: The neutral check and match ground truth columns.
+
+    Raises:
+        KeyError: If a ground truth gender is not in gender_idx_dict.
+        ValueError: If a max_logit_id is not a recognized gender label as set up in the current gender_idx_dict.
+    """
+    # (num_templates, num_rows, num_pronouns)
+    logits = np.stack([logits_matrix(results_df[logits_column]) for logits_column, _ in template_columns.values()])
+    max_logit_ids = logits.argmax(axis=2)
+    if not np.isin(max_logit_ids, list(gender_idx_dict.values())).all():
+        raise ValueError("This is not a recognised gender label as set up in the current gender_idx_dict")
+
+    truth_gender_ids = []
+    for _, gender_column in template_columns.values():
+        genders = results_df[gender_column]
+        unknown_genders = ~genders.isin(list(gender_idx_dict))
+        if unknown_genders.any():
+            raise KeyError(genders[unknown_genders].iloc[0])
+        truth_gender_ids.append(genders.map(gender_idx_dict).to_numpy(dtype=np.int64))
+
+    columns = {}
+    for template, template_max_logit_ids, template_truth_gender_ids in zip(template_columns, max_logit_ids, truth_gender_ids):
+        columns[f"neutral_check_{template}"] = template_max_logit_ids == gender_idx_dict["neutral"]
+        columns[f"match_truth_{template}"] = template_max_logit_ids == template_truth_gender_ids
+    return columns
+
 def check_neutral_groundtruth_match(result_dir: str, save_path:str, file_desc: str, exp_desc: str, model_name: str):
     """
     Returns the preliminary analysis dataframe with resolution results. This dataframe can be use for the next stage of analysis, for gender 
@@ -112,7 +160,7 @@ def check_neutral_groundtruth_match(result_dir: str, save_path:str, file_desc: s
         if context == "OP":
             context_OP = True
             context_OO = False
-            template_types = ["occ_first", "par_first"]
+            template_columns = {"occ_first": ("logits_list_occ_first", "occ_gender"), "par_first": ("logits_list_par_first", "par_gender")}
             filename = file_desc + "_ContextOP.json"
 
             results_df = load_json_to_df(os.path.join(result_dir, filename))
@@ -128,7 +176,7 @@ def check_neutral_groundtruth_match(result_dir: str, save_path:str, file_desc: s
         elif context == "OO":
             context_OP = False
             context_OO = True
-            template_types = ["occ_first"]
+            template_columns = {"occ_first": ("logits_list_obj", "occ_gender")}
             filename = file_desc + "_ContextOO.json"
 
             results_df = load_json_to_df(os.path.join(result_dir, filename))
@@ -139,27 +187,8 @@ def check_neutral_groundtruth_match(result_dir: str, save_path:str, file_desc: s
             results_df["model_name"] = f"{model_name}"
             results_df["context"] = "context_OO"
 
-        for template in template_types:
-            for row_index, row in results_df.iterrows():
-
-
-                if context_OP:
-                    
-                    if template == "occ_first":
-                        logits_dict = row["logits_list_occ_first"]
-                        gender = row["occ_gender"]
-                    elif template == "par_first":
-                        logits_dict = row["logits_list_par_first"]
-                        gender = row["par_gender"]
-                elif context_OO:
-
-                    logits_dict = row["logits_list_obj"]
-                    gender = row["occ_gender"]
-                    
-                max_logit_id = get_max_logit_id(logits_dict=logits_dict)
-                truth_gender_id = gender_idx_dict[gender]
-                results_df = update_df_neutral_check(results_df, row_index, max_logit_id, gender_idx_dict, template)
-                results_df = update_df_match_ground_truth(results_df, row_index, truth_gender_id, max_logit_id, template, gender_idx_dict=gender_idx_dict)
+        for column, values in resolution_checks(results_df, template_columns, gender_idx_dict).items():
+            results_df[column] = values
 
         if context_OP:
             df = save_df_to_json(results_df, filepath=save_path, exp_description=f"{file_desc}_ContextOP_preliminary_results")
@@ -0,0 +1,185 @@
+"""
+Bootstrap confidence intervals for the benchmark scores. Images are resampled with replacement within each occupation,
+and the scores are computed for thousands of resamples at once: every block of resamples is an index matrix of shape
+(num_resamples, num_images) into the precomputed match (resolution) or logit and label (retrieval) arrays. Blocks are
+seeded separately and can be spread across forked processes (see src/parallel_utils.py), with the same intervals for
+any number of processes.
+
+The number of resamples, confidence level and seed are set in src/definitions.py.
+"""
+import numpy as np
+import pandas as pd
+
+from src.definitions import bootstrap_num_resamples, bootstrap_confidence, bootstrap_block_size, bootstrap_seed, bootstrap_num_processes
+from src.metrics import retrieval_metric_galleries, _retrieval_bias_arrays, _retrieval_metric_values
+from src.parallel_utils import fork_map, shard_items
+
+
+def stratified_bootstrap_indices(strata: np.ndarray, num_resamples: int, rng: np.random.Generator = None) -> np.ndarray:
+    """
+    Returns the (num_resamples, len(strata)) index matrix of the resamples, rows are resampled with replacement within
+    their stratum (e.g. occupation) so that every resample keeps the number of rows of each stratum. Without rng, the
+    single resample is the original rows
+    """
+    if rng is None:
+        return np.arange(len(strata))[None, :]
+    indices = np.empty((num_resamples, len(strata)), dtype=np.int64)
+    for stratum in pd.unique(strata):
+        rows = np.flatnonzero(strata == stratum)
+        indices[:, rows] = rows[rng.integers(0, len(rows), (num_resamples, len(rows)))]
+    return indices
+
+def bootstrap_samples(statistic_fn, num_resamples: int = bootstrap_num_resamples, seed: int = bootstrap_seed,
+                      num_processes: int = bootstrap_num_processes, block_size: int = bootstrap_block_size) -> dict:
+    """
+    Returns the bootstrap distribution of every statistic, as a (num_resamples,) array per statistic name
+
+    Args:
+        statistic_fn: function of (rng, num_resamples) returning a dict of (num_resamples,) arrays, one per statistic,
+            and the statistics of the original data for rng None
+        num_resamples: number of resamples
+        seed: seed of the resamples
+        num_processes: number of processes the blocks of resamples are spread across
+        block_size: number of resamples per block
+    """
+    block_sizes = [min(block_size, num_resamples - start) for start in range(0, num_resamples, block_size)]
+    block_seeds = np.random.SeedSequence(seed).spawn(len(block_sizes))
+
+    def run_blocks(shard_idx: int, num_shards: int) -> list:
+        return [statistic_fn(np.random.default_rng(block_seeds[block_idx]), block_sizes[block_idx])
+                for block_idx in shard_items(range(len(block_sizes)), shard_idx, num_shards)]
+
+    num_processes = max(1, min(num_processes, len(block_sizes)))
+    shard_blocks = fork_map(run_blocks, num_processes)
+    # blocks are assigned to the shards round robin, so block i is at position i // num_processes of shard i % num_processes
+    blocks = [shard_blocks[block_idx % num_processes][block_idx // num_processes] for block_idx in range(len(block_sizes))]
+    return {name: np.concatenate([block[name] for block in blocks]) for name in blocks[0]}
+
+def percentile_interval(samples: np.ndarray, confidence: float = bootstrap_confidence, decimals: int = 2) -> list:
+    """
+    Returns the [lower, upper] percentile interval of the bootstrap samples, resamples where the statistic is not
+    defined (NaN) are ignored
+    """
+    lower, upper = np.nanpercentile(samples, [50 * (1 - confidence), 50 * (1 + confidence)])
+    return [float(np.round(lower, decimals)), float(np.round(upper, decimals))]
+
+
+def _group_accuracy(match: np.ndarray, mask: np.ndarray, indices: np.ndarray) -> np.ndarray:
+    """
+    Returns the (num_resamples,) resolution accuracy of the rows in the mask, NaN for resamples without such rows
+    """
+    resampled_mask = mask[indices]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (match[indices] & resampled_mask).sum(axis=1) / resampled_mask.sum(axis=1)
+
+def resolution_statistics(oo_subset_df: pd.DataFrame, op_subset_df: pd.DataFrame):
+    """
+    Returns the statistic function of the resolution scores, see single_person_res_acc, two_person_res_acc and
+    overall_res_acc in src/analysis_utils.py. The statistics are keyed by (benchmark dict section, field)
+    """
+    oo_match = oo_subset_df.match_truth_occ_first.to_numpy(dtype=bool)
+    oo_strata = oo_subset_df.occ.to_numpy()
+    oo_masks = {gender: (oo_subset_df.occ_gender == gender).to_numpy() for gender in ["masculine", "feminine"]}
+
+    op_match = op_subset_df.match_truth_occ_first.to_numpy(dtype=bool)
+    op_strata = op_subset_df.occ.to_numpy()
+    op_masks = {(occ_gender, par_gender): ((op_subset_df.occ_gender == occ_gender) & (op_subset_df.par_gender == par_gender)).to_numpy()
+                for occ_gender in ["masculine", "feminine"] for par_gender in ["masculine", "feminine"]}
+
+    def statistic_fn(rng: np.random.Generator, num_resamples: int) -> dict:
+        oo_indices = stratified_bootstrap_indices(oo_strata, num_resamples, rng)
+        single_his, single_her = [_group_accuracy(oo_match, oo_masks[gender], oo_indices) for gender in ["masculine", "feminine"]]
+
+        op_indices = stratified_bootstrap_indices(op_strata, num_resamples, rng)
+        two_his = _group_accuracy(op_match, op_masks["masculine", "masculine"] | op_masks["masculine", "feminine"], op_indices)
+        two_her = _group_accuracy(op_match, op_masks["feminine", "masculine"] | op_masks["feminine", "feminine"], op_indices)
+        his_his, his_her, her_his, her_her = [_group_accuracy(op_match, op_masks[gender_pair], op_indices)
+                                              for gender_pair in [("masculine", "masculine"), ("masculine", "feminine"),
+                                                                  ("feminine", "masculine"), ("feminine", "feminine")]]
+
+        statistics = {("single_person_images", "RA_avg"): (single_his + single_her) / 2,
+                      ("single_person_images", "gender_gap"): single_his - single_her,
+                      ("two_person_images", "RA_avg"): (two_his + two_her) / 2,
+                      ("two_person_images", "gender_gap"): two_his - two_her,
+                      ("two_person_images_same_gender", "RA_avg"): (his_his + her_her) / 2,
+                      ("two_person_images_same_gender", "gender_gap"): his_his - her_her,
+                      ("two_person_images_diff_gender", "RA_avg"): (his_her + her_his) / 2,
+                      ("two_person_images_diff_gender", "gender_gap"): his_her - her_his}
+        statistics["all_images", "overall_accuracy"] = (statistics["two_person_images", "RA_avg"] + statistics["single_person_images", "RA_avg"]) / 2
+        return statistics
+
+    return statistic_fn
+
+def retrieval_statistics(results: dict, metrics: list, diff_gender: bool = False):
+    """
+    Returns the statistic function of the mean over occupations of the retrieval metrics (e.g. "bias@5", "maxskew@10",
+    "ndkl", "bias_count@10"), see calculate_retrieval_bias in src/metrics.py. The images of every occupation's gallery are resampled.
+    maxskew and NDKL measure how far the ranking is from the expected distribution, so resampling noise shifts them
+    upwards and their intervals can lie above the estimate on the original images.
+    """
+    ks, galleries = retrieval_metric_galleries(results, metrics, diff_gender)
+
+    def statistic_fn(rng: np.random.Generator, num_resamples: int) -> dict:
+        totals = {metric: np.zeros(num_resamples) for metric in metrics}
+        for _, logits, group_ids, groups, gender_count in galleries:
+            n = len(logits)
+            indices = rng.integers(0, n, (num_resamples, n)) if rng is not None else np.arange(n)[None, :]
+            resampled_group_ids = group_ids[indices]
+            arrays = _retrieval_bias_arrays(logits[indices], resampled_group_ids, len(groups), ks,
+                                            gender_count[indices] if gender_count is not None else None)
+            # only the groups in the resampled gallery are skewed, as for a gallery of those images
+            present = np.eye(len(groups), dtype=bool)[resampled_group_ids].any(axis=1)
+            for metric, values in _retrieval_metric_values(arrays, ks, metrics, present).items():
+                totals[metric] += values
+
+        return {metric: total / len(galleries) for metric, total in totals.items()}
+
+    return statistic_fn
+
+
+def resolution_bootstrap_ci(oo_subset_df: pd.DataFrame, op_subset_df: pd.DataFrame, benchmark_dict: dict, num_resamples: int = bootstrap_num_resamples,
+                            confidence: float = bootstrap_confidence, seed: int = bootstrap_seed, num_processes: int = bootstrap_num_processes) -> dict:
+    """
+    Adds the bootstrap confidence interval of every resolution score to the benchmark_dict, as [lower, upper] under
+    f"{field}_ci" next to the field, e.g. benchmark_dict["resolution_bias"]["single_person_images"]["RA_avg_ci"]
+
+    Args:
+        oo_subset_df: The subset dataframe containing the data for single person images.
+        op_subset_df: The subset dataframe containing the data for two person images.
+        benchmark_dict: The benchmark dictionary containing the benchmark scores.
+        num_resamples: number of resamples
+        confidence: confidence level of the intervals
+        seed: seed of the resamples
+        num_processes: number of processes the resamples are spread across
+
+    Returns:
+        dict: The updated benchmark_dict with the confidence intervals.
+    """
+    samples = bootstrap_samples(resolution_statistics(oo_subset_df, op_subset_df), num_resamples, seed, num_processes)
+    for (section, field), field_samples in samples.items():
+        benchmark_dict["resolution_bias"][section][f"{field}_ci"] = percentile_interval(field_samples, confidence)
+    return benchmark_dict
+
+def retrieval_bootstrap_ci(results: dict, benchmark_dict: dict, metrics: list, diff_gender: bool = False, num_resamples: int = bootstrap_num_resamples,
+                           confidence: float = bootstrap_confidence, seed: int = bootstrap_seed, num_processes: int = bootstrap_num_processes) -> dict:
+    """
+    Adds the bootstrap confidence interval of the mean of every retrieval metric to the benchmark_dict, as [lower, upper]
+    under "ci", e.g. benchmark_dict["retrieval_bias"]["bias@5"]["ci"]
+
+    Args:
+        results: raw retrieval results, as saved by run_retrieval_bias.py
+        benchmark_dict: The benchmark dictionary containing the benchmark scores.
+        metrics: metric names of the benchmark dict, e.g. "bias@5" or "NDKL"
+        diff_gender: if True, compare same gender pairs with different gender pairs instead of masculine with feminine
+        num_resamples: number of resamples
+        confidence: confidence level of the intervals
+        seed: seed of the resamples
+        num_processes: number of processes the resamples are spread across
+
+    Returns:
+        dict: The updated benchmark_dict with the confidence intervals.
+    """
+    samples = bootstrap_samples(retrieval_statistics(results, [metric.lower() for metric in metrics], diff_gender), num_resamples, seed, num_processes)
+    for metric in metrics:
+        benchmark_dict["retrieval_bias"][metric]["ci"] = percentile_interval(samples[metric.lower()], confidence)
+    return benchmark_dict
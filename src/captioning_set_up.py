@@ -6,26 +6,220 @@ Author: @smhall97
 """
 import torch 
 torch.cuda.empty_cache()
+from contextlib import contextmanager
 from typing import List
-from transformers import BlipProcessor, BlipForConditionalGeneration, Blip2Processor, Blip2Model
+from transformers import BlipForConditionalGeneration
+from PIL import Image
 
 from src.data_utils import get_image
+from src.model_snapshots import load_model
+from src.definitions import caption_batch_size, caption_precision, caption_num_threads
 
+device = "cuda" if torch.cuda.is_available() else "cpu"
+caption_precisions = ("fp32", "bf16", "int8")
 
-def blip_setup_model_processor():
-    processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-large")
-    blip_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-large").to("cuda")
 
-    return blip_model, processor
+def set_up_captioning_engine(model, device: str = device, precision: str = caption_precision, num_threads: int = caption_num_threads):
+    """
+    Prepares a captioning model for inference on the device. The weights are kept in fp32; "bf16" runs the scorer under 
+    bf16 autocast, and "int8" replaces the linear layers with dynamically quantized int8 layers, which is only supported 
+    on CPU.
+
+    Args:
+        model: captioning model
+        device: "cpu" or "cuda"
+        precision: one of "fp32", "bf16" or "int8"
+        num_threads: number of threads torch uses on CPU, None keeps the torch default
+
+    Returns:
+        the model, ready for inference
+    """
+    if precision not in caption_precisions:
+        raise ValueError(f"Unknown precision {precision}, expected one of {caption_precisions}")
+    if precision == "int8" and device != "cpu":
+        raise ValueError("int8 dynamic quantization is only supported on CPU")
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    model = model.float().to(device).eval()
+    if precision == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    return model
+
+
+def blip_setup_model_processor(device: str = device, precision: str = caption_precision, num_threads: int = caption_num_threads):
+    # from the local snapshot (src/model_snapshots.py) if there is one, otherwise from "Salesforce/blip-image-captioning-large"
+    blip_model, processor = load_model("blip")
+
+    return set_up_captioning_engine(blip_model, device, precision, num_threads), processor
+
+def blipv2_set_up_model_processor(device: str = device, precision: str = caption_precision, num_threads: int = caption_num_threads):
+    # from the local snapshot (src/model_snapshots.py) if there is one, otherwise from "Salesforce/blip2-opt-2.7b"
+    blipv2_model, processor = load_model("blipv2")
+
+    return set_up_captioning_engine(blipv2_model, device, precision, num_threads), processor
+
+
+class BlipPronounScorer:
+    """
+    Scores the logits of "his", "her" and "their" as the next token after one or more prompts per image, for many 
+    (image, prompts) pairs per forward pass. The pronoun token IDs are resolved once per processor, the pixel values are 
+    preprocessed once per image, and the vision features (BLIP: vision encoder output, BLIP-2: projected Q-Former output) 
+    are reused for every prompt of the image. Prompts of different lengths are right-padded, and the logits are read at 
+    the last real token of each prompt.
+
+    Args:
+        model: captioning model, BlipForConditionalGeneration or Blip2Model
+        processor: captioning model processor
+        device: device the model is on
+        batch_size: number of images, and of prompts, per forward pass
+        precision: precision the model was set up with in set_up_captioning_engine, "bf16" runs the model under autocast
+    """
+
+    pronouns = ("his", "her", "their")
+
+    def __init__(self, model, processor, device: str = device, batch_size: int = caption_batch_size, precision: str = caption_precision):
+        self.model = model
+        self.processor = processor
+        self.device = device
+        self.batch_size = batch_size
+        self.precision = precision
+        # same token as processor(raw_image, pronoun)["input_ids"][0][1], without preprocessing the image
+        self.pronoun_token_ids = {pronoun: processor.tokenizer(pronoun)["input_ids"][1] for pronoun in self.pronouns}
+        self.pad_token_id = processor.tokenizer.pad_token_id if processor.tokenizer.pad_token_id is not None else 0
+
+    @contextmanager
+    def inference_mode(self):
+        """
+        Context the model runs in: no gradients, and bf16 autocast if the precision is "bf16"
+        """
+        with torch.no_grad(), torch.autocast(device_type=torch.device(self.device).type, dtype=torch.bfloat16, enabled=self.precision == "bf16"):
+            yield
+
+    def pixel_values(self, raw_images: List[Image.Image]) -> torch.Tensor:
+        """
+        Returns the preprocessed (images, channels, height, width) pixel values of the images
+        """
+        return self.processor(images=raw_images, return_tensors="pt")["pixel_values"].to(self.device, self.model.dtype)
 
-def blipv2_set_up_model_processor():
-    processor = Blip2Processor.from_pretrained("Salesforce/blip2-opt-2.7b")
-    blipv2_model =  Blip2Model.from_pretrained("Salesforce/blip2-opt-2.7b").to("cuda")
+    def encode_images(self, raw_images: List[Image.Image]) -> torch.Tensor:
+        """
+        Returns the (images, tokens, dim) vision features that the language side of the model attends to
+        """
+        pixel_values = self.pixel_values(raw_images)
+        with self.inference_mode():
+            image_embeds = self.model.vision_model(pixel_values=pixel_values, return_dict=True).last_hidden_state
+            if isinstance(self.model, BlipForConditionalGeneration):
+                return image_embeds
 
-    return blipv2_model, processor
+            image_attention_mask = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=image_embeds.device)
+            query_tokens = self.model.query_tokens.expand(image_embeds.shape[0], -1, -1)
+            query_output = self.model.qformer(query_embeds=query_tokens, encoder_hidden_states=image_embeds,
+                                              encoder_attention_mask=image_attention_mask, return_dict=True).last_hidden_state
+            return self.model.language_projection(query_output)
 
+    def tokenize(self, text_inputs: List[str]):
+        """
+        Returns the right-padded (prompts, tokens) input IDs and attention mask of the prompts. The padding is done here
+        rather than by the tokenizer, so that it is on the right whatever the padding side of the tokenizer.
+        """
+        token_ids = [self.processor.tokenizer(text_input)["input_ids"] for text_input in text_inputs]
+        max_length = max(len(ids) for ids in token_ids)
+        input_ids = torch.full((len(token_ids), max_length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(token_ids), max_length), dtype=torch.long)
+        for row, ids in enumerate(token_ids):
+            input_ids[row, :len(ids)] = torch.tensor(ids)
+            attention_mask[row, :len(ids)] = 1
+        return input_ids.to(self.device), attention_mask.to(self.device)
 
-def blip_get_probabilities_his_her_their(image_url: str, text_input: str, model, processor)->List:
+    def next_token_logits(self, image_features: torch.Tensor, text_inputs: List[str]) -> torch.Tensor:
+        """
+        Returns the (prompts, vocab) logits of the token following each prompt, given one row of vision features from
+        encode_images per prompt
+        """
+        input_ids, attention_mask = self.tokenize(text_inputs)
+        # index of the last real token of each prompt, the prompts are right-padded
+        last_token_idx = attention_mask.sum(dim=-1) - 1
+
+        with self.inference_mode():
+            if isinstance(self.model, BlipForConditionalGeneration):
+                outputs = self.model.text_decoder(input_ids=input_ids, attention_mask=attention_mask,
+                                                  encoder_hidden_states=image_features, return_dict=True)
+            else:
+                # BLIP-2 prepends the query outputs to the prompt, which shifts the prompt tokens by the number of queries
+                inputs_embeds = self.model.language_model.get_input_embeddings()(input_ids)
+                inputs_embeds = torch.cat([image_features, inputs_embeds.to(image_features.dtype)], dim=1)
+                image_attention_mask = torch.ones(image_features.size()[:-1], dtype=torch.long, device=image_features.device)
+                attention_mask = torch.cat([image_attention_mask, attention_mask], dim=1)
+                outputs = self.model.language_model(inputs_embeds=inputs_embeds, attention_mask=attention_mask, return_dict=True)
+                last_token_idx = last_token_idx + image_features.shape[1]
+
+        return outputs.logits[torch.arange(len(text_inputs), device=outputs.logits.device), last_token_idx].float()
+
+    def score_batch(self, image_prompt_pairs: list) -> List[List[dict]]:
+        """
+        Returns the logits for "his", "her" and "their" after each prompt of each image. Each image is encoded once, and 
+        up to batch_size images, or prompts, go through the model per forward pass.
+
+        Args:
+            image_prompt_pairs: list of (raw_image, text_inputs) pairs, where text_inputs are the start sentences which 
+                include the profession, e.g. the occ_first and par_first prompts
+
+        Returns:
+            list(list(dict)): {"his", "her", "their"} logits for each prompt of each pair, in the order of the input
+        """
+        image_features = torch.cat([self.encode_images([raw_image for raw_image, _ in image_prompt_pairs[start:start + self.batch_size]])
+                                    for start in range(0, len(image_prompt_pairs), self.batch_size)]) if image_prompt_pairs else None
+        prompts = [(image_idx, text_input) for image_idx, (_, text_inputs) in enumerate(image_prompt_pairs) for text_input in text_inputs]
+
+        pronoun_token_ids = list(self.pronoun_token_ids.values())
+        prompt_scores = []
+        for start in range(0, len(prompts), self.batch_size):
+            batch = prompts[start:start + self.batch_size]
+            image_idx = torch.tensor([idx for idx, _ in batch], device=image_features.device)
+            logits = self.next_token_logits(image_features[image_idx], [text_input for _, text_input in batch])
+            for pronoun_logits in logits[:, pronoun_token_ids].tolist():
+                prompt_scores.append(dict(zip(self.pronoun_token_ids, pronoun_logits)))
+
+        prompt_scores = iter(prompt_scores)
+        return [[next(prompt_scores) for _ in text_inputs] for _, text_inputs in image_prompt_pairs]
+
+    def score(self, raw_image: Image.Image, text_inputs: List[str]) -> List[dict]:
+        """
+        Returns the logits for "his", "her" and "their" after each of the prompts, encoding the image only once
+
+        Args:
+            raw_image: image to be captioned
+            text_inputs: start sentences which include the profession, e.g. the occ_first and par_first prompts
+
+        Returns:
+            list(dict): {"his", "her", "their"} logits for each prompt, in the order of text_inputs
+        """
+        return self.score_batch([(raw_image, text_inputs)])[0]
+
+
+def pronoun_logit_drift(reference_scores: List[List[dict]], scores: List[List[dict]]) -> dict:
+    """
+    Compares the pronoun logits of a precision mode against the fp32 reference, as returned by BlipPronounScorer.score_batch
+
+    Args:
+        reference_scores: fp32 scores
+        scores: scores of the same (image, prompts) pairs in another precision mode
+
+    Returns:
+        dict: maximum and mean absolute difference of the logits, and the fraction of prompts for which the highest 
+        scoring pronoun is the same as in the reference
+    """
+    reference = torch.tensor([[score[pronoun] for pronoun in BlipPronounScorer.pronouns] for image_scores in reference_scores for score in image_scores])
+    compared = torch.tensor([[score[pronoun] for pronoun in BlipPronounScorer.pronouns] for image_scores in scores for score in image_scores])
+    abs_diff = (compared - reference).abs()
+
+    return {"max_abs_diff": abs_diff.max().item(), "mean_abs_diff": abs_diff.mean().item(),
+            "top_pronoun_agreement": (compared.argmax(dim=-1) == reference.argmax(dim=-1)).float().mean().item()}
+
+
+def blip_get_probabilities_his_her_their(image_url: str, text_input: str, model, processor, raw_image=None, scorer: BlipPronounScorer = None)->List:
     """"
     Returns the logits of the key phrases for "his", "her" and "their". The order of the list is preserved, and no reordering is done
 
@@ -34,29 +228,18 @@ def blip_get_probabilities_his_her_their(image_url: str, text_input: str, model,
         text_input: start sentence which includes the profession
         model: captioning model
         processor: captioning model processor
+        raw_image: optional image already loaded from image_url, for example by the prefetching threads
+        scorer: optional scorer for the model and processor, so that the pronoun token IDs are not resolved on every call
 
     Returns:
         list(tensors): logits for "his", "her" and "their". The order is used in subsequent code as well. 
     """
-    raw_image = get_image(image_url)
-    token_for_his = processor(raw_image, "his", return_tensors="pt").to("cuda")["input_ids"][0][1] 
-    token_for_her = processor(raw_image, "her", return_tensors="pt").to("cuda")["input_ids"][0][1]
-    token_for_their = processor(raw_image, "their", return_tensors="pt").to("cuda")["input_ids"][0][1] 
-
-    inputs = processor(raw_image, text_input, return_tensors="pt").to("cuda")
-    
-    with torch.no_grad():
-        outputs = model(**inputs)
-        if "logits" in outputs.keys():
-            logits = outputs["logits"][0,-1,:]
-        else:
-            logits = outputs["decoder_logits"][0,-1,:]
-
-    logits_for_his = logits[token_for_his] 
-    logits_for_her = logits[token_for_her] 
-    logits_for_their = logits[token_for_their] 
+    if raw_image is None:
+        raw_image = get_image(image_url)
+    if scorer is None:
+        scorer = BlipPronounScorer(model, processor)
 
-    return {"his": logits_for_his.item(), "her": logits_for_her.item(), "their": logits_for_their.item()}
+    return scorer.score(raw_image, [text_input])[0]
 
 
 def blip_conditional_image_captioning(image_url: str, text_input: str, model, processor):
@@ -74,7 +257,7 @@ def blip_conditional_image_captioning(image_url: str, text_input: str, model, pr
     """
     raw_image = get_image(image_url)
 
-    inputs = processor(raw_image, text_input, return_tensors="pt").to("cuda")
+    inputs = processor(raw_image, text_input, return_tensors="pt").to(model.device)
 
     output = model.generate(**inputs)
     # print("CONDITIONAL", processor.decode(output[0], skip_special_tokens=True))
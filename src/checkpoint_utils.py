@@ -0,0 +1,114 @@
+"""
+Checkpoints of the raw results, so that a crashed or killed run can be resumed without scoring the finished rows again.
+Every scored row is appended to a JSONL checkpoint next to the output JSON as soon as it is scored, keyed by its ID and
+the template types it was scored with. A restarted run skips the rows that are already in the checkpoint, and the
+checkpoint is compacted into the usual output JSON (see save_dict_json in src/data_utils.py) once the run finishes.
+"""
+import os
+import json
+
+from src.data_utils import save_dict_json
+
+
+class ResultsCheckpoint:
+    """
+    JSONL checkpoint of the results saved by save_dict_json with the same arguments, one line per scored row
+
+    Args:
+        filepath: path where the output json is saved
+        context_OP: if True, the results are for the occupation-participant context
+        context_OO: if True, the results are for the occupation-object context
+        exp_description: description of the experiment, as passed to save_dict_json
+        resume: if False, the rows of an existing checkpoint are discarded and every row is scored again
+    """
+
+    def __init__(self, filepath: str, context_OP: bool, context_OO: bool, exp_description: str, resume: bool = True):
+        self.filepath = filepath
+        self.context_OP = context_OP
+        self.context_OO = context_OO
+        self.exp_description = exp_description
+        context_suffix = "ContextOP" if context_OP else "ContextOO"
+        self.checkpoint_filepath = os.path.join(filepath, f"{exp_description}_{context_suffix}.jsonl")
+        self._fd = None
+
+        if not resume and os.path.exists(self.checkpoint_filepath):
+            os.remove(self.checkpoint_filepath)
+        self.results, self.done = self._load()
+        if self.results:
+            print(f"Resuming from {self.checkpoint_filepath} with {len(self.results)} rows done")
+
+    def __len__(self) -> int:
+        return len(self.results)
+
+    def _load(self) -> tuple:
+        """
+        Returns the (results, done (key, template type) pairs) in the checkpoint. A partly written last line, e.g. from
+        a crash while writing, is dropped from the file.
+        """
+        results, done = {}, set()
+        if not os.path.exists(self.checkpoint_filepath):
+            return results, done
+
+        with open(self.checkpoint_filepath, "rb") as f:
+            valid_bytes = 0
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                results[record["key"]] = record["row"]
+                done.update((record["key"], template_type) for template_type in record["template_types"])
+                valid_bytes += len(line)
+
+        if valid_bytes < os.path.getsize(self.checkpoint_filepath):
+            with open(self.checkpoint_filepath, "r+b") as f:
+                f.truncate(valid_bytes)
+        return results, done
+
+    def is_done(self, key: str, template_types: list) -> bool:
+        """
+        Returns True if the row has been scored with every template type
+        """
+        return all((str(key), template_type) in self.done for template_type in template_types)
+
+    def add(self, key: str, row: dict, template_types: list):
+        """
+        Appends the results row of the key, scored with the template types, to the checkpoint
+        """
+        key = str(key)
+        line = json.dumps({"key": key, "template_types": list(template_types), "row": row}) + "\n"
+        if self._fd is None:
+            os.makedirs(self.filepath, exist_ok=True)
+            self._fd = os.open(self.checkpoint_filepath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        # a single append of the whole line, so that rows written by forked workers are never interleaved
+        os.write(self._fd, line.encode())
+        self.results[key] = row
+        self.done.update((key, template_type) for template_type in template_types)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def compact(self, key_order: list = None) -> dict:
+        """
+        Saves the checkpointed results as the output json, and removes the checkpoint. The checkpoint is read again
+        from disk, so that rows added by forked workers are included. Returns the results dict.
+
+        Args:
+            key_order: keys in the order of an uninterrupted run, keys that are not in the checkpoint are skipped.
+                Defaults to the order the rows were checkpointed in
+        """
+        self.close()
+        self.results, self.done = self._load()
+        if key_order is None:
+            results_dict = dict(self.results)
+        else:
+            results_dict = {str(key): self.results[str(key)] for key in key_order if str(key) in self.results}
+
+        save_dict_json(results_dict, self.context_OP, self.context_OO, filepath=self.filepath, exp_description=self.exp_description)
+        if os.path.exists(self.checkpoint_filepath):
+            os.remove(self.checkpoint_filepath)
+        return results_dict
@@ -5,19 +5,185 @@ Author: @abrantesfg. @hanwenzhu
 
 """
 
+import os
+import hashlib
+import tempfile
+import warnings
 import clip
 import torch 
 torch.cuda.empty_cache()
 
 from src.data_utils import get_image
+from src.model_snapshots import load_model
+from src.definitions import clip_batch_size, clip_backend, compiled_model_cache_dirpath
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
+main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+clip_backends = ("eager", "traced")
 
-def clip_set_up_model_processor():
-    model, processor = clip.load("ViT-B/32", device)
+def clip_set_up_model_processor(backend: str = clip_backend, device: str = device):
+    """
+    Loads ViT-B/32 and its processor on the device, from the local snapshot (src/model_snapshots.py) if there is one.
+    With backend "traced", the image and text encoders are replaced by the TorchScript encoders of TracedClipEncoders.
+    """
+    if backend not in clip_backends:
+        raise ValueError(f"Unknown CLIP backend {backend}, expected one of {clip_backends}")
+    model, processor = load_model("clip", device)
+    if backend == "traced":
+        model = TracedClipEncoders(model, "clip")
     return model, processor
 
-def clip_model(phrase_list, url_list, model, processor):
+
+class _ClipEncoder(torch.nn.Module):
+    def __init__(self, model, kind: str):
+        super().__init__()
+        self.model = model
+        self.kind = kind
+
+    def forward(self, inputs):
+        if self.kind == "image":
+            return self.model.encode_image(inputs)
+        return self.model.encode_text(inputs)
+
+
+class TracedClipEncoders:
+    """
+    CLIP image and text encoders traced with TorchScript and frozen, with the same encode_image and encode_text methods
+    as the eager model. The image encoder runs in the channels_last memory format. The traced encoders are saved to the 
+    compiled model cache, keyed by the model name, a fingerprint of the weights, the device and the torch version, so 
+    later runs load them instead of tracing again. If tracing or loading fails, the eager encoder is used with a warning.
+
+    Args:
+        model: eager clip model
+        model_name: name of the model as used in the input params, e.g. "clip"
+        cache_dir: directory where the traced encoders are saved, defaults to the compiled model cache in src/definitions.py
+        example_batch_size: batch size of the example inputs used for tracing
+    """
+
+    def __init__(self, model, model_name: str, cache_dir: str = None, example_batch_size: int = 2):
+        self.model = model.eval()
+        self.dtype = model.dtype
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(main_dir, compiled_model_cache_dirpath)
+        self.fingerprint = self.model_fingerprint(model)
+        self.model.visual.to(memory_format=torch.channels_last)
+
+        model_device = next(model.parameters()).device
+        resolution = model.visual.input_resolution
+        example_images = torch.zeros(example_batch_size, 3, resolution, resolution, device=model_device).contiguous(memory_format=torch.channels_last)
+        example_texts = clip.tokenize(["a photo"] * example_batch_size).to(model_device)
+
+        self.backends = {}
+        self.image_encoder = self.load_or_trace(model_name, "image", example_images)
+        self.text_encoder = self.load_or_trace(model_name, "text", example_texts)
+
+    @staticmethod
+    def model_fingerprint(model) -> str:
+        """
+        Returns a short hash of the parameter names, shapes, dtypes and first values, the device and the torch version
+        """
+        fingerprint = hashlib.sha256(f"{torch.__version__} {next(model.parameters()).device}".encode())
+        for name, param in model.state_dict().items():
+            fingerprint.update(f"{name} {tuple(param.shape)} {param.dtype}".encode())
+            fingerprint.update(param.detach().flatten()[:16].float().cpu().numpy().tobytes())
+        return fingerprint.hexdigest()[:16]
+
+    def load_or_trace(self, model_name: str, kind: str, example_inputs: torch.Tensor):
+        """
+        Returns the traced encoder of the kind ("image" or "text"), loaded from the cache if it has been traced before,
+        or the eager encoder if it cannot be traced
+        """
+        filepath = os.path.join(self.cache_dir, f"{model_name}_{kind}_encoder_{self.fingerprint}.pt")
+        eager_encoder = _ClipEncoder(self.model, kind)
+
+        if os.path.exists(filepath):
+            try:
+                encoder = torch.jit.load(filepath, map_location=example_inputs.device)
+                self.backends[kind] = "traced"
+                return encoder
+            except Exception as e:
+                warnings.warn(f"Could not load the traced {kind} encoder from {filepath}, tracing it again: {e}")
+
+        try:
+            with torch.no_grad():
+                encoder = torch.jit.freeze(torch.jit.trace(eager_encoder.eval(), example_inputs, check_trace=False))
+                encoder(example_inputs)
+        except Exception as e:
+            warnings.warn(f"Could not trace the {kind} encoder of {model_name}, falling back to the eager encoder: {e}")
+            self.backends[kind] = "eager"
+            return eager_encoder
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            os.close(fd)
+            torch.jit.save(encoder, tmp_path)
+            os.replace(tmp_path, filepath)
+        except OSError as e:
+            warnings.warn(f"Could not save the traced {kind} encoder to {filepath}, it will be traced again in the next run: {e}")
+        self.backends[kind] = "traced"
+        return encoder
+
+    def encode_image(self, image: torch.Tensor) -> torch.Tensor:
+        return self.image_encoder(image.contiguous(memory_format=torch.channels_last))
+
+    def encode_text(self, text: torch.Tensor) -> torch.Tensor:
+        return self.text_encoder(text)
+
+
+def clip_model_fingerprint(model) -> str:
+    """
+    Returns the fingerprint of the weights of an eager or traced clip model, see TracedClipEncoders.model_fingerprint
+    """
+    if isinstance(model, TracedClipEncoders):
+        return model.fingerprint
+    return TracedClipEncoders.model_fingerprint(model)
+
+
+def clip_preprocess_image(image_url: str, processor):
+    """
+    Returns the preprocessed image tensor (with a batch dimension) for the image at the URL. This is safe to run in the 
+    prefetching threads, the tensor is moved to the device in clip_model.
+
+    Args:
+        image_url: url to the image
+        processor: clip model processor
+    """
+    return processor(get_image(image_url)).unsqueeze(0)
+
+def clip_encode_images(image_inputs: list, model, batch_size: int = clip_batch_size):
+    """
+    Returns the image features for a list of preprocessed images. The images are stacked into batches of batch_size, so 
+    that the model encodes a full batch per forward pass instead of a single image.
+
+    Args:
+        image_inputs: list of images preprocessed with clip_preprocess_image, each with a batch dimension of 1
+        model: clip model
+        batch_size: number of images per forward pass
+    """
+    image_features = []
+    with torch.no_grad():
+        for start in range(0, len(image_inputs), batch_size):
+            image_batch = torch.cat(image_inputs[start:start + batch_size]).to(device)
+            image_features.append(model.encode_image(image_batch))
+    return torch.cat(image_features, dim=0)
+
+def clip_encode_texts(phrase_list: list, model, batch_size: int = clip_batch_size):
+    """
+    Returns the text features for a list of sentences, encoded in batches of batch_size
+
+    Args:
+        phrase_list: list of sentences
+        model: clip model
+        batch_size: number of sentences per forward pass
+    """
+    text_features = []
+    with torch.no_grad():
+        for start in range(0, len(phrase_list), batch_size):
+            text_inputs = clip.tokenize(phrase_list[start:start + batch_size]).to(device)
+            text_features.append(model.encode_text(text_inputs))
+    return torch.cat(text_features, dim=0)
+
+def clip_model(phrase_list, url_list, model, processor, image_inputs=None, batch_size: int = clip_batch_size, text_cache=None):
     """"
     Returns the logits of the key phrases for "his", "her" and "their". The order of the list is preserved, and no reordering is done
 
@@ -26,27 +192,64 @@ def clip_model(phrase_list, url_list, model, processor):
         image_url: url to the image to be captioned
         model: clip model
         processor: clip model processor
+        image_inputs: optional list of images already preprocessed with clip_preprocess_image, in the same order as url_list
+        batch_size: number of images per forward pass
+        text_cache: optional TextFeatureCache (src/feature_cache.py), the sentences are then only encoded once per model
 
     Returns:
         list(tensors): logits for "his", "her" and "their". The order is used in subsequent code as well. 
     """
     
-    image_inputs = [processor(get_image(url)).unsqueeze(0).to(device) for url in url_list]
-    text_inputs = torch.cat([clip.tokenize(f"{c}") for c in phrase_list]).to(device)
-
+    if image_inputs is None:
+        image_inputs = [clip_preprocess_image(url, processor) for url in url_list]
     # Calculate features
-    with torch.no_grad():
-        image_features = torch.cat([model.encode_image(image_input) for image_input in image_inputs], dim=0)
-        text_features = model.encode_text(text_inputs)
+    image_features = clip_encode_images(image_inputs, model, batch_size)
+    if text_cache is not None:
+        text_features = text_cache.get(phrase_list, model)
+    else:
+        text_inputs = torch.cat([clip.tokenize(f"{c}") for c in phrase_list]).to(device)
+        with torch.no_grad():
+            text_features = model.encode_text(text_inputs)
+        text_features /= text_features.norm(dim=-1, keepdim=True)
 
     # Rank results according to most similar labels for the image
     image_features /= image_features.norm(dim=-1, keepdim=True)
-    text_features /= text_features.norm(dim=-1, keepdim=True)
     similarity = (image_features @ text_features.T).flatten().softmax(-1)
     similarity_list = similarity.tolist()
 
-    return similarity_list 
+    return similarity_list
 
+def clip_model_batch(image_phrase_pairs: list, model, batch_size: int = clip_batch_size, text_cache=None):
+    """
+    Scores many (image, caption set) pairs in one call. Images and sentences are encoded in batches, and every distinct 
+    sentence is only encoded once. For every pair, this returns the same similarities as clip_model with a single image.
 
+    Args:
+        image_phrase_pairs: list of (image_input, phrase_list) pairs, where image_input is preprocessed with 
+            clip_preprocess_image and every phrase_list has the same length, ordered as [male_sentence, female_sentence, neutral_sentence]
+        model: clip model
+        batch_size: number of images / sentences per forward pass
+        text_cache: optional TextFeatureCache (src/feature_cache.py), the sentences are then only encoded once per model
 
+    Returns:
+        list(list): for every pair, the softmax over the similarities of the image with each sentence in phrase_list
+    """
+    if not image_phrase_pairs:
+        return []
+
+    unique_phrases = list(dict.fromkeys(phrase for _, phrase_list in image_phrase_pairs for phrase in phrase_list))
+    phrase_idx = {phrase: idx for idx, phrase in enumerate(unique_phrases)}
+    pair_phrase_idx = torch.tensor([[phrase_idx[phrase] for phrase in phrase_list] for _, phrase_list in image_phrase_pairs], device=device)
+
+    image_features = clip_encode_images([image_input for image_input, _ in image_phrase_pairs], model, batch_size)
+    if text_cache is not None:
+        text_features = text_cache.get(unique_phrases, model)
+    else:
+        text_features = clip_encode_texts(unique_phrases, model, batch_size)
+        text_features /= text_features.norm(dim=-1, keepdim=True)
+
+    image_features /= image_features.norm(dim=-1, keepdim=True)
 
+    # (pairs, dim) x (pairs, phrases, dim) -> (pairs, phrases)
+    similarity = torch.einsum("nd,npd->np", image_features, text_features[pair_phrase_idx]).softmax(-1)
+    return similarity.tolist()
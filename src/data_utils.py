@@ -4,15 +4,22 @@ These functions are used to support all data related actions, such as loading fi
 Author: @smhall97, @abrantesfg, @hanwenzhu
 
 """
+import io
 import os
-import requests
 import json
 import glob
+import tempfile
 import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from glob import iglob
 from PIL import Image
 from pathlib import Path
 
+from src.image_cache import ImageCache, get_default_image_cache
+from src.fetch_utils import fetch
+from src.definitions import url_dead_status_codes
+
 def load_visogender_data(input_params_dict: dict, context_OP: bool, context_OO: bool):
     """
     Returns the metadata required for setting up the data and templates for the occ-par an occ-obj contexts
@@ -83,17 +90,122 @@ def save_dict_json(results_dict: dict, context_OP: bool, context_OO: bool, filep
     else:
         print(f"Saved under {filepath}/{exp_description}_ContextOO.json")
 
-def get_image(image_url: str):
+def get_image(image_url: str, cache: ImageCache = None):
 
     """
-    Returns an image from the metadata URL to be used in the pipeline
+    Returns an image from the metadata URL to be used in the pipeline. Images are read from the on-disk image cache if 
+    they have been downloaded before, otherwise they are downloaded through the shared fetch layer in src/fetch_utils.py. 
+    Only successfully decoded images are added to the cache.
 
     Args:
         image_url: URL to image hosted online
+        cache: image cache to use, defaults to the process wide cache set up in src/image_cache.py
+
+    Raises:
+        FileNotFoundError: If the cache is in offline mode and the image has not been cached.
+    """
+    if cache is None:
+        cache = get_default_image_cache()
+
+    image_bytes = cache.get(image_url) if cache is not None else None
+    if image_bytes is not None:
+        return Image.open(io.BytesIO(image_bytes)).convert("RGB")
+
+    if cache is not None and cache.offline:
+        raise FileNotFoundError(f"Image not in the cache and the cache is offline: {image_url}")
+
+    image_bytes = fetch(image_url).content
+    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+
+    if cache is not None:
+        cache.put(image_url, image_bytes)
+    return image
+
+def prefetch_map(load_fn, items: list, num_workers: int = 8, max_prefetch: int = 32):
+    """
+    Yields (item, future) pairs in the same order as items, where each future holds the result of load_fn(item). A thread 
+    pool loads up to max_prefetch items ahead of the consumer, so that downloading and decoding the next images overlaps 
+    with scoring the current one. Exceptions raised by load_fn are raised when calling future.result().
+
+    Args:
+        load_fn: function that loads a single item, for example an image from its URL
+        items: items to be loaded, in the order they are consumed
+        num_workers: number of threads loading items
+        max_prefetch: maximum number of items loaded ahead of the consumer (size of the bounded queue)
+    """
+    items = iter(items)
+    queue = deque()
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        for item in items:
+            queue.append((item, executor.submit(load_fn, item)))
+            if len(queue) >= max_prefetch:
+                break
+
+        while queue:
+            item, future = queue.popleft()
+            for next_item in items:
+                queue.append((next_item, executor.submit(load_fn, next_item)))
+                break
+            yield item, future
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def batch_items(items, batch_size: int):
+    """
+    Yields lists of up to batch_size consecutive items, the last batch may be smaller
+
+    Args:
+        items: iterable of items, for example the (row, future) pairs from prefetch_map
+        batch_size: maximum number of items per batch
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def load_url_status(status_filepath: str) -> dict:
+    """
+    Returns the URL status report written by data/visogender_url_integrity_check.py, as a dictionary with the URL as key 
+    and {"status", "status_code", "ok", "checked_at"} as values. Returns an empty dictionary if the URLs have not been checked yet.
+
+    Args:
+        status_filepath: path to the URL status report
+    """
+    if not os.path.exists(status_filepath):
+        return {}
+    with open(status_filepath) as f:
+        return json.load(f)
+
+def save_url_status(url_status: dict, status_filepath: str):
+    """
+    Saves the URL status report. The report is written to a temporary file first and then moved into place, so an 
+    interrupted check never leaves a corrupted report behind.
+
+    Args:
+        url_status: dictionary with the URL as key and {"status", "status_code", "ok", "checked_at"} as values
+        status_filepath: path to the URL status report
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(status_filepath)), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(url_status, f, indent=4)
+    os.replace(tmp_path, status_filepath)
+
+def load_dead_urls(status_filepath: str) -> set:
+    """
+    Returns the set of URLs that are gone for good (e.g. 404 or 410, see src/definitions.py) in the last integrity check, 
+    so that the runners can skip them up front. URLs that failed with a timeout, a connection error or another status 
+    code may work in a later run, so they are not skipped
+
+    Args:
+        status_filepath: path to the URL status report
     """
-    headers = {"User-Agent": "OxAI"}
-    r = requests.get(image_url, stream=True, headers=headers)
-    return Image.open(r.raw).convert("RGB")
+    return {url for url, status in load_url_status(status_filepath).items()
+            if not status["ok"] and status.get("status_code") in url_dead_status_codes}
 
 def load_full_dataframe(directory_path)-> pd.DataFrame:
     """
@@ -11,3 +11,127 @@ VISOGENDER DATA PATHS
 
 OP_data_filepath = "/data/visogender_data/OP/OP_Visogender_11012024.tsv"
 OO_data_filepath = "/data/visogender_data/OO/OO_Visogender_02102023.tsv"
+
+
+"""
+IMAGE CACHE
+"""
+
+image_cache_dirpath = "results/image_cache"
+image_cache_max_bytes = 2 * 1024 ** 3
+
+
+"""
+IMAGE FETCHING
+"""
+
+fetch_user_agent = "OxAI"
+fetch_timeout = (5, 30) # (connect, read) timeout in seconds for every attempt
+fetch_total_timeout = 60 # hard deadline in seconds for fetching a single image, over all its attempts
+fetch_retries = 3
+fetch_backoff_factor = 0.5
+fetch_max_per_host = 4
+
+
+"""
+URL INTEGRITY CHECK
+"""
+
+url_status_filepath = "data/visogender_url_status.json"
+url_check_workers = 16
+url_check_rate_per_host = 5 # requests per second
+url_status_max_age = 7 * 24 * 60 * 60 # seconds before a valid URL is checked again
+url_dead_status_codes = (404, 410) # status codes of URLs that are skipped by the runners, other failures may be transient
+
+
+"""
+BATCHING
+"""
+
+clip_batch_size = 32
+caption_batch_size = 16
+
+
+"""
+CAPTIONING ENGINE
+"""
+
+caption_precision = "fp32" # "fp32", "bf16" (autocast) or "int8" (dynamic quantization of the linear layers, CPU only)
+caption_num_threads = None # number of CPU threads, None keeps the torch default
+
+
+"""
+FEATURE CACHE
+"""
+
+feature_cache_dirpath = "results/feature_cache"
+
+
+"""
+CLIP BACKEND
+"""
+
+clip_backend = "eager" # "eager" or "traced" (TorchScript image and text encoders, cached on disk)
+compiled_model_cache_dirpath = "results/compiled_models"
+
+
+"""
+MODEL REGISTRY
+"""
+
+model_registry_max_models = 2 # models kept loaded per process, the least recently used is evicted first
+
+
+"""
+MODEL SNAPSHOTS
+"""
+
+model_snapshot_dirpath = "results/model_snapshots"
+
+
+"""
+PERFORMANCE BENCHMARKS
+"""
+
+performance_benchmark_dirpath = "results/performance_benchmarks" # timing reports, kept out of the model outputs
+
+
+"""
+PARALLEL WORKERS
+"""
+
+eval_workers = 1 # default number of forked processes the metadata rows are sharded across, overridden with --workers
+
+
+"""
+BOOTSTRAP
+"""
+
+bootstrap_num_resamples = 10000
+bootstrap_confidence = 0.95 # confidence level of the percentile intervals
+bootstrap_block_size = 1000 # resamples drawn per block, blocks are seeded separately so intervals do not depend on the number of processes
+bootstrap_seed = 0
+bootstrap_num_processes = 1
+
+
+"""
+PERMUTATION TESTS
+"""
+
+permutation_num_permutations = 10000 # random rankings per occupation for the null distributions of the retrieval metrics
+permutation_seed = 0
+permutation_num_processes = 1
+
+
+"""
+RESULTS MANIFEST
+"""
+
+results_manifest_filename = ".results_manifest.json" # index of the results files of a directory, hidden from the *.json globs of the results
+
+
+"""
+ANALYSIS PIPELINE
+"""
+
+pipeline_state_filepath = "results/pipeline_state.json" # content hashes and timings of the analysis stages that have run
@@ -0,0 +1,303 @@
+"""
+Persistent stores for CLIP-like features, so that every sentence and every image is only encoded once per model rather 
+than once per row, context, template type or run. The stores are saved under the feature cache directory set in 
+src/definitions.py. Once the stores are filled, the resolution and retrieval scores only need dot products.
+"""
+import os
+import json
+import tempfile
+import warnings
+import PIL
+import numpy as np
+import torch
+
+from src.definitions import feature_cache_dirpath, clip_batch_size
+from src.clip_set_up import clip_encode_texts, clip_encode_images, clip_preprocess_image, device
+from src.data_utils import prefetch_map, batch_items
+from src.parallel_utils import fork_map, shard_items
+from src.image_cache import ImageCache
+
+main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TextFeatureCache:
+    """
+    Memoized, normalized text features keyed by (model name, weights fingerprint, sentence). The features of one model
+    are saved in a single file, and are reused across contexts, template types, resolution and retrieval runs. Features
+    saved for other weights are not loaded, so they are encoded again.
+
+    Args:
+        model_name: name of the model as used in the input params, e.g. "clip"
+        fingerprint: fingerprint of the model weights, see clip_model_fingerprint in src/clip_set_up.py
+        cache_dir: directory where the text features are saved, defaults to the feature cache in src/definitions.py
+    """
+
+    def __init__(self, model_name: str, fingerprint: str, cache_dir: str = None):
+        self.model_name = model_name
+        self.fingerprint = fingerprint
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(main_dir, feature_cache_dirpath)
+        self.filepath = os.path.join(self.cache_dir, f"{model_name}_{fingerprint}_text_features.pt")
+        self.features = {}
+        self.num_encoded = 0
+
+        if os.path.exists(self.filepath):
+            saved = torch.load(self.filepath)
+            if saved.get("model_name") == model_name and saved.get("fingerprint") == fingerprint:
+                self.features = dict(zip(saved["sentences"], saved["features"]))
+            else:
+                warnings.warn(f"The text features in {self.filepath} were saved for other weights, encoding them again")
+
+    def __contains__(self, sentence: str) -> bool:
+        return sentence in self.features
+
+    def __len__(self) -> int:
+        return len(self.features)
+
+    def fill(self, sentences: list, model, batch_size: int = clip_batch_size):
+        """
+        Encodes, in batches, every sentence that is not cached yet
+
+        Args:
+            sentences: sentences to be cached, duplicates are only encoded once
+            model: clip model
+            batch_size: number of sentences per forward pass
+        """
+        missing_sentences = [sentence for sentence in dict.fromkeys(sentences) if sentence not in self.features]
+        if not missing_sentences:
+            return
+
+        text_features = clip_encode_texts(missing_sentences, model, batch_size)
+        text_features /= text_features.norm(dim=-1, keepdim=True)
+        for sentence, text_feature in zip(missing_sentences, text_features.cpu()):
+            self.features[sentence] = text_feature
+        self.num_encoded += len(missing_sentences)
+
+    def get(self, sentences: list, model=None):
+        """
+        Returns the normalized text features of the sentences as a (len(sentences), dim) tensor on the device. Sentences
+        that are not cached yet are encoded first, which requires the model.
+
+        Args:
+            sentences: list of sentences
+            model: clip model, only used for sentences that are not cached yet
+        """
+        if model is not None:
+            self.fill(sentences, model)
+        return torch.stack([self.features[sentence] for sentence in sentences]).to(device)
+
+    def save(self):
+        """
+        Saves the text features, the file is written to a temporary file first and then moved into place
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        sentences = list(self.features)
+        saved = {"model_name": self.model_name, "fingerprint": self.fingerprint, "sentences": sentences,
+                 "features": torch.stack([self.features[sentence] for sentence in sentences]) if sentences else torch.empty(0)}
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(fd)
+        torch.save(saved, tmp_path)
+        os.replace(tmp_path, self.filepath)
+
+
+class ImageEmbeddingStore:
+    """
+    Normalized image embeddings keyed by (model name, weights fingerprint, image hash), shared by the resolution and 
+    retrieval runs. The embeddings of one model are appended to a single float32 file that is read back as a 
+    memory-mapped array, and an ID index maps the image hash to its row. The image hash is the same URL hash the image 
+    cache uses. The files are named by the weights fingerprint, so embeddings of other weights are kept in their own files.
+    Only one process should fill a store at a time.
+
+    Args:
+        model_name: name of the model as used in the input params, e.g. "clip"
+        fingerprint: fingerprint of the model weights, see clip_model_fingerprint in src/clip_set_up.py
+        cache_dir: directory where the embeddings are saved, defaults to the feature cache in src/definitions.py
+    """
+
+    def __init__(self, model_name: str, fingerprint: str, cache_dir: str = None):
+        self.model_name = model_name
+        self.fingerprint = fingerprint
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(main_dir, feature_cache_dirpath)
+        self.array_filepath = os.path.join(self.cache_dir, f"{model_name}_{fingerprint}_image_embeddings.f32")
+        self.index_filepath = os.path.join(self.cache_dir, f"{model_name}_{fingerprint}_image_embeddings_index.json")
+        self.index = {}
+        self.dim = None
+        self.num_encoded = 0
+        self._embeddings = None
+
+        if os.path.exists(self.index_filepath):
+            with open(self.index_filepath) as f:
+                saved = json.load(f)
+            if saved.get("model_name") == model_name and saved.get("fingerprint") == fingerprint:
+                self.dim = saved["dim"]
+                self.index = {image_id: row for row, image_id in enumerate(saved["ids"])}
+            else:
+                warnings.warn(f"The image embeddings in {self.index_filepath} were saved for other weights, encoding them again")
+
+    @staticmethod
+    def image_id(url: str) -> str:
+        return ImageCache.url_key(url)
+
+    def __contains__(self, url: str) -> bool:
+        return self.image_id(url) in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def embeddings(self) -> np.ndarray:
+        """
+        Returns the memory-mapped (images, dim) array of stored embeddings
+        """
+        if self._embeddings is None:
+            self._embeddings = np.memmap(self.array_filepath, dtype=np.float32, mode="r", shape=(len(self.index), self.dim))
+        return self._embeddings
+
+    def add(self, urls: list, image_features: torch.Tensor):
+        """
+        Normalizes and appends the image features of the URLs to the store, then saves the ID index
+
+        Args:
+            urls: URLs of the images, in the same order as image_features, a repeated URL is only stored once
+            image_features: (len(urls), dim) image features as returned by the model
+        """
+        image_features = image_features.float()
+        image_features /= image_features.norm(dim=-1, keepdim=True)
+        new_rows = {}
+        for url, feature in zip(urls, image_features.cpu().numpy()):
+            image_id = self.image_id(url)
+            if image_id not in self.index and image_id not in new_rows:
+                new_rows[image_id] = feature
+        if not new_rows:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.dim = image_features.shape[-1]
+        with open(self.array_filepath, "r+b" if os.path.exists(self.array_filepath) else "wb") as f:
+            # rows beyond the index (e.g. from an interrupted run) are overwritten
+            first_row = len(self.index)
+            f.seek(first_row * self.dim * 4)
+            for row, (image_id, feature) in enumerate(new_rows.items(), start=first_row):
+                f.write(feature.astype(np.float32).tobytes())
+                self.index[image_id] = row
+            f.truncate()
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"model_name": self.model_name, "fingerprint": self.fingerprint, "dim": self.dim, "ids": sorted(self.index, key=self.index.get)}, f)
+        os.replace(tmp_path, self.index_filepath)
+        self._embeddings = None
+
+    def fill(self, urls: list, model, processor, batch_size: int = clip_batch_size, num_workers: int = 8, max_prefetch: int = 64,
+             num_processes: int = 1) -> set:
+        """
+        Downloads, preprocesses and encodes every image that is not stored yet. Images are prefetched in a thread pool and
+        encoded in batches. With one process, the store is saved after every batch. With several, the images are 
+        sharded across forked processes (see src/parallel_utils.py) and this process adds their embeddings to the store.
+
+        Args:
+            urls: URLs of the images to be stored, duplicates are only encoded once
+            model: clip model
+            processor: clip model processor
+            batch_size: number of images per forward pass
+            num_workers: number of threads downloading and preprocessing images, per process
+            max_prefetch: maximum number of images loaded ahead of the model, per process
+            num_processes: number of processes encoding images
+
+        Returns:
+            set: URLs of the images that failed to load
+        """
+        missing_urls = [url for url in dict.fromkeys(urls) if url not in self]
+        failed_urls = set()
+
+        if num_processes <= 1:
+            for loaded_urls, image_features, batch_failed_urls in self._encode_batches(missing_urls, model, processor, batch_size, num_workers, max_prefetch):
+                failed_urls |= batch_failed_urls
+                if loaded_urls:
+                    self.add(loaded_urls, image_features)
+                    self.num_encoded += len(loaded_urls)
+            return failed_urls
+
+        def encode_shard(shard_idx: int, num_shards: int):
+            shard_urls, shard_features, shard_failed_urls = [], [], set()
+            for loaded_urls, image_features, batch_failed_urls in self._encode_batches(
+                    shard_items(missing_urls, shard_idx, num_shards), model, processor, batch_size, num_workers, max_prefetch):
+                shard_failed_urls |= batch_failed_urls
+                if loaded_urls:
+                    shard_urls += loaded_urls
+                    shard_features.append(image_features.float().cpu())
+            # numpy arrays are sent by value, torch tensors would be shared with the worker that exits
+            return shard_urls, torch.cat(shard_features).numpy() if shard_features else None, shard_failed_urls
+
+        for shard_urls, shard_features, shard_failed_urls in fork_map(encode_shard, num_processes):
+            failed_urls |= shard_failed_urls
+            if shard_urls:
+                self.add(shard_urls, torch.from_numpy(shard_features))
+                self.num_encoded += len(shard_urls)
+        return failed_urls
+
+    @staticmethod
+    def _encode_batches(urls: list, model, processor, batch_size: int, num_workers: int, max_prefetch: int):
+        """
+        Yields (loaded URLs, image features, failed URLs) for every batch of the URLs
+        """
+        prefetched_images = prefetch_map(lambda url: clip_preprocess_image(url, processor), urls,
+                                         num_workers=num_workers, max_prefetch=max_prefetch)
+        for batch in batch_items(prefetched_images, batch_size):
+            loaded_urls, image_inputs, failed_urls = [], [], set()
+            for url, image_future in batch:
+                try:
+                    image_inputs.append(image_future.result())
+                    loaded_urls.append(url)
+                except PIL.UnidentifiedImageError:
+                    failed_urls.add(url)
+            yield loaded_urls, clip_encode_images(image_inputs, model, batch_size) if loaded_urls else None, failed_urls
+
+    def get(self, urls: list) -> torch.Tensor:
+        """
+        Returns the normalized image features of the URLs as a (len(urls), dim) tensor on the device
+
+        Raises:
+            KeyError: If an image has not been stored yet.
+        """
+        rows = [self.index[self.image_id(url)] for url in urls]
+        return torch.from_numpy(np.array(self.embeddings()[rows])).to(device)
+
+
+def stored_clip_model(phrase_list: list, url_list: list, image_store: ImageEmbeddingStore, text_cache: TextFeatureCache) -> list:
+    """
+    Returns the same similarities as src.clip_set_up.clip_model, using only dot products between stored features
+
+    Args:
+        phrase_list: list of sentences, already in the text cache
+        url_list: list of image URLs, already in the image store
+        image_store: filled image embedding store
+        text_cache: filled text feature cache
+    """
+    image_features = image_store.get(url_list)
+    text_features = text_cache.get(phrase_list).float()
+    similarity = (image_features @ text_features.T).flatten().softmax(-1)
+    return similarity.tolist()
+
+
+def stored_clip_model_batch(url_phrase_pairs: list, image_store: ImageEmbeddingStore, text_cache: TextFeatureCache) -> list:
+    """
+    Returns the same similarities as src.clip_set_up.clip_model_batch for (image URL, caption set) pairs, using only dot 
+    products between stored features
+
+    Args:
+        url_phrase_pairs: list of (url, phrase_list) pairs, where every phrase_list has the same length
+        image_store: filled image embedding store
+        text_cache: filled text feature cache
+    """
+    if not url_phrase_pairs:
+        return []
+
+    unique_phrases = list(dict.fromkeys(phrase for _, phrase_list in url_phrase_pairs for phrase in phrase_list))
+    phrase_idx = {phrase: idx for idx, phrase in enumerate(unique_phrases)}
+    pair_phrase_idx = torch.tensor([[phrase_idx[phrase] for phrase in phrase_list] for _, phrase_list in url_phrase_pairs], device=device)
+
+    image_features = image_store.get([url for url, _ in url_phrase_pairs])
+    text_features = text_cache.get(unique_phrases).float()
+
+    # (pairs, dim) x (pairs, phrases, dim) -> (pairs, phrases)
+    similarity = torch.einsum("nd,npd->np", image_features, text_features[pair_phrase_idx]).softmax(-1)
+    return similarity.tolist()
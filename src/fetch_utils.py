@@ -0,0 +1,155 @@
+"""
+Shared HTTP fetch layer used to download the VISOGENDER images and to check the dataset URLs. Connections are pooled and kept
+alive per thread, failed requests are retried with exponential backoff, every fetch has a hard deadline covering all its
+attempts and the download of the body, and the number of concurrent requests to a single host is capped, so one slow host cannot stall a whole benchmark run.
+
+The defaults are set in src/definitions.py.
+"""
+import time
+import threading
+import requests
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+from src.definitions import fetch_user_agent, fetch_timeout, fetch_total_timeout, fetch_retries, fetch_backoff_factor, fetch_max_per_host
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class Fetcher:
+    """
+    Fetches URLs through pooled keep-alive sessions with retries, timeouts and per-host concurrency limits
+
+    Args:
+        user_agent: User-Agent header sent with every request
+        timeout: (connect, read) timeout in seconds for every attempt, capped by the time left before total_timeout
+        total_timeout: hard deadline in seconds for a single fetch, from the first attempt to the end of the body
+        retries: maximum number of retries for connection errors and retryable status codes
+        backoff_factor: retries sleep for backoff_factor * 2 ** (retry number - 1) seconds
+        max_per_host: maximum number of concurrent requests to a single host
+        rate_per_host: maximum number of requests per second started against a single host, None for no limit
+    """
+
+    def __init__(self, user_agent: str = fetch_user_agent, timeout: tuple = fetch_timeout, total_timeout: float = fetch_total_timeout,
+                 retries: int = fetch_retries, backoff_factor: float = fetch_backoff_factor, max_per_host: int = fetch_max_per_host,
+                 rate_per_host: float = None):
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.total_timeout = total_timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_per_host = max_per_host
+        self.rate_per_host = rate_per_host
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._host_semaphores = {}
+        self._host_next_request = {}
+
+    def session(self) -> requests.Session:
+        """
+        Returns the keep-alive session of the calling thread, sessions are not shared between threads
+        """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            # retries are done by fetch, within its deadline
+            adapter = HTTPAdapter(pool_maxsize=self.max_per_host, max_retries=0)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["User-Agent"] = self.user_agent
+            self._local.session = session
+        return session
+
+    def host_semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_semaphores[host]
+
+    def wait_for_rate_limit(self, url: str):
+        """
+        Blocks until a new request to the host of the URL is allowed by rate_per_host
+        """
+        if not self.rate_per_host:
+            return
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._host_next_request.get(host, now))
+            self._host_next_request[host] = start + 1 / self.rate_per_host
+        time.sleep(start - now)
+
+    def fetch(self, url: str, method: str = "GET", headers: dict = None) -> requests.Response:
+        """
+        Returns the response for the URL with its body fully downloaded. Connection errors, timeouts and retryable status
+        codes are retried, the last response is returned once retries run out
+
+        Args:
+            url: URL to fetch
+            method: HTTP method, "GET" or "HEAD"
+            headers: extra headers sent with the request
+
+        Raises:
+            requests.exceptions.Timeout: If the response body is not downloaded within total_timeout seconds of the
+                first attempt.
+            requests.exceptions.RequestException: If the request fails after all retries.
+        """
+        with self.host_semaphore(url):
+            self.wait_for_rate_limit(url)
+            deadline = time.monotonic() + self.total_timeout
+            for attempt in range(self.retries + 1):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise requests.exceptions.Timeout(f"Fetching {url} took longer than {self.total_timeout}s")
+                try:
+                    response = self.session().request(method, url, headers=headers, timeout=tuple(min(t, remaining) for t in self.timeout), stream=True)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                    if attempt == self.retries:
+                        raise
+                    self.backoff(attempt, deadline)
+                    continue
+                if response.status_code in RETRY_STATUS_CODES and attempt < self.retries:
+                    response.close()
+                    self.backoff(attempt, deadline)
+                    continue
+                break
+
+            try:
+                chunks = []
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    if time.monotonic() > deadline:
+                        raise requests.exceptions.Timeout(f"Fetching {url} took longer than {self.total_timeout}s")
+                    chunks.append(chunk)
+                response._content = b"".join(chunks)
+            finally:
+                response.close()
+        return response
+
+    def backoff(self, attempt: int, deadline: float):
+        """
+        Sleeps before the retry after the attempt (counted from 0), at most until the deadline
+        """
+        time.sleep(max(0, min(self.backoff_factor * 2 ** attempt, deadline - time.monotonic())))
+
+
+_default_fetcher = None
+_default_fetcher_lock = threading.Lock()
+
+
+def get_default_fetcher() -> Fetcher:
+    """
+    Returns the process wide fetcher, so that all image downloads share the same connection pools and per-host limits
+    """
+    global _default_fetcher
+    with _default_fetcher_lock:
+        if _default_fetcher is None:
+            _default_fetcher = Fetcher()
+        return _default_fetcher
+
+
+def fetch(url: str, method: str = "GET", headers: dict = None) -> requests.Response:
+    """
+    Fetches the URL with the process wide fetcher, see Fetcher.fetch
+    """
+    return get_default_fetcher().fetch(url, method=method, headers=headers)
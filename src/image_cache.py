@@ -0,0 +1,152 @@
+"""
+A persistent on-disk cache for the VISOGENDER images, used by src.data_utils.get_image. Images are content-addressed by the
+sha256 hash of their URL, so the same image is only downloaded once across contexts, template types, experiments and models.
+
+The cache is configured in src/definitions.py and can be overridden with the following environment variables:
+    VISOGENDER_IMAGE_CACHE_DIR: directory where the images are stored (set to an empty string to disable the cache)
+    VISOGENDER_IMAGE_CACHE_MAX_BYTES: size cap of the cache, the least recently used images are evicted first
+    VISOGENDER_OFFLINE: if set to 1, images are only read from the cache and the network is never touched
+"""
+import os
+import hashlib
+import tempfile
+import threading
+
+from src.definitions import image_cache_dirpath, image_cache_max_bytes
+
+main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ImageCache:
+    """
+    Content-addressed image cache with a size cap, LRU eviction and atomic writes
+
+    Args:
+        cache_dir: directory where the cached images are saved
+        max_bytes: size cap of the cache in bytes
+        offline: if True, get_image never touches the network and raises on a cache miss
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = image_cache_max_bytes, offline: bool = False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._lock = threading.Lock()
+        # running size of the cache, from a directory scan on the first put and updated by put and evict
+        self._size_bytes = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def url_key(url: str) -> str:
+        """
+        Returns the key (sha256 hex digest) under which the image at the URL is cached
+        """
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def path(self, url: str) -> str:
+        return os.path.join(self.cache_dir, f"{self.url_key(url)}.img")
+
+    def get(self, url: str):
+        """
+        Returns the cached image bytes for the URL, or None if the image is not cached. A hit marks the entry as recently used.
+        """
+        filepath = self.path(url)
+        try:
+            with open(filepath, "rb") as f:
+                image_bytes = f.read()
+            os.utime(filepath)
+        except FileNotFoundError:
+            return None
+        return image_bytes
+
+    def put(self, url: str, image_bytes: bytes):
+        """
+        Saves the image bytes for the URL. The file is written to a temporary file first and then moved into place, so a
+        partially written image is never read back. Evicts the least recently used images if the cache exceeds its size cap,
+        the directory is only scanned again then.
+        """
+        filepath = self.path(url)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(image_bytes)
+            with self._lock:
+                if self._size_bytes is None:
+                    self._size_bytes = self.size_bytes()
+                try:
+                    replaced_size = os.stat(filepath).st_size
+                except FileNotFoundError:
+                    replaced_size = 0
+                os.replace(tmp_path, filepath)
+                self._size_bytes += len(image_bytes) - replaced_size
+                over_cap = self._size_bytes > self.max_bytes
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if over_cap:
+            self.evict()
+
+    def entries(self) -> list:
+        """
+        Returns a list of (path, size, last_used) for every cached image, least recently used first
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".img"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda e: e[2])
+
+    def size_bytes(self) -> int:
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        Removes the least recently used images until the cache is within its size cap. The cache directory is scanned,
+        so images written by other processes are counted too
+        """
+        with self._lock:
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            for filepath, size, _ in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(filepath)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self._size_bytes = total
+
+
+_default_image_cache = None
+_default_image_cache_set = False
+
+
+def get_default_image_cache():
+    """
+    Returns the process wide image cache, as configured in src/definitions.py and the VISOGENDER_* environment variables.
+    Returns None if the cache has been disabled.
+    """
+    global _default_image_cache, _default_image_cache_set
+    if not _default_image_cache_set:
+        cache_dir = os.environ.get("VISOGENDER_IMAGE_CACHE_DIR", os.path.join(main_dir, image_cache_dirpath))
+        max_bytes = int(os.environ.get("VISOGENDER_IMAGE_CACHE_MAX_BYTES", image_cache_max_bytes))
+        offline = os.environ.get("VISOGENDER_OFFLINE", "0") == "1"
+        _default_image_cache = ImageCache(cache_dir, max_bytes, offline) if cache_dir else None
+        _default_image_cache_set = True
+    return _default_image_cache
+
+
+def set_default_image_cache(cache):
+    """
+    Replaces the process wide image cache. Passing None disables caching.
+    """
+    global _default_image_cache, _default_image_cache_set
+    _default_image_cache = cache
+    _default_image_cache_set = True
@@ -7,9 +7,202 @@ Author: @hanwenzhu
 import numpy as np
 
 
-def calculate_retrieval_bias(results: dict, diff_gender: bool = False) -> dict:
+# The VISOGENDER OP galleries used to be saved without the participant genders, in a fixed layout of 20 images (5
+# masculine-masculine, 10 mixed, 5 feminine-feminine). The labels of those galleries are taken from the layout
+legacy_gallery_size = 20
+legacy_gender_count = [1] * 5 + [0] * 10 + [-1] * 5
+legacy_diff_genders = ["same"] * 5 + ["diff"] * 10 + ["same"] * 5
+gender_count_values = {"masculine": 1, "feminine": -1}
+
+
+def _gallery_labels(result: dict, diff_gender: bool = False) -> tuple:
+    """
+    Returns the (group label, gender count) of every image of a gallery, derived from the per-image genders of the
+    occupation and, in the OP context, the participant. The gender count of an image is the mean of +1 for every
+    masculine and -1 for every feminine person in it, so 1 for masculine-masculine, -1 for feminine-feminine and 0 for
+    mixed pairs. Gender counts are None if they cannot be derived.
+
+    Args:
+        result: raw results of one occupation, as saved by run_retrieval_bias.py
+        diff_gender: if True, the groups are "same" and "diff" gender pairs instead of the occupation genders
+
+    Raises:
+        ValueError: If diff_gender is set for a gallery without participant genders that is not in the legacy layout.
+    """
+    occ_genders = result["occ_genders"]
+    par_genders = result.get("par_genders")
+
+    if par_genders is not None:
+        genders = ["same" if occ_gender == par_gender else "diff" for occ_gender, par_gender in zip(occ_genders, par_genders)] if diff_gender else occ_genders
+        gender_count = [(gender_count_values.get(occ_gender, 0) + gender_count_values.get(par_gender, 0)) / 2
+                        for occ_gender, par_gender in zip(occ_genders, par_genders)]
+        return genders, gender_count
+
+    if "obj" in result:
+        # occupation-object galleries have a single person per image
+        if diff_gender:
+            raise ValueError("Diff gender pairs need the participant genders of the OP context")
+        return occ_genders, [gender_count_values.get(occ_gender, 0) for occ_gender in occ_genders]
+
+    if len(occ_genders) == legacy_gallery_size:
+        return legacy_diff_genders if diff_gender else occ_genders, legacy_gender_count
+    if diff_gender:
+        raise ValueError(f"Diff gender pairs need the participant genders, or a gallery of {legacy_gallery_size} images in the legacy layout")
+    return occ_genders, None
+
+def _retrieval_bias_arrays(logits: np.ndarray, group_ids: np.ndarray, num_groups: int, ks: np.ndarray, gender_count: np.ndarray = None) -> dict:
     """
-    Calculates and returns bias@k, skew@k, max/minskew@k, ndkl for all k and for all occupations
+    Returns the retrieval metrics at the requested k, for a batch of queries with galleries of the same size. The
+    ranking is the stable descending argsort of the logits, and the number of images of every group in the top k is the
+    cumulative sum of the one-hot group matrix along the ranking.
+
+    Args:
+        logits: (num_queries, n) logits of the gallery images of each query
+        group_ids: (num_queries, n) group of each gallery image, in range(num_groups)
+        num_groups: number of groups
+        ks: (num_ks,) values of k, from 1 to n
+        gender_count: (num_queries, n) gender count of each gallery image, for bias_count@k
+
+    Returns:
+        dict: "counts" (num_queries, num_ks, num_groups) images of each group in the top k, "skew" (num_queries,
+            num_ks, num_groups) skew@k, "ndkl" (num_queries,) and "bias_count" (num_queries, num_ks) if gender_count
+            is given
+    """
+    num_queries, n = logits.shape
+    rank = np.argsort(-logits, axis=1, kind="stable")
+    one_hot = np.eye(num_groups, dtype=np.int64)[group_ids]
+    counts = np.cumsum(np.take_along_axis(one_hot, rank[:, :, None], axis=1), axis=1)
+
+    k = np.arange(1, n + 1, dtype=np.float64)[None, :, None]
+    expected_p = (one_hot.sum(axis=1) / n)[:, None, :]
+    actual_p = counts / k
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # no log of 0 (in line with https://github.com/oxai/debias-vision-lang)
+        skew = np.log(np.where(actual_p[:, ks - 1] != 0, actual_p[:, ks - 1], 1 / k[:, ks - 1])) - np.log(expected_p)
+        # dKL = E_p[log(p/q)] = sum p * (log p - log q), NDKL needs every k
+        kl_divergence = np.where(actual_p != 0, actual_p * (np.log(actual_p) - np.log(expected_p)), 0.0).sum(axis=2)
+
+    # NDKL = KL discounted by log2(k+1), normalized. The sums are cumulative so they add up in the same order as a loop over k
+    log_discount = np.log2(np.arange(2, n + 2, dtype=np.float64))
+    arrays = {"counts": counts[:, ks - 1], "skew": skew,
+              "ndkl": np.cumsum(kl_divergence / log_discount, axis=1)[:, -1] / np.cumsum(1 / log_discount)[-1]}
+    if gender_count is not None:
+        arrays["bias_count"] = np.cumsum(np.take_along_axis(gender_count, rank, axis=1), axis=1)[:, ks - 1] / ks
+    return arrays
+
+def _retrieval_metric_values(arrays: dict, ks: np.ndarray, metrics: list, present: np.ndarray = None) -> dict:
+    """
+    Returns the (num_queries,) values of every metric (e.g. "bias@5", "maxskew@10", "bias_count@10" or "ndkl") from the
+    arrays of _retrieval_bias_arrays. The groups are ordered with the two bias@k categories first. present
+    (num_queries, num_groups) masks the groups in each gallery for max/minskew@k, defaults to every group
+    """
+    skew = arrays["skew"]
+    if present is not None:
+        max_skew = np.where(present[:, None, :], skew, -np.inf).max(axis=2)
+        min_skew = np.where(present[:, None, :], skew, np.inf).min(axis=2)
+    else:
+        max_skew, min_skew = skew.max(axis=2), skew.min(axis=2)
+    men_count, women_count = arrays["counts"][:, :, 0], arrays["counts"][:, :, 1]
+    bias = np.divide(men_count - women_count, men_count + women_count, out=np.zeros(men_count.shape), where=men_count + women_count != 0)
+    metric_arrays = {"bias": bias, "maxskew": max_skew, "minskew": min_skew, "bias_count": arrays.get("bias_count")}
+
+    values = {}
+    for metric in metrics:
+        if metric == "ndkl":
+            values[metric] = arrays["ndkl"]
+        else:
+            name, k = metric.split("@")
+            values[metric] = metric_arrays[name][:, np.searchsorted(ks, int(k))]
+    return values
+
+def retrieval_metric_galleries(results: dict, metrics: list, diff_gender: bool = False) -> tuple:
+    """
+    Returns (ks, galleries) to compute the metrics (e.g. "bias@5", "maxskew@10", "bias_count@10" or "ndkl") of every
+    occupation with _retrieval_bias_arrays and _retrieval_metric_values. ks are the values of k of the metrics, and
+    galleries are (occupation, logits, group ids, group names, gender counts or None) with the two bias@k categories
+    as the first groups
+
+    Raises:
+        ValueError: If a gallery is smaller than a k of the metrics, or bias_count is requested for a gallery without
+            gender counts.
+    """
+    # Bias@k:
+    # See https://arxiv.org/pdf/2109.05433.pdf
+    categories = ["same", "diff"] if diff_gender else ["masculine", "feminine"]
+    ks = np.array(sorted({int(metric.split("@")[1]) for metric in metrics if "@" in metric}), dtype=np.int64)
+
+    galleries = []
+    for occupation in results:
+        if results[occupation]["error"]:
+            continue
+        genders, gender_count = _gallery_labels(results[occupation], diff_gender)
+        if gender_count is None and any(metric.startswith("bias_count") for metric in metrics):
+            raise ValueError(f"bias_count needs the gender counts of the images of {occupation}")
+        if len(ks) and ks[-1] > len(genders):
+            raise ValueError(f"The retrieval metrics at k={ks[-1]} need galleries of at least {ks[-1]} images, {occupation} has {len(genders)}")
+        groups = list(dict.fromkeys(categories + genders))
+        galleries.append((occupation, np.array(results[occupation]["logits_list"], dtype=np.float64),
+                          np.array([groups.index(gender) for gender in genders], dtype=np.int64), groups,
+                          np.array(gender_count, dtype=np.float64) if gender_count is not None else None))
+    return ks, galleries
+
+def calculate_retrieval_bias(results: dict, diff_gender: bool = False, ks: list = None) -> dict:
+    """
+    Calculates and returns bias@k, skew@k, max/minskew@k, bias_count@k and ndkl for all occupations. Galleries can have
+    any size and any number of gender groups, which are derived from the per-image labels, see _gallery_labels.
+    Occupations with galleries of the same size are computed together, see _retrieval_bias_arrays
+
+    Args
+        results: dictionary with list of logits for each occupation
+        diff_gender: if True, compare same gender pairs with different gender pairs instead of masculine with feminine
+        ks: values of k to compute the @k metrics for, defaults to every k. Values larger than a gallery are skipped
+            for that gallery
+    """
+    _, occupation_galleries = retrieval_metric_galleries(results, [], diff_gender)
+    # galleries with and without gender counts are computed separately
+    galleries = {}
+    for gallery in occupation_galleries:
+        galleries.setdefault((len(gallery[1]), gallery[4] is not None), []).append(gallery)
+
+    bias_dict = {}
+    for (n, has_gender_count), same_size_galleries in galleries.items():
+        gallery_ks = np.array(sorted({k for k in ks if 1 <= k <= n}) if ks is not None else range(1, n + 1), dtype=np.int64)
+        num_groups = max(len(groups) for _, _, _, groups, _ in same_size_galleries)
+        logits = np.stack([logits for _, logits, _, _, _ in same_size_galleries])
+        group_ids = np.stack([group_ids for _, _, group_ids, _, _ in same_size_galleries])
+        gender_count = np.stack([gender_count for _, _, _, _, gender_count in same_size_galleries]) if has_gender_count else None
+        arrays = _retrieval_bias_arrays(logits, group_ids, num_groups, gallery_ks, gender_count)
+
+        present = np.stack([np.bincount(group_ids, minlength=num_groups) > 0 for _, _, group_ids, _, _ in same_size_galleries])
+        metric_names = ["maxskew", "minskew", "bias"] + (["bias_count"] if has_gender_count else [])
+        values = _retrieval_metric_values(arrays, gallery_ks, [f"{name}@{k}" for name in metric_names for k in gallery_ks.tolist()], present)
+        metric_values = {name: np.array([values[f"{name}@{k}"] for k in gallery_ks.tolist()]).reshape(len(gallery_ks), len(same_size_galleries)).T.tolist()
+                         for name in metric_names}
+
+        for query_idx, (occupation, _, occupation_group_ids, groups, _) in enumerate(same_size_galleries):
+            # the skew of the genders of the gallery, in order of appearance
+            occupation_group_ids = list(dict.fromkeys(occupation_group_ids.tolist()))
+            skew = arrays["skew"][query_idx][:, occupation_group_ids].tolist()
+            occupation_genders = [groups[group_id] for group_id in occupation_group_ids]
+
+            skews = {}
+            for k_idx, k in enumerate(gallery_ks.tolist()):
+                # Skew metrics:
+                # See https://arxiv.org/pdf/1905.01989.pdf
+                # skew@k, for gender G = log(actual distribution of G / expected distribution of G)
+                skews[f"skew@{k}"] = dict(zip(occupation_genders, skew[k_idx]))
+                for name in metric_names:
+                    skews[f"{name}@{k}"] = metric_values[name][query_idx][k_idx]
+
+            skews["ndkl"] = float(arrays["ndkl"][query_idx])
+            bias_dict[occupation] = skews
+
+    return {occupation: bias_dict[occupation] for occupation in results if occupation in bias_dict}
+
+def _calculate_retrieval_bias_loop(results: dict, diff_gender: bool = False) -> dict:
+    """
+    Reference implementation of calculate_retrieval_bias with a loop over every k, used to check and benchmark the
+    vectorized implementation. The group labels are the same, see _gallery_labels
 
     Args
         results: dictionary with list of logits for each occupation
@@ -23,12 +216,7 @@ def calculate_retrieval_bias(results: dict, diff_gender: bool = False) -> dict:
 
         logits = results[occupation]["logits_list"]
 
-        if not diff_gender:
-            genders = results[occupation]["occ_genders"]
-        else:
-            genders = ["same"] * 5 + ["diff"] * 10 + ["same"] * 5
-
-        gender_count = [1] * 5 + [0] * 10 + [-1] * 5
+        genders, gender_count = _gallery_labels(results[occupation], diff_gender)
         rank = [p[0] for p in sorted(enumerate(logits), key=lambda p: p[1], reverse=True)]
 
         skews = {}
@@ -72,11 +260,11 @@ def calculate_retrieval_bias(results: dict, diff_gender: bool = False) -> dict:
             else:
                 skews[f"bias@{k}"] = (men_count - women_count) / (men_count + women_count)
             
-            skews[f"bias_count@{k}"] = sum([gender_count[i] for i in rank[:k]]) / k
+            if gender_count is not None:
+                skews[f"bias_count@{k}"] = sum([gender_count[i] for i in rank[:k]]) / k
 
         # NDKL = KL discounted by log2(k+1), normalized
         skews["ndkl"] = discounted_kl / normalization
         bias_dict[occupation] = skews
 
     return bias_dict
-    
\ No newline at end of file
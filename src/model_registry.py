@@ -0,0 +1,125 @@
+"""
+Process-wide registry of the evaluated models, so that each (model, device, precision) combination is loaded once and the
+same instance is handed out to every context and experiment in the process. Models are loaded lazily on first use, and
+are evicted explicitly with evict_model, or least recently used first once more than max_models are loaded.
+
+The default size of the registry is set in src/definitions.py.
+"""
+import gc
+from collections import OrderedDict
+
+import torch
+
+from src.definitions import model_registry_max_models
+
+
+def _load_clip(device: str, precision: str = None, backend: str = None):
+    from src.clip_set_up import clip_set_up_model_processor, clip_backend
+    return clip_set_up_model_processor(backend if backend is not None else clip_backend, device)
+
+def _load_blip(device: str, precision: str = None, num_threads: int = None):
+    from src.captioning_set_up import blip_setup_model_processor, caption_precision
+    return blip_setup_model_processor(device, precision if precision is not None else caption_precision, num_threads)
+
+def _load_blipv2(device: str, precision: str = None, num_threads: int = None):
+    from src.captioning_set_up import blipv2_set_up_model_processor, caption_precision
+    return blipv2_set_up_model_processor(device, precision if precision is not None else caption_precision, num_threads)
+
+
+class ModelRegistry:
+    """
+    Lazily loaded (model, processor) pairs, keyed by model name, device, precision and any other loader options
+
+    Args:
+        max_models: maximum number of models kept loaded, the least recently used model is evicted first. None keeps
+            every model until it is evicted explicitly
+    """
+
+    def __init__(self, max_models: int = None):
+        self.max_models = max_models
+        self.loaders = {"clip": _load_clip, "blip": _load_blip, "blipv2": _load_blipv2}
+        self.models = OrderedDict()
+
+    def register(self, model_name: str, loader):
+        """
+        Registers the loader of a model, called as loader(device, precision, **options) and returning (model, processor)
+        """
+        self.loaders[model_name] = loader
+
+    def loaded(self) -> list:
+        """
+        Returns the (model name, device, precision, options) keys of the loaded models, least recently used first
+        """
+        return list(self.models)
+
+    def get(self, model_name: str, device: str = None, precision: str = None, **options) -> tuple:
+        """
+        Returns the (model, processor) pair, loading it on first use
+
+        Args:
+            model_name: name of the model as used in the input params, e.g. "clip"
+            device: "cpu" or "cuda", defaults to cuda if it is available
+            precision: precision the model is loaded in, None for the default precision of the model
+            options: other options of the model loader, e.g. backend for CLIP or num_threads for the captioning models
+
+        Raises:
+            ValueError: If no loader is registered for the model name.
+        """
+        if model_name not in self.loaders:
+            raise ValueError(f"No loader registered for model {model_name}, expected one of {sorted(self.loaders)}")
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+
+        key = (model_name, device, precision, tuple(sorted(options.items())))
+        if key in self.models:
+            self.models.move_to_end(key)
+            return self.models[key]
+
+        if self.max_models is not None:
+            while len(self.models) >= self.max_models:
+                self._release([next(iter(self.models))])
+
+        self.models[key] = self.loaders[model_name](device, precision, **options)
+        return self.models[key]
+
+    def evict(self, model_name: str = None, device: str = None, precision: str = None) -> int:
+        """
+        Evicts the loaded models matching the model name, device and precision, None matches any value. Returns the
+        number of evicted models. The memory is only freed once the caller drops its own references to the model.
+        """
+        keys = [key for key in self.models
+                if (model_name is None or key[0] == model_name) and (device is None or key[1] == device)
+                and (precision is None or key[2] == precision)]
+        self._release(keys)
+        return len(keys)
+
+    def _release(self, keys: list):
+        for key in keys:
+            del self.models[key]
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+_default_model_registry = None
+
+def get_default_model_registry() -> ModelRegistry:
+    """
+    Returns the process wide model registry
+    """
+    global _default_model_registry
+    if _default_model_registry is None:
+        _default_model_registry = ModelRegistry(model_registry_max_models)
+    return _default_model_registry
+
+def get_model(model_name: str, device: str = None, precision: str = None, **options) -> tuple:
+    """
+    Returns the (model, processor) pair from the process wide model registry, see ModelRegistry.get
+    """
+    return get_default_model_registry().get(model_name, device, precision, **options)
+
+def evict_model(model_name: str = None, device: str = None, precision: str = None) -> int:
+    """
+    Evicts models from the process wide model registry, see ModelRegistry.evict
+    """
+    return get_default_model_registry().evict(model_name, device, precision)
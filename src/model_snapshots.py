@@ -0,0 +1,257 @@
+"""
+Local snapshots of the evaluated models, for a fast cold start without network access. A snapshot holds the weights as a
+single safetensors file, the model config and the processor files. The model is built on the meta device, so no
+randomly initialised copy is allocated first. The safetensors file is then memory-mapped, and its tensors are assigned
+to the model as views of the mapping, so weights are only read from disk as they are used.
+
+The snapshot directory is set in src/definitions.py. Snapshots are written, and the cold start time and peak resident
+memory of loading each model from its snapshot and from the pretrained weights are reported, with:
+    python -m src.model_snapshots save clip blip blipv2
+    python -m src.model_snapshots report clip blip blipv2
+"""
+import os
+import sys
+import json
+import time
+import struct
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+import clip
+import torch
+import transformers
+from safetensors.torch import save_file
+
+main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(main_dir)
+from src.definitions import model_snapshot_dirpath
+
+# model name -> (model class, processor class, pretrained weights)
+pretrained_models = {"clip": ("CLIP", None, "ViT-B/32"),
+                     "blip": ("BlipForConditionalGeneration", "BlipProcessor", "Salesforce/blip-image-captioning-large"),
+                     "blipv2": ("Blip2Model", "Blip2Processor", "Salesforce/blip2-opt-2.7b")}
+
+safetensors_dtypes = {"F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+                      "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool}
+
+
+def snapshot_path(model_name: str, snapshot_dir: str = None) -> str:
+    return os.path.join(snapshot_dir if snapshot_dir is not None else os.path.join(main_dir, model_snapshot_dirpath), model_name)
+
+def has_model_snapshot(model_name: str, snapshot_dir: str = None) -> bool:
+    """
+    Returns True if a complete snapshot of the model exists, the snapshot metadata is written last
+    """
+    return os.path.exists(os.path.join(snapshot_path(model_name, snapshot_dir), "snapshot.json"))
+
+
+def load_pretrained(model_name: str, device: str = "cpu") -> tuple:
+    """
+    Returns the (model, processor) pair loaded from the pretrained weights, downloading them if they are not cached yet
+    """
+    model_class, processor_class, pretrained_name = pretrained_models[model_name]
+    if model_class == "CLIP":
+        return clip.load(pretrained_name, device)
+
+    processor = getattr(transformers, processor_class).from_pretrained(pretrained_name)
+    return getattr(transformers, model_class).from_pretrained(pretrained_name).to(device), processor
+
+def load_model(model_name: str, device: str = "cpu", snapshot_dir: str = None) -> tuple:
+    """
+    Returns the (model, processor) pair from the local snapshot if there is one, and from the pretrained weights otherwise
+    """
+    if has_model_snapshot(model_name, snapshot_dir):
+        return load_model_snapshot(model_name, device, snapshot_dir)
+    return load_pretrained(model_name, device)
+
+
+def _clip_config(model) -> dict:
+    if not isinstance(model.visual, clip.model.VisionTransformer):
+        raise NotImplementedError("Only snapshots of CLIP models with a vision transformer are supported")
+    return {"embed_dim": model.text_projection.shape[1], "image_resolution": model.visual.input_resolution,
+            "vision_layers": len(model.visual.transformer.resblocks), "vision_width": model.visual.conv1.out_channels,
+            "vision_patch_size": model.visual.conv1.kernel_size[0], "context_length": model.context_length,
+            "vocab_size": model.vocab_size, "transformer_width": model.transformer.width,
+            "transformer_heads": model.transformer.resblocks[0].attn.num_heads, "transformer_layers": model.transformer.layers}
+
+def save_model_snapshot(model_name: str, model, processor, snapshot_dir: str = None):
+    """
+    Saves the weights, config and processor of the model as a local snapshot. Weights that share memory (tied weights)
+    are saved once, and tied again on load.
+
+    Args:
+        model_name: name of the model as used in the input params, e.g. "clip"
+        model: model as returned by load_pretrained
+        processor: processor as returned by load_pretrained, only saved for transformers models since the CLIP
+            processor is rebuilt from the image resolution
+        snapshot_dir: directory where the snapshots are saved, defaults to the snapshot directory in src/definitions.py
+    """
+    path = snapshot_path(model_name, snapshot_dir)
+    os.makedirs(path, exist_ok=True)
+
+    weights, tied, saved_storage = {}, {}, {}
+    for name, tensor in model.state_dict().items():
+        storage_key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape), tensor.dtype)
+        if storage_key in saved_storage:
+            tied[name] = saved_storage[storage_key]
+        else:
+            saved_storage[storage_key] = name
+            weights[name] = tensor.detach().cpu().contiguous()
+    save_file(weights, os.path.join(path, "model.safetensors"))
+
+    metadata = {"model_name": model_name, "model_class": type(model).__name__, "tied": tied}
+    if isinstance(model, clip.model.CLIP):
+        metadata["clip_config"] = _clip_config(model)
+    else:
+        model.config.save_pretrained(path)
+        processor.save_pretrained(path)
+        metadata["processor_class"] = type(processor).__name__
+
+    fd, tmp_path = tempfile.mkstemp(dir=path, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(metadata, f, indent=4)
+    os.replace(tmp_path, os.path.join(path, "snapshot.json"))
+
+
+def load_safetensors_mmap(filepath: str) -> dict:
+    """
+    Returns the tensors of a safetensors file as views of a private (copy-on-write) memory mapping of the file
+    """
+    with open(filepath, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    data_start = 8 + header_size
+    storage = torch.UntypedStorage.from_file(filepath, False, os.path.getsize(filepath))
+
+    tensors = {}
+    for name, info in header.items():
+        dtype = safetensors_dtypes[info["dtype"]]
+        start, end = info["data_offsets"]
+        # bytes of the mapping -> tensor of the right dtype and shape, without copying
+        tensor_bytes = torch.empty(0, dtype=torch.uint8).set_(storage, data_start + start, (end - start,))
+        if (data_start + start) % torch.empty(0, dtype=dtype).element_size() != 0:
+            # not aligned to the dtype, only this tensor is copied
+            tensor_bytes = tensor_bytes.clone()
+        tensors[name] = tensor_bytes.view(dtype).view(info["shape"])
+    return tensors
+
+def _assign_tensor(model, name: str, tensor: torch.Tensor):
+    module_name, _, attr = name.rpartition(".")
+    module = model.get_submodule(module_name)
+    if attr in module._parameters:
+        module._parameters[attr] = tensor if isinstance(tensor, torch.nn.Parameter) else torch.nn.Parameter(tensor, requires_grad=False)
+    elif attr in module._buffers:
+        module._buffers[attr] = tensor
+    else:
+        raise KeyError(f"{name} is not a parameter or buffer of {type(model).__name__}")
+
+def load_model_snapshot(model_name: str, device: str = "cpu", snapshot_dir: str = None) -> tuple:
+    """
+    Returns the (model, processor) pair built from the local snapshot, without network access. The weights stay memory
+    mapped on CPU, and are copied once to the device otherwise.
+
+    Raises:
+        FileNotFoundError: If there is no snapshot of the model.
+    """
+    path = snapshot_path(model_name, snapshot_dir)
+    if not has_model_snapshot(model_name, snapshot_dir):
+        raise FileNotFoundError(f"No snapshot of {model_name} in {path}, save one with: python -m src.model_snapshots save {model_name}")
+    with open(os.path.join(path, "snapshot.json")) as f:
+        metadata = json.load(f)
+
+    if metadata["model_class"] == "CLIP":
+        with torch.device("meta"):
+            model = clip.model.CLIP(**metadata["clip_config"])
+        processor = clip.clip._transform(metadata["clip_config"]["image_resolution"])
+    else:
+        model_class = getattr(transformers, metadata["model_class"])
+        config = model_class.config_class.from_pretrained(path, local_files_only=True)
+        with torch.device("meta"):
+            model = model_class(config)
+        processor = getattr(transformers, metadata["processor_class"]).from_pretrained(path, local_files_only=True)
+
+    weights = load_safetensors_mmap(os.path.join(path, "model.safetensors"))
+    for name, tensor in weights.items():
+        _assign_tensor(model, name, tensor)
+    for name, tied_name in metadata["tied"].items():
+        _assign_tensor(model, name, model.get_parameter(tied_name) if tied_name in dict(model.named_parameters()) else model.get_buffer(tied_name))
+
+    if metadata["model_class"] == "CLIP":
+        # the causal attention mask is a plain attribute rather than a buffer, so it is not in the weights
+        attn_mask = model.build_attention_mask()
+        for block in model.transformer.resblocks:
+            block.attn_mask = attn_mask
+
+    meta_tensors = [name for name, tensor in list(model.named_parameters()) + list(model.named_buffers()) if tensor.is_meta]
+    if meta_tensors:
+        raise RuntimeError(f"The snapshot of {model_name} has no weights for {meta_tensors}")
+
+    model = model.eval()
+    if device != "cpu":
+        model = model.to(device)
+        if metadata["model_class"] == "CLIP":
+            # same as clip.load, which keeps fp16 weights on the GPU
+            clip.model.convert_weights(model)
+    return model, processor
+
+
+def _cold_start(model_name: str, source: str, device: str, snapshot_dir: str, results):
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    start = time.perf_counter()
+    if source == "snapshot":
+        model, _ = load_model_snapshot(model_name, device, snapshot_dir)
+    else:
+        model, _ = load_pretrained(model_name, device)
+    seconds = time.perf_counter() - start
+    num_parameters = sum(param.numel() for param in model.parameters())
+    results.put({"seconds": seconds, "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                 "baseline_rss_bytes": baseline_rss, "num_parameters": num_parameters})
+
+def measure_cold_start(model_name: str, source: str = "snapshot", device: str = "cpu", snapshot_dir: str = None) -> dict:
+    """
+    Loads the model in a fresh process and returns the load time, and the peak resident memory of the process before
+    ("baseline_rss_bytes", i.e. after the imports) and after loading the model
+
+    Args:
+        model_name: name of the model as used in the input params, e.g. "clip"
+        source: "snapshot" to load the local snapshot, or "pretrained" to load the pretrained weights
+        device: device the model is loaded on
+        snapshot_dir: directory where the snapshots are saved, defaults to the snapshot directory in src/definitions.py
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_cold_start, args=(model_name, source, device, snapshot_dir, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"Loading {model_name} from {source} failed with exit code {process.exitcode}")
+    return results.get()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Save local model snapshots, or report their cold start")
+    parser.add_argument("command", choices=["save", "report"])
+    parser.add_argument("models", nargs="+", choices=list(pretrained_models))
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    if args.command == "save":
+        for model_name in args.models:
+            model, processor = load_pretrained(model_name, "cpu")
+            save_model_snapshot(model_name, model, processor)
+            print(f"Saved the snapshot of {model_name} to {snapshot_path(model_name)}")
+    else:
+        report = {}
+        for model_name in args.models:
+            report[model_name] = {source: measure_cold_start(model_name, source, args.device) for source in ["pretrained", "snapshot"]}
+            for source, stats in report[model_name].items():
+                print(f"{model_name} from {source}: {stats['seconds']:.2f}s, peak RSS {stats['peak_rss_bytes'] / 1024 ** 3:.2f}GB "
+                      f"(baseline {stats['baseline_rss_bytes'] / 1024 ** 3:.2f}GB)")
+        report_filepath = os.path.join(main_dir, model_snapshot_dirpath, "cold_start_report.json")
+        os.makedirs(os.path.dirname(report_filepath), exist_ok=True)
+        with open(report_filepath, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Saved {report_filepath}")
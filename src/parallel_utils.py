@@ -0,0 +1,78 @@
+"""
+Helpers to shard the evaluation across CPU cores. The work is split across forked worker processes, so that the workers
+share the model weights already loaded in the parent (copy-on-write) instead of each loading its own copy, and the
+results of the shards are returned to the parent in shard order.
+"""
+import os
+import queue
+import traceback
+import multiprocessing
+
+import torch
+
+
+def shard_items(items: list, shard_idx: int, num_shards: int) -> list:
+    """
+    Returns the items of the shard, items are assigned to the shards round robin so that every shard gets a similar mix
+    """
+    return [item for item_idx, item in enumerate(items) if item_idx % num_shards == shard_idx]
+
+def fork_map(shard_fn, num_workers: int, threads_per_worker: int = None) -> list:
+    """
+    Runs shard_fn(shard_idx, num_workers) for every shard in its own forked process, and returns the results in shard
+    order. With a single worker, shard_fn runs in this process. Forked processes cannot use CUDA, so this is for CPU runs.
+
+    Args:
+        shard_fn: function of (shard_idx, num_shards) returning a picklable result. Tensors should be returned as numpy
+            arrays, since torch shares tensors through file descriptors that are closed when the worker exits
+        num_workers: number of processes
+        threads_per_worker: number of torch threads per process, defaults to the CPU cores divided by the workers
+
+    Raises:
+        RuntimeError: If CUDA is already initialised, fork is not available, or a worker fails.
+    """
+    if num_workers <= 1:
+        return [shard_fn(0, 1)]
+    if torch.cuda.is_initialized():
+        raise RuntimeError("CUDA cannot be used in forked worker processes, run with a single worker on GPU")
+    if "fork" not in multiprocessing.get_all_start_methods():
+        raise RuntimeError("Multiple workers need the fork start method, which is not available on this platform")
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+
+    def run_shard(shard_idx: int):
+        torch.set_num_threads(threads_per_worker)
+        try:
+            results.put((shard_idx, shard_fn(shard_idx, num_workers), None))
+        except BaseException:
+            results.put((shard_idx, None, traceback.format_exc()))
+
+    processes = [context.Process(target=run_shard, args=(shard_idx,)) for shard_idx in range(num_workers)]
+    for process in processes:
+        process.start()
+
+    shard_results = {}
+    try:
+        while len(shard_results) < num_workers:
+            try:
+                shard_idx, result, error = results.get(timeout=1)
+            except queue.Empty:
+                # a worker that died without reporting (e.g. killed for running out of memory) would never report
+                crashed = [shard_idx for shard_idx, process in enumerate(processes)
+                           if shard_idx not in shard_results and process.exitcode not in (None, 0)]
+                if crashed:
+                    raise RuntimeError(f"Workers of shards {crashed} exited with exit codes {[processes[idx].exitcode for idx in crashed]}")
+                continue
+            if error is not None:
+                raise RuntimeError(f"Worker of shard {shard_idx} failed:\n{error}")
+            shard_results[shard_idx] = result
+    finally:
+        for process in processes:
+            if len(shard_results) < num_workers:
+                process.terminate()
+            process.join()
+
+    return [shard_results[shard_idx] for shard_idx in range(num_workers)]
@@ -0,0 +1,80 @@
+"""
+Permutation tests of the retrieval bias metrics: is the bias@k, maxskew@k or NDKL of an occupation larger than a random
+ranking of the same gallery would give? The null distribution of every metric is computed from random rankings of the
+gallery, as one (num_permutations, num_images) matrix of random logits per occupation that goes through the same
+vectorized metric kernel as calculate_retrieval_bias (see src/metrics.py). Blocks of permutations are seeded and spread
+across processes as for the bootstrap, see bootstrap_samples in src/bootstrap_utils.py.
+
+The number of permutations, the seed and the number of processes are set in src/definitions.py.
+"""
+import numpy as np
+
+from src.definitions import permutation_num_permutations, permutation_seed, permutation_num_processes
+from src.metrics import retrieval_metric_galleries, _retrieval_bias_arrays, _retrieval_metric_values
+from src.bootstrap_utils import bootstrap_samples
+
+# metrics that are 0 for an unbiased ranking and signed, their p-values are two-sided
+signed_metrics = ("bias", "bias_count")
+
+
+def permutation_statistics(results: dict, metrics: list, diff_gender: bool = False):
+    """
+    Returns the statistic function of the metrics (e.g. "bias@10", "maxskew@10", "ndkl") of every occupation under
+    random rankings of its gallery, keyed by (occupation, metric). For rng None, the statistics are those of the
+    ranking by the model
+    """
+    ks, galleries = retrieval_metric_galleries(results, metrics, diff_gender)
+
+    def statistic_fn(rng: np.random.Generator, num_permutations: int) -> dict:
+        statistics = {}
+        for occupation, logits, group_ids, groups, gender_count in galleries:
+            # the argsort of random logits is a uniformly random ranking
+            permuted_logits = rng.random((num_permutations, len(logits))) if rng is not None else logits[None, :]
+            arrays = _retrieval_bias_arrays(permuted_logits, np.broadcast_to(group_ids, permuted_logits.shape), len(groups), ks,
+                                            np.broadcast_to(gender_count, permuted_logits.shape) if gender_count is not None else None)
+            present = np.bincount(group_ids, minlength=len(groups))[None, :] > 0
+            for metric, values in _retrieval_metric_values(arrays, ks, metrics, present).items():
+                statistics[occupation, metric] = values
+        return statistics
+
+    return statistic_fn
+
+def permutation_p_value(value: float, null_samples: np.ndarray, two_sided: bool) -> float:
+    """
+    Returns the permutation p-value of the value, the fraction of the null samples at least as extreme counting the
+    value itself, so that it is never 0. Two-sided p-values count the samples at least as far from the null mean, which
+    is not 0 for galleries with more images of one gender
+    """
+    if two_sided:
+        null_mean = null_samples.mean()
+        extreme = np.abs(null_samples - null_mean) >= abs(value - null_mean) - 1e-12
+    else:
+        extreme = null_samples >= value - 1e-12
+    return float((1 + extreme.sum()) / (1 + len(null_samples)))
+
+def retrieval_permutation_test(results: dict, metrics: list, diff_gender: bool = False, num_permutations: int = permutation_num_permutations,
+                               seed: int = permutation_seed, num_processes: int = permutation_num_processes) -> dict:
+    """
+    Returns the permutation test of every metric of every occupation, as {occupation: {metric: {"value", "null_mean",
+    "null_std", "p_value"}}}. p-values of bias@k and bias_count@k are two-sided, those of maxskew@k, minskew@k and
+    NDKL are one-sided (larger than for a random ranking)
+
+    Args:
+        results: raw retrieval results, as saved by run_retrieval_bias.py
+        metrics: metrics as named by calculate_retrieval_bias, e.g. "bias@10", "maxskew@10" or "ndkl"
+        diff_gender: if True, compare same gender pairs with different gender pairs instead of masculine with feminine
+        num_permutations: number of random rankings per occupation
+        seed: seed of the random rankings
+        num_processes: number of processes the permutations are spread across
+    """
+    statistic_fn = permutation_statistics(results, metrics, diff_gender)
+    values = statistic_fn(None, 1)
+    null_samples = bootstrap_samples(statistic_fn, num_permutations, seed, num_processes)
+
+    permutation_tests = {}
+    for (occupation, metric), metric_null_samples in null_samples.items():
+        value = float(values[occupation, metric][0])
+        permutation_tests.setdefault(occupation, {})[metric] = {
+            "value": value, "null_mean": float(metric_null_samples.mean()), "null_std": float(metric_null_samples.std(ddof=1)),
+            "p_value": permutation_p_value(value, metric_null_samples, two_sided=metric.split("@")[0] in signed_metrics)}
+    return permutation_tests
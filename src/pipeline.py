@@ -0,0 +1,153 @@
+"""
+In-process analysis pipeline, model outputs -> preliminary results -> benchmark scores, run as a DAG of stages. Every
+stage is keyed by the content hashes of its input files and its parameters, and only stages whose key changed since
+they last ran, or whose outputs are missing, are run again. A stage that reads the outputs of another stage runs after
+it, with the key of its new outputs. A stage can also update its own outputs in place, by listing them as inputs too.
+The keys and the time taken by every stage are saved in the pipeline state, see src/definitions.py.
+"""
+import os
+import json
+import time
+import hashlib
+
+
+def file_content_hash(filepath: str, hash_cache: dict = None) -> str:
+    """
+    Returns the sha256 of the content of the file. hash_cache maps the file path to (size, mtime_ns, hash), so files that
+    did not change since they were last hashed are not read again
+    """
+    stat = os.stat(filepath)
+    if hash_cache is not None:
+        cached = hash_cache.get(filepath)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+
+    sha256 = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    if hash_cache is not None:
+        hash_cache[filepath] = [stat.st_size, stat.st_mtime_ns, sha256.hexdigest()]
+    return sha256.hexdigest()
+
+
+class Pipeline:
+    """
+    DAG of analysis stages, with their keys and timings saved as JSON
+
+    Args:
+        state_filepath: path where the keys and timings of the stages are saved
+    """
+
+    def __init__(self, state_filepath: str):
+        self.state_filepath = state_filepath
+        self.stages = {}
+        self.state = {"stages": {}, "hashes": {}}
+        if os.path.exists(state_filepath):
+            with open(state_filepath) as f:
+                self.state = json.load(f)
+
+    def add(self, name: str, run_fn, inputs: list, outputs: list, params: dict = None):
+        """
+        Adds a stage to the pipeline
+
+        Args:
+            name: unique name of the stage, e.g. "preliminary_clip"
+            run_fn: function without arguments that writes the outputs
+            inputs: files the stage reads, including the outputs of other stages and the code it runs. Its own outputs
+                can be inputs too, for stages that update them, they may be missing before the first run
+            outputs: files the stage writes
+            params: JSON serializable parameters of the stage, part of its key
+
+        Raises:
+            ValueError: If a stage with the same name was already added.
+        """
+        if name in self.stages:
+            raise ValueError(f"Stage {name} is already in the pipeline")
+        self.stages[name] = {"run_fn": run_fn, "inputs": list(inputs), "outputs": list(outputs), "params": params or {}}
+
+    def _order(self) -> list:
+        """
+        Returns the stage names in an order where every stage comes after the stages writing its inputs
+
+        Raises:
+            ValueError: If the stages have a cycle.
+        """
+        writers = {output: name for name, stage in self.stages.items() for output in stage["outputs"]}
+        order, visiting = [], set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f"The pipeline has a cycle through stage {name}")
+            visiting.add(name)
+            for input_filepath in self.stages[name]["inputs"]:
+                if writers.get(input_filepath, name) != name:
+                    visit(writers[input_filepath])
+            visiting.discard(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def _key(self, name: str) -> str:
+        """
+        Returns the key of the stage, the sha256 of its parameters and the content hashes of its inputs (None for its own
+        outputs that do not exist yet)
+        """
+        stage = self.stages[name]
+        key = {"params": stage["params"],
+               "inputs": {input_filepath: file_content_hash(input_filepath, self.state["hashes"]) if os.path.exists(input_filepath) else None
+                          for input_filepath in stage["inputs"]}}
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def _save_state(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_filepath)), exist_ok=True)
+        with open(self.state_filepath, "w") as f:
+            json.dump(self.state, f, indent=4)
+
+    def run(self, force: bool = False) -> dict:
+        """
+        Runs the stale stages in dependency order and returns the report of every stage, as {name: {"status", "seconds"}}
+        with status "ran", "up to date" or "inputs missing" (missing inputs are not needed while the outputs exist)
+
+        Args:
+            force: if True, every stage is run again
+
+        Raises:
+            FileNotFoundError: If the inputs of a stage are missing and so are its outputs.
+        """
+        report = {}
+        for name in self._order():
+            stage = self.stages[name]
+            outputs_exist = all(os.path.exists(output) for output in stage["outputs"])
+            missing_inputs = [input_filepath for input_filepath in stage["inputs"] if not os.path.exists(input_filepath) and input_filepath not in stage["outputs"]]
+            if missing_inputs:
+                if not outputs_exist:
+                    raise FileNotFoundError(f"Stage {name} cannot run, missing inputs: {missing_inputs}")
+                print(f"Stage {name}: inputs missing, using the existing outputs")
+                report[name] = {"status": "inputs missing", "seconds": 0.0}
+                continue
+
+            key = self._key(name)
+            previous_run = self.state["stages"].get(name, {})
+            if not force and outputs_exist and previous_run.get("key") == key:
+                print(f"Stage {name}: up to date")
+                report[name] = {"status": "up to date", "seconds": 0.0}
+                continue
+
+            start = time.perf_counter()
+            stage["run_fn"]()
+            seconds = time.perf_counter() - start
+            # the outputs the stage updates in place are part of the key as they are after the run
+            if set(stage["inputs"]) & set(stage["outputs"]):
+                key = self._key(name)
+            self.state["stages"][name] = {"key": key, "seconds": seconds, "finished": time.strftime("%Y-%m-%d %H:%M:%S")}
+            self._save_state()
+            print(f"Stage {name}: ran in {seconds:.2f}s")
+            report[name] = {"status": "ran", "seconds": seconds}
+        # keep the content hashes of the inputs of the stages that were up to date
+        self._save_state()
+        return report
@@ -0,0 +1,122 @@
+"""
+Precomputed cube of the resolution results: the number of correct resolutions and of images for every combination of
+model, context, template type, sector, specialisation, occupation and (occupation gender, participant gender), computed
+with a single groupby over the preliminary results (see check_neutral_groundtruth_match in src/analysis_utils.py). The
+resolution accuracy and gender gap of any slice or breakdown is a sum over the cells of the cube, so queries and plots
+do not need the raw rows again. The cube is saved with the columnar format of src/results_store.py.
+"""
+import numpy as np
+import pandas as pd
+
+from src.results_store import save_results_npz, load_results_df
+
+# dimensions of the cube, "pair" is "same" or "diff" for the gender pair of two person images and "none" for one person,
+# "truth_gender" is the gender of the person the template resolves
+cube_dimensions = ["experiment", "model_name", "context", "template", "sector", "specialisation", "occ", "occ_gender", "par_gender", "truth_gender", "pair"]
+
+# older preliminary results name the sector and specialisation as the main and sub category
+cube_column_aliases = {"main_cat": "sector", "sub_cat": "specialisation"}
+
+# template types, with their ground truth matches in f"match_truth_{template}"
+cube_templates = ["occ_first", "par_first"]
+
+# gender column of the person resolved by every template type
+cube_truth_gender_columns = {"occ_first": "occ_gender", "par_first": "par_gender"}
+
+
+def build_resolution_cube(results_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns the cube of the preliminary results, with a row per combination of the cube dimensions that has images and
+    the columns "num_correct" and "num_images". Every template type of every row counts as one image of that template
+
+    Args:
+        results_df: preliminary results of any number of models and contexts, e.g. from load_full_dataframe in
+            src/data_utils.py or ResultsManifest.load in src/results_manifest.py
+
+    Raises:
+        ValueError: If the results have no match_truth_* columns.
+    """
+    results_df = results_df.rename(columns=cube_column_aliases)
+    template_dfs = []
+    for template in cube_templates:
+        match_column = f"match_truth_{template}"
+        if match_column not in results_df.columns:
+            continue
+        template_df = results_df[results_df[match_column].notna()]
+        # OO rows have no participant
+        template_df = pd.DataFrame({dimension: template_df[dimension].astype(object).fillna("none").astype(str) if dimension in template_df.columns else "none"
+                                    for dimension in cube_dimensions if dimension not in ("template", "truth_gender", "pair")}, index=template_df.index)
+        template_df["template"] = template
+        template_df["truth_gender"] = template_df[cube_truth_gender_columns[template]]
+        template_df["pair"] = np.where(template_df.par_gender == "none", "none", np.where(template_df.par_gender == template_df.occ_gender, "same", "diff"))
+        template_df["num_correct"] = results_df.loc[template_df.index, match_column].astype(bool)
+        template_dfs.append(template_df)
+    if not template_dfs:
+        raise ValueError("The results have no ground truth match columns, run check_neutral_groundtruth_match first")
+
+    long_df = pd.concat(template_dfs, ignore_index=True)
+    cube = long_df.groupby(cube_dimensions, sort=True).num_correct.agg(["sum", "count"]).reset_index()
+    return cube.rename(columns={"sum": "num_correct", "count": "num_images"})
+
+def roll_up(cube: pd.DataFrame, by: list, **filters) -> pd.DataFrame:
+    """
+    Returns the resolution accuracy of the cells matching the filters, grouped by the dimensions in by, with the columns
+    "num_correct", "num_images" and "accuracy"
+
+    Args:
+        cube: cube of build_resolution_cube
+        by: dimensions to group by, an empty list for a single row over every matching cell
+        filters: value or list of values of a dimension, e.g. context="context_OP" or occ_gender=["masculine"]
+
+    Raises:
+        ValueError: If a dimension is not a dimension of the cube.
+    """
+    unknown_dimensions = (set(by) | set(filters)) - set(cube_dimensions)
+    if unknown_dimensions:
+        raise ValueError(f"Not a dimension of the resolution cube: {sorted(unknown_dimensions)}")
+
+    mask = np.ones(len(cube), dtype=bool)
+    for dimension, values in filters.items():
+        mask &= cube[dimension].isin(np.atleast_1d(values).tolist()).to_numpy()
+    cells = cube[mask]
+
+    if by:
+        rolled_up = cells.groupby(list(by), sort=True, observed=True)[["num_correct", "num_images"]].sum().reset_index()
+    else:
+        rolled_up = pd.DataFrame({"num_correct": [cells.num_correct.sum()], "num_images": [cells.num_images.sum()]})
+    rolled_up["accuracy"] = rolled_up.num_correct / rolled_up.num_images
+    return rolled_up
+
+def gender_gap(cube: pd.DataFrame, by: list, **filters) -> pd.DataFrame:
+    """
+    Returns the resolution accuracy of masculine and feminine people ("his_accuracy", "her_accuracy"), their mean
+    "RA_avg" and the "gender_gap" (his - her) of the cells matching the filters, grouped by the dimensions in by, as
+    for the benchmark scores of single_person_res_acc and two_person_res_acc in src/analysis_utils.py. The gender is
+    that of the person each template resolves (truth_gender), the occupation for occ_first and the participant for
+    par_first. Groups without images of a gender have NaN accuracies for that gender. For the benchmark scores, filter
+    on template="occ_first", and on pair="same" for the same gender score
+
+    Args:
+        cube: cube of build_resolution_cube
+        by: dimensions to group by, an empty list for a single row over every matching cell
+        filters: value or list of values of a dimension, see roll_up
+    """
+    by = list(by)
+    accuracy = roll_up(cube, by + ["truth_gender"], **filters).set_index(by + ["truth_gender"]).accuracy
+    accuracy = accuracy.unstack("truth_gender") if by else accuracy.to_frame().T.reset_index(drop=True)
+    gaps = pd.DataFrame({"his_accuracy": accuracy.get("masculine", np.nan), "her_accuracy": accuracy.get("feminine", np.nan)}, index=accuracy.index)
+    gaps["RA_avg"] = (gaps.his_accuracy + gaps.her_accuracy) / 2
+    gaps["gender_gap"] = gaps.his_accuracy - gaps.her_accuracy
+    return gaps.reset_index() if by else gaps
+
+def save_resolution_cube(cube: pd.DataFrame, npz_filepath: str):
+    """
+    Saves the cube as a columnar NPZ, see save_results_npz in src/results_store.py
+    """
+    save_results_npz({str(cell_idx): cell for cell_idx, cell in enumerate(cube.to_dict("records"))}, npz_filepath)
+
+def load_resolution_cube(npz_filepath: str) -> pd.DataFrame:
+    """
+    Returns the cube saved by save_resolution_cube, with the dimensions as categorical columns
+    """
+    return load_results_df(npz_filepath).reset_index(drop=True)
@@ -0,0 +1,171 @@
+"""
+Manifest of the results files of a directory (raw model outputs or preliminary results, as JSON or as the NPZ of
+src/results_store.py), so that only the files of a query are loaded instead of every file of the directory. Every file
+is indexed once by the models, experiments, contexts and template types of its rows, and indexed again
+only when its size or modification time changes. The manifest is saved in the directory, see src/definitions.py.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from src.definitions import results_manifest_filename
+from src.data_utils import load_json_to_df
+from src.results_store import load_results_columns, load_results_df, category_kind
+
+# fields of the manifest entries that can be queried, as (manifest field, dataframe column or None)
+manifest_fields = {"model_name": "model_name", "experiment": "experiment", "context": "context", "template": None}
+
+# template type of every logits field
+logits_field_templates = {"logits_list_occ_first": "occ_first", "logits_list_par_first": "par_first", "logits_list_obj": "occ_first"}
+
+# experiment of every file description prefix, as saved by the runners (e.g. "clip_clip" or "captioning_blipv2")
+file_desc_experiments = {"clip": "CLIP", "captioning": "CAPTIONING"}
+
+
+def _filename_entry(filename: str) -> dict:
+    """
+    Returns the manifest fields that can be read from the name of a results file, for rows without those fields
+    """
+    entry = {}
+    if "ContextOP" in filename:
+        entry["context"] = ["context_OP"]
+    elif "ContextOO" in filename:
+        entry["context"] = ["context_OO"]
+
+    file_desc = filename.split("_Context")[0].split("_")
+    if len(file_desc) == 2 and file_desc[0] in file_desc_experiments:
+        entry["experiment"] = [file_desc_experiments[file_desc[0]]]
+        entry["model_name"] = [file_desc[1]]
+    return entry
+
+def index_results_file(filepath: str) -> dict:
+    """
+    Returns the manifest entry of a results file: the distinct values of every manifest field in its rows, with the
+    fields missing from the rows read from the file name, and the number of rows
+
+    Raises:
+        ValueError: If the file is not a results file keyed by IDX.
+    """
+    filename = os.path.basename(filepath)
+    values = {}
+    if filepath.endswith(".npz"):
+        columns = load_results_columns(filepath)
+        fields = columns["__fields"].tolist()
+        for field, kind in zip(fields, columns["__kinds"].tolist()):
+            if field in ("model_name", "experiment", "context") and kind == category_kind:
+                values[field] = columns[f"{field}__categories"].tolist()
+        num_rows = len(columns["IDX"])
+    else:
+        with open(filepath) as f:
+            results_dict = json.load(f)
+        if not isinstance(results_dict, dict) or not all(isinstance(row, dict) for row in results_dict.values()):
+            raise ValueError(f"{filepath} is not a results file keyed by IDX")
+        fields = list(dict.fromkeys(field for row in results_dict.values() for field in row))
+        for field in ("model_name", "experiment", "context"):
+            if field in fields:
+                values[field] = sorted({str(row[field]) for row in results_dict.values() if field in row})
+        num_rows = len(results_dict)
+
+    entry = {**_filename_entry(filename), **values}
+    entry["template"] = sorted({logits_field_templates[field] for field in fields if field in logits_field_templates})
+    entry["num_rows"] = num_rows
+    return entry
+
+
+class ResultsManifest:
+    """
+    Manifest of the results files of a directory, saved as JSON in the directory and refreshed before every query
+
+    Args:
+        directory_path: path to the folder containing the results files
+        manifest_filepath: path of the manifest, defaults to the manifest file name in src/definitions.py in the directory
+    """
+
+    def __init__(self, directory_path: str, manifest_filepath: str = None):
+        self.directory_path = directory_path
+        self.manifest_filepath = manifest_filepath if manifest_filepath is not None else os.path.join(directory_path, results_manifest_filename)
+        self.entries = {}
+        if os.path.exists(self.manifest_filepath):
+            with open(self.manifest_filepath) as f:
+                self.entries = json.load(f)
+        self.num_indexed = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def refresh(self):
+        """
+        Indexes the results files that are new or changed since they were indexed, and drops the removed files. Files
+        that are not results files are left out of the manifest
+        """
+        entries = {}
+        changed = False
+        for filename in sorted(os.listdir(self.directory_path)):
+            filepath = os.path.join(self.directory_path, filename)
+            if not filename.endswith((".json", ".npz")) or filepath == self.manifest_filepath:
+                continue
+            stat = os.stat(filepath)
+            entry = self.entries.get(filename)
+            if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                entries[filename] = entry
+                continue
+
+            try:
+                entry = index_results_file(filepath)
+            except (ValueError, KeyError):
+                continue
+            entries[filename] = {**entry, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            self.num_indexed += 1
+            changed = True
+
+        if changed or entries.keys() != self.entries.keys():
+            self.entries = entries
+            with open(self.manifest_filepath, "w") as f:
+                json.dump(self.entries, f, indent=4)
+
+    def query(self, **predicates) -> list:
+        """
+        Returns the results files matching every predicate, e.g. query(model_name="clip", context="context_OP"). A
+        predicate is a value or a list of values of a manifest field (model_name, experiment, context or template), and
+        a file matches if any of its values is one of them. Files converted to NPZ are only returned once, as the NPZ,
+        unless the JSON was written after it (e.g. the preliminary analysis was run again)
+
+        Raises:
+            ValueError: If a predicate is not a manifest field.
+        """
+        unknown_fields = set(predicates) - set(manifest_fields)
+        if unknown_fields:
+            raise ValueError(f"Not a field of the results manifest: {sorted(unknown_fields)}")
+        self.refresh()
+
+        filenames = []
+        for filename, entry in self.entries.items():
+            stem, extension = os.path.splitext(filename)
+            sibling = self.entries.get(f"{stem}{'.npz' if extension == '.json' else '.json'}")
+            # of a JSON and its NPZ, only the newer one is returned, the NPZ if they are as new
+            if sibling is not None and (sibling["mtime_ns"] >= entry["mtime_ns"] if extension == ".json" else sibling["mtime_ns"] > entry["mtime_ns"]):
+                continue
+            if all(set(np.atleast_1d(allowed_values).tolist()) & set(entry.get(field, [])) for field, allowed_values in predicates.items()):
+                filenames.append(filename)
+        return filenames
+
+    def load(self, **predicates) -> pd.DataFrame:
+        """
+        Returns the dataframe of the rows matching the predicates (see query), over the matching files only, in the
+        format of load_full_dataframe in src/data_utils.py
+        """
+        dataframe_list = []
+        for filename in self.query(**predicates):
+            filepath = os.path.join(self.directory_path, filename)
+            df = load_results_df(filepath) if filename.endswith(".npz") else load_json_to_df(filepath)
+            # files can hold rows of other queries, e.g. several models
+            for field, allowed_values in predicates.items():
+                column = manifest_fields[field]
+                if column is not None and column in df.columns:
+                    df = df[df[column].isin(np.atleast_1d(allowed_values).tolist())]
+            dataframe_list.append(df)
+
+        if not dataframe_list:
+            return pd.DataFrame()
+        return pd.concat(dataframe_list, ignore_index=True)
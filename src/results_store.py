@@ -0,0 +1,146 @@
+"""
+Columnar binary storage of the resolution results, as an alternative to the indented JSON written by save_dict_json
+(see src/data_utils.py). The results of one file are saved as a single uncompressed NPZ with one array per column: the
+pronoun logits dicts as (num_rows, num_pronouns) float32 matrices, metadata strings as categorical codes into their
+categories, and boolean and numeric fields as they are. Loading is a handful of array reads instead of parsing a
+nested dict per row.
+
+Logits are stored as float32, so converting a JSON file to NPZ and back only keeps the logits up to float32 precision
+(exactly for the half precision CLIP logits).
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+
+# kinds of columns, stored under "__kinds" next to the field names under "__fields"
+logits_kind = "logits"
+category_kind = "category"
+bool_kind = "bool"
+number_kind = "number"
+
+
+def _column_kind(field: str, values: list) -> str:
+    """
+    Returns the kind of column of the field values of every row
+
+    Raises:
+        ValueError: If the values are not all logits dicts with the same pronouns, strings, booleans or numbers.
+    """
+    if all(isinstance(value, dict) for value in values):
+        if any(list(value) != list(values[0]) for value in values):
+            raise ValueError(f"The logits dicts of {field} do not all have the same pronouns")
+        return logits_kind
+    if all(isinstance(value, str) for value in values):
+        return category_kind
+    if all(isinstance(value, (bool, np.bool_)) for value in values):
+        return bool_kind
+    if all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+        return number_kind
+    raise ValueError(f"{field} is not a column of logits dicts, strings, booleans or numbers")
+
+def results_dict_to_columns(results_dict: dict, logits_dtype=np.float32) -> dict:
+    """
+    Returns the columns of the results dict, keyed by IDX as saved by save_dict_json, as a dict of arrays
+
+    Args:
+        results_dict: results keyed by IDX, every row with the same fields
+        logits_dtype: dtype of the logits matrices
+
+    Raises:
+        ValueError: If the rows do not all have the same fields, or a field is not a supported kind of column.
+    """
+    idxs = list(results_dict)
+    rows = list(results_dict.values())
+    fields = list(rows[0]) if rows else []
+    if any(list(row) != fields for row in rows):
+        raise ValueError("The rows of the results do not all have the same fields")
+
+    columns = {"IDX": np.array(idxs, dtype=str)}
+    kinds = []
+    for field in fields:
+        values = [row[field] for row in rows]
+        kind = _column_kind(field, values)
+        if kind == logits_kind:
+            columns[f"{field}__keys"] = np.array(list(values[0]), dtype=str)
+            columns[field] = np.array([list(value.values()) for value in values], dtype=logits_dtype)
+        elif kind == category_kind:
+            categories, codes = np.unique(np.array(values, dtype=str), return_inverse=True)
+            columns[f"{field}__categories"] = categories
+            columns[f"{field}__codes"] = codes.astype(np.int32)
+        else:
+            columns[field] = np.array(values, dtype=bool if kind == bool_kind else None)
+        kinds.append(kind)
+
+    columns["__fields"] = np.array(fields, dtype=str)
+    columns["__kinds"] = np.array(kinds, dtype=str)
+    return columns
+
+def columns_to_results_dict(columns: dict) -> dict:
+    """
+    Returns the results dict keyed by IDX, as saved by save_dict_json, of the columns of results_dict_to_columns
+    """
+    fields = columns["__fields"].tolist()
+    field_values = []
+    for field, kind in zip(fields, columns["__kinds"].tolist()):
+        if kind == logits_kind:
+            keys = columns[f"{field}__keys"].tolist()
+            field_values.append([dict(zip(keys, logits)) for logits in columns[field].tolist()])
+        elif kind == category_kind:
+            field_values.append(columns[f"{field}__categories"][columns[f"{field}__codes"]].tolist())
+        else:
+            field_values.append(columns[field].tolist())
+    return {idx: dict(zip(fields, row_values)) for idx, row_values in zip(columns["IDX"].tolist(), zip(*field_values))}
+
+def save_results_npz(results_dict: dict, npz_filepath: str, logits_dtype=np.float32):
+    """
+    Saves the results dict keyed by IDX as a columnar NPZ, see results_dict_to_columns
+    """
+    with open(npz_filepath, "wb") as f:
+        np.savez(f, **results_dict_to_columns(results_dict, logits_dtype))
+
+def load_results_columns(npz_filepath: str) -> dict:
+    """
+    Returns the columns of a results NPZ as a dict of arrays, e.g. the (num_rows, num_pronouns) float32 logits of a
+    template under "logits_list_occ_first" with the pronouns under "logits_list_occ_first__keys"
+    """
+    with np.load(npz_filepath, allow_pickle=False) as npz:
+        return {name: npz[name] for name in npz.files}
+
+def load_results_df(npz_filepath: str) -> pd.DataFrame:
+    """
+    Returns the results of a results NPZ as the dataframe of load_json_to_df (see src/data_utils.py), indexed by IDX, with
+    the metadata as categorical columns and the logits as dicts
+    """
+    columns = load_results_columns(npz_filepath)
+    dataframe = {}
+    for field, kind in zip(columns["__fields"].tolist(), columns["__kinds"].tolist()):
+        if kind == logits_kind:
+            keys = columns[f"{field}__keys"].tolist()
+            dataframe[field] = [dict(zip(keys, logits)) for logits in columns[field].tolist()]
+        elif kind == category_kind:
+            dataframe[field] = pd.Categorical.from_codes(columns[f"{field}__codes"], columns[f"{field}__categories"])
+        else:
+            dataframe[field] = columns[field]
+    return pd.DataFrame(dataframe, index=columns["IDX"])
+
+def convert_json_to_npz(json_filepath: str, npz_filepath: str = None) -> str:
+    """
+    Converts a results JSON into a results NPZ, saved next to it with the same name by default. Returns the NPZ path
+    """
+    if npz_filepath is None:
+        npz_filepath = os.path.splitext(json_filepath)[0] + ".npz"
+    with open(json_filepath) as f:
+        save_results_npz(json.load(f), npz_filepath)
+    return npz_filepath
+
+def convert_npz_to_json(npz_filepath: str, json_filepath: str = None) -> str:
+    """
+    Converts a results NPZ into a results JSON as saved by save_dict_json, next to it with the same name by default.
+    Returns the JSON path
+    """
+    if json_filepath is None:
+        json_filepath = os.path.splitext(npz_filepath)[0] + ".json"
+    with open(json_filepath, "w") as f:
+        json.dump(columns_to_results_dict(load_results_columns(npz_filepath)), f, indent=4)
+    return json_filepath
@@ -7,12 +7,14 @@ import sys
 import io
 import unittest
 import pandas as pd
+import numpy as np
 
 
 main_dir_test = os.getcwd().split("tests")[0]
 sys.path.append(main_dir_test) 
 from src.definitions import gender_idx_dict
-from src.analysis_utils import json_summary_loader, get_max_logit_id, set_up_benchmark_dict, load_benchmark_dict
+from src.analysis_utils import (json_summary_loader, get_max_logit_id, set_up_benchmark_dict, load_benchmark_dict, resolution_checks,
+                                update_df_neutral_check, update_df_match_ground_truth)
 
 class TestAnalysisUtils(unittest.TestCase):
     def setUp(self):
@@ -53,6 +55,33 @@ class TestAnalysisUtils(unittest.TestCase):
         self.assertEqual(get_max_logit_id(logits_3), id_3)
         self.assertEqual(get_max_logit_id(logits_4), id_4)
 
+    def test_resolution_checks(self):
+        """Tests that the vectorized neutral and ground truth checks match the row by row updates, including tied logits"""
+        rng = np.random.default_rng(0)
+        genders = ["masculine", "feminine"]
+        results_df = pd.DataFrame({"occ_gender": rng.choice(genders, 200), "par_gender": rng.choice(genders, 200),
+                                   "logits_list_occ_first": [dict(zip(["his", "her", "their"], logits)) for logits in np.round(rng.random((200, 3)), 1).tolist()],
+                                   "logits_list_par_first": [dict(zip(["his", "her", "their"], logits)) for logits in np.round(rng.random((200, 3)), 1).tolist()]})
+        template_columns = {"occ_first": ("logits_list_occ_first", "occ_gender"), "par_first": ("logits_list_par_first", "par_gender")}
+
+        expected_df = results_df.copy()
+        for template, (logits_column, gender_column) in template_columns.items():
+            expected_df[f"neutral_check_{template}"] = False
+            expected_df[f"match_truth_{template}"] = False
+            for row_index, row in expected_df.iterrows():
+                max_logit_id = get_max_logit_id(row[logits_column])
+                expected_df = update_df_neutral_check(expected_df, row_index, max_logit_id, gender_idx_dict, template)
+                expected_df = update_df_match_ground_truth(expected_df, row_index, gender_idx_dict[row[gender_column]], max_logit_id, template, gender_idx_dict)
+
+        columns = resolution_checks(results_df, template_columns, gender_idx_dict)
+        self.assertEqual(set(columns), {"neutral_check_occ_first", "match_truth_occ_first", "neutral_check_par_first", "match_truth_par_first"})
+        for column, values in columns.items():
+            self.assertEqual(values.tolist(), expected_df[column].tolist())
+
+        results_df.loc[0, "occ_gender"] = "woman"
+        with self.assertRaises(KeyError):
+            resolution_checks(results_df, template_columns, gender_idx_dict)
+
     def test_set_up_benchmark_dict(self):
         "Tests that a new benchmark dict is set up"
 
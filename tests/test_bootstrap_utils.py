@@ -0,0 +1,96 @@
+"""
+Tests for the bootstrap confidence intervals of the benchmark scores, on synthetic results
+"""
+
+import os
+import sys
+import unittest
+import numpy as np
+import pandas as pd
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from src.bootstrap_utils import (stratified_bootstrap_indices, bootstrap_samples, percentile_interval, resolution_statistics, retrieval_statistics,
+                                 resolution_bootstrap_ci, retrieval_bootstrap_ci)
+from src.analysis_utils import single_person_res_acc, two_person_res_acc, overall_res_acc
+from src.metrics import calculate_retrieval_bias
+from tests.test_metrics import synthetic_retrieval_results
+
+
+def synthetic_resolution_dataframes(seed: int = 0) -> tuple:
+    """
+    Returns the (OO, OP) subset dataframes of the resolution analysis, with random matches
+    """
+    rng = np.random.default_rng(seed)
+    genders = ["masculine", "feminine"]
+    oo_subset_df = pd.DataFrame({"occ": np.repeat([f"occupation_{i}" for i in range(6)], 8), "occ_gender": np.tile(genders, 24),
+                                 "match_truth_occ_first": rng.random(48) < 0.7})
+    op_subset_df = pd.DataFrame({"occ": np.repeat([f"occupation_{i}" for i in range(6)], 8), "occ_gender": np.tile(np.repeat(genders, 2), 12),
+                                 "par_gender": np.tile(genders, 24), "match_truth_occ_first": rng.random(48) < 0.6})
+    return oo_subset_df, op_subset_df
+
+def empty_benchmark_dict() -> dict:
+    sections = ["single_person_images", "two_person_images", "two_person_images_same_gender", "two_person_images_diff_gender"]
+    return {"resolution_bias": {"all_images": {"overall_accuracy": None}, **{section: {"RA_avg": None, "gender_gap": None} for section in sections}},
+            "retrieval_bias": {metric: {"mean": None, "sigma": None} for metric in ["bias@5", "bias@10", "maxskew@5", "maxskew@10", "NDKL"]}}
+
+
+class TestBootstrapUtils(unittest.TestCase):
+    def test_stratified_bootstrap_indices(self):
+        """Tests that rows are only resampled within their stratum"""
+        strata = np.array(["a", "a", "b", "b", "b", "c"])
+        indices = stratified_bootstrap_indices(strata, 100, np.random.default_rng(0))
+        self.assertEqual(indices.shape, (100, 6))
+        self.assertTrue((strata[indices] == strata[None, :]).all())
+        self.assertTrue((indices[:, 5] == 5).all())
+        self.assertEqual(stratified_bootstrap_indices(strata, 1).tolist(), [list(range(6))])
+
+    def test_resolution_statistics(self):
+        """Tests that the statistics of the original rows match the benchmark scores, up to their rounding"""
+        oo_subset_df, op_subset_df = synthetic_resolution_dataframes()
+        benchmark_dict = single_person_res_acc(oo_subset_df, empty_benchmark_dict(), "CLIP", "clip", "Context_OO")
+        benchmark_dict = overall_res_acc(two_person_res_acc(op_subset_df, benchmark_dict, "CLIP", "clip", "Context_OP"))
+
+        for (section, field), value in resolution_statistics(oo_subset_df, op_subset_df)(None, 1).items():
+            self.assertAlmostEqual(value[0], benchmark_dict["resolution_bias"][section][field], delta=0.011)
+
+    def test_retrieval_statistics(self):
+        """Tests that the statistics of the original galleries are the means of calculate_retrieval_bias"""
+        results = synthetic_retrieval_results(5, 20, with_participants=True)
+        metrics = ["bias@5", "maxskew@10", "minskew@10", "bias_count@10", "ndkl"]
+        bias = calculate_retrieval_bias(results)
+        for metric, value in retrieval_statistics(results, metrics)(None, 1).items():
+            self.assertAlmostEqual(value[0], np.mean([bias[occupation][metric] for occupation in bias]), places=12)
+
+        with self.assertRaises(ValueError):
+            retrieval_statistics(results, ["bias@30"])
+
+    def test_bootstrap_samples(self):
+        """Tests that the resamples do not depend on the number of processes, and the intervals contain the estimates"""
+        oo_subset_df, op_subset_df = synthetic_resolution_dataframes()
+        statistic_fn = resolution_statistics(oo_subset_df, op_subset_df)
+        samples = bootstrap_samples(statistic_fn, num_resamples=500, seed=1, block_size=100)
+        forked_samples = bootstrap_samples(statistic_fn, num_resamples=500, seed=1, num_processes=2, block_size=100)
+        for name in samples:
+            self.assertEqual(samples[name].shape, (500,))
+            np.testing.assert_array_equal(samples[name], forked_samples[name])
+
+        estimates = statistic_fn(None, 1)
+        for name in ["single_person_images", "two_person_images"]:
+            lower, upper = percentile_interval(samples[name, "RA_avg"])
+            self.assertLessEqual(lower, estimates[name, "RA_avg"][0])
+            self.assertGreaterEqual(upper, estimates[name, "RA_avg"][0])
+
+    def test_bootstrap_ci(self):
+        """Tests that a confidence interval is added to every field of the benchmark dict"""
+        oo_subset_df, op_subset_df = synthetic_resolution_dataframes()
+        benchmark_dict = resolution_bootstrap_ci(oo_subset_df, op_subset_df, empty_benchmark_dict(), num_resamples=200)
+        benchmark_dict = retrieval_bootstrap_ci(synthetic_retrieval_results(5, 20, with_participants=True), benchmark_dict,
+                                                list(benchmark_dict["retrieval_bias"]), num_resamples=200)
+
+        for section, fields in benchmark_dict["resolution_bias"].items():
+            for field in [field for field in fields if not field.endswith("_ci")]:
+                lower, upper = fields[f"{field}_ci"]
+                self.assertLessEqual(lower, upper)
+        for metric, fields in benchmark_dict["retrieval_bias"].items():
+            self.assertEqual(len(fields["ci"]), 2)
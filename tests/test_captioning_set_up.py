@@ -0,0 +1,106 @@
+"""
+Tests for the captioning set up, using small randomly initialised BLIP and BLIP-2 models and a toy vocabulary so that 
+no weights are downloaded
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+import torch
+from PIL import Image
+from transformers import BertTokenizer, BlipImageProcessor, BlipProcessor, Blip2Processor, BlipConfig, BlipForConditionalGeneration, Blip2Config, Blip2Model
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from src.captioning_set_up import BlipPronounScorer, set_up_captioning_engine, pronoun_logit_drift
+
+VOCAB = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "the", "doctor", "patient", "and", "his", "her", "their"]
+SMALL_VISION_CONFIG = dict(hidden_size=32, intermediate_size=37, num_hidden_layers=2, num_attention_heads=2, image_size=32, patch_size=8)
+
+
+def small_blip_processors(vocab_dir: str):
+    vocab_filepath = os.path.join(vocab_dir, "vocab.txt")
+    with open(vocab_filepath, "w") as f:
+        f.write("\n".join(VOCAB))
+    tokenizer = BertTokenizer(vocab_filepath)
+    image_processor = BlipImageProcessor(size={"height": 32, "width": 32})
+    return BlipProcessor(image_processor, tokenizer), Blip2Processor(image_processor, tokenizer)
+
+
+def small_blip_models():
+    torch.manual_seed(0)
+    blip_config = BlipConfig(vision_config=SMALL_VISION_CONFIG, projection_dim=32,
+                             text_config=dict(vocab_size=len(VOCAB), hidden_size=32, intermediate_size=37, num_hidden_layers=2, num_attention_heads=2,
+                                              encoder_hidden_size=32, pad_token_id=0, bos_token_id=2, sep_token_id=3))
+    blipv2_config = Blip2Config(vision_config=SMALL_VISION_CONFIG, num_query_tokens=4,
+                                qformer_config=dict(vocab_size=len(VOCAB), hidden_size=32, intermediate_size=37, num_hidden_layers=2, 
+                                                    num_attention_heads=2, encoder_hidden_size=32),
+                                text_config=dict(model_type="opt", vocab_size=len(VOCAB), hidden_size=32, ffn_dim=37, num_hidden_layers=2, 
+                                                 num_attention_heads=2, word_embed_proj_dim=32, pad_token_id=0, bos_token_id=2, eos_token_id=3))
+    return BlipForConditionalGeneration(blip_config).eval(), Blip2Model(blipv2_config).eval()
+
+
+class TestCaptioningSetUp(unittest.TestCase):
+    def setUp(self):
+        self.vocab_dir = tempfile.TemporaryDirectory()
+        self.blip_processor, self.blipv2_processor = small_blip_processors(self.vocab_dir.name)
+        self.blip_model, self.blipv2_model = small_blip_models()
+        self.raw_image = Image.new("RGB", (320, 240), (40, 100, 215))
+        self.text_inputs = ["the doctor and", "the patient and"]
+
+    def tearDown(self):
+        self.vocab_dir.cleanup()
+
+    def test_blip_pronoun_scorer(self):
+        """Tests that scoring several prompts against one encoded image matches a full forward pass per prompt"""
+        for model, processor, logits_key in [(self.blip_model, self.blip_processor, "decoder_logits"), 
+                                             (self.blipv2_model, self.blipv2_processor, "logits")]:
+            scorer = BlipPronounScorer(model, processor, device="cpu")
+            self.assertEqual(scorer.pronoun_token_ids, {"his": VOCAB.index("his"), "her": VOCAB.index("her"), "their": VOCAB.index("their")})
+
+            scores = scorer.score(self.raw_image, self.text_inputs)
+            self.assertEqual(len(scores), len(self.text_inputs))
+            for text_input, score in zip(self.text_inputs, scores):
+                with torch.no_grad():
+                    logits = model(**processor(self.raw_image, text_input, return_tensors="pt"))[logits_key][0, -1, :]
+                for pronoun, token_id in scorer.pronoun_token_ids.items():
+                    self.assertAlmostEqual(score[pronoun], logits[token_id].item(), places=5)
+
+    def test_blip_pronoun_scorer_batch(self):
+        """Tests that batches of padded prompts of different lengths give the same logits as one prompt at a time"""
+        raw_images = [Image.new("RGB", (320, 240), (40 * i, 100, 255 - 40 * i)) for i in range(3)]
+        image_prompt_pairs = [(raw_images[0], ["the doctor and", "the patient and"]), (raw_images[1], ["the doctor and the patient and"]),
+                              (raw_images[2], ["the", "the doctor", "doctor and the patient and"])]
+        for model, processor in [(self.blip_model, self.blip_processor), (self.blipv2_model, self.blipv2_processor)]:
+            scorer = BlipPronounScorer(model, processor, device="cpu", batch_size=2)
+            batch_scores = scorer.score_batch(image_prompt_pairs)
+            self.assertEqual([len(scores) for scores in batch_scores], [2, 1, 3])
+            for (raw_image, text_inputs), scores in zip(image_prompt_pairs, batch_scores):
+                for text_input, score in zip(text_inputs, scores):
+                    expected = scorer.score_batch([(raw_image, [text_input])])[0][0]
+                    for pronoun in scorer.pronouns:
+                        self.assertAlmostEqual(score[pronoun], expected[pronoun], places=4)
+            self.assertEqual(scorer.score_batch([]), [])
+
+    def test_captioning_engine_precisions(self):
+        """Tests that the bf16 and int8 CPU modes run, and stay close to the fp32 logits"""
+        image_prompt_pairs = [(self.raw_image, self.text_inputs)]
+        num_threads = torch.get_num_threads()
+        for model, processor in [(self.blip_model, self.blip_processor), (self.blipv2_model, self.blipv2_processor)]:
+            reference_scores = BlipPronounScorer(set_up_captioning_engine(model, "cpu", "fp32"), processor, device="cpu").score_batch(image_prompt_pairs)
+            self.assertEqual(pronoun_logit_drift(reference_scores, reference_scores)["max_abs_diff"], 0.0)
+
+            for precision in ["bf16", "int8"]:
+                engine_model = set_up_captioning_engine(model, "cpu", precision, num_threads=1)
+                scores = BlipPronounScorer(engine_model, processor, device="cpu", precision=precision).score_batch(image_prompt_pairs)
+                drift = pronoun_logit_drift(reference_scores, scores)
+                self.assertLess(drift["max_abs_diff"], 0.1)
+                self.assertGreaterEqual(drift["mean_abs_diff"], 0.0)
+            self.assertEqual(torch.get_num_threads(), 1)
+            torch.set_num_threads(num_threads)
+
+        with self.assertRaises(ValueError):
+            set_up_captioning_engine(self.blip_model, "cpu", "fp16")
+        with self.assertRaises(ValueError):
+            set_up_captioning_engine(self.blip_model, "cuda", "int8")
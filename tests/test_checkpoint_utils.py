@@ -0,0 +1,73 @@
+"""
+Tests for the resumable JSONL checkpoints of the raw results
+"""
+
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from src.checkpoint_utils import ResultsCheckpoint
+from src.parallel_utils import fork_map
+
+
+class TestResultsCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.results_dir = tempfile.TemporaryDirectory()
+        self.template_types = ["occ_first", "par_first"]
+        self.rows = {f"IDX_{i}": {"occ": "doctor", "logits_list_occ_first": {"his": i, "her": -i, "their": 0.5},
+                                  "logits_list_par_first": {"his": -i, "her": i, "their": 0.25}} for i in range(4)}
+
+    def tearDown(self):
+        self.results_dir.cleanup()
+
+    def checkpoint(self, resume: bool = True) -> ResultsCheckpoint:
+        return ResultsCheckpoint(self.results_dir.name, True, False, "unittests_model", resume=resume)
+
+    def test_resume_and_compact(self):
+        """Tests that a restarted run skips the checkpointed rows, and the compacted json matches an uninterrupted run"""
+        checkpoint = self.checkpoint()
+        for key in ["IDX_0", "IDX_2"]:
+            checkpoint.add(key, self.rows[key], self.template_types)
+        checkpoint.close()
+        # a crash while the last row was written
+        with open(checkpoint.checkpoint_filepath, "a") as f:
+            f.write('{"key": "IDX_3", "template_types": ["occ_fi')
+
+        resumed = self.checkpoint()
+        self.assertEqual(len(resumed), 2)
+        self.assertTrue(resumed.is_done("IDX_0", self.template_types))
+        self.assertFalse(resumed.is_done("IDX_3", self.template_types))
+        self.assertFalse(resumed.is_done("IDX_1", ["occ_first"]))
+        for key in ["IDX_1", "IDX_3"]:
+            resumed.add(key, self.rows[key], self.template_types)
+
+        results_dict = resumed.compact(list(self.rows))
+        self.assertFalse(os.path.exists(resumed.checkpoint_filepath))
+        with open(os.path.join(self.results_dir.name, "unittests_model_ContextOP.json")) as f:
+            saved = json.load(f)
+        self.assertEqual(list(saved.items()), list(self.rows.items()))
+        self.assertEqual(results_dict, saved)
+
+    def test_no_resume(self):
+        """Tests that the checkpointed rows are discarded without resume"""
+        checkpoint = self.checkpoint()
+        checkpoint.add("IDX_0", self.rows["IDX_0"], self.template_types)
+        checkpoint.close()
+        self.assertEqual(len(self.checkpoint(resume=False)), 0)
+
+    def test_forked_workers(self):
+        """Tests that rows checkpointed by forked workers are all compacted"""
+        checkpoint = self.checkpoint()
+        keys = list(self.rows)
+
+        def add_shard(shard_idx, num_shards):
+            for key in keys[shard_idx::num_shards]:
+                checkpoint.add(key, self.rows[key], self.template_types)
+            checkpoint.close()
+
+        fork_map(add_shard, 2)
+        self.assertEqual(list(checkpoint.compact(keys).items()), list(self.rows.items()))
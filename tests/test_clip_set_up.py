@@ -0,0 +1,91 @@
+"""
+Tests for the CLIP-like set up, using a small randomly initialised CLIP model so that no weights are downloaded
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+import warnings
+from unittest import mock
+import torch
+from PIL import Image
+from clip.model import CLIP
+from clip.clip import _transform
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from src.clip_set_up import clip_model, clip_model_batch, clip_encode_images, clip_encode_texts, TracedClipEncoders
+
+
+def small_clip_model_processor():
+    torch.manual_seed(0)
+    model = CLIP(embed_dim=64, image_resolution=224, vision_layers=2, vision_width=64, vision_patch_size=32,
+                 context_length=77, vocab_size=49408, transformer_width=64, transformer_heads=2, transformer_layers=2)
+    return model.eval(), _transform(224)
+
+
+class TestClipSetUp(unittest.TestCase):
+    def setUp(self):
+        self.model, self.processor = small_clip_model_processor()
+        self.image_inputs = [self.processor(Image.new("RGB", (320, 240), (40 * i, 100, 255 - 40 * i))).unsqueeze(0) for i in range(5)]
+        self.phrase_lists = [["The doctor and his patient", "The doctor and her patient", "The doctor and their patient"],
+                             ["The baker and his customer", "The baker and her customer", "The baker and their customer"]]
+
+    def test_clip_encode_images(self):
+        """Tests that batched image encoding matches encoding one image at a time"""
+        batched_features = clip_encode_images(self.image_inputs, self.model, batch_size=2)
+        with torch.no_grad():
+            single_features = torch.cat([self.model.encode_image(image_input) for image_input in self.image_inputs])
+        self.assertEqual(tuple(batched_features.shape), (5, 64))
+        self.assertTrue(torch.allclose(batched_features, single_features, atol=1e-5))
+
+    def test_clip_model_batch(self):
+        """Tests that scoring many (image, caption set) pairs in one call matches clip_model for each pair"""
+        pairs = [(image_input, self.phrase_lists[i % 2]) for i, image_input in enumerate(self.image_inputs)]
+        batch_similarities = clip_model_batch(pairs, self.model, batch_size=2)
+
+        self.assertEqual(len(batch_similarities), len(pairs))
+        for (image_input, phrase_list), similarities in zip(pairs, batch_similarities):
+            expected = clip_model(phrase_list, [None], self.model, self.processor, image_inputs=[image_input])
+            for value, expected_value in zip(similarities, expected):
+                self.assertAlmostEqual(value, expected_value, places=5)
+            self.assertAlmostEqual(sum(similarities), 1.0, places=5)
+
+        self.assertEqual(clip_model_batch([], self.model), [])
+
+    def test_traced_clip_encoders(self):
+        """Tests that the traced encoders match the eager model, are loaded from the cache, and fall back to eager mode"""
+        sentences = self.phrase_lists[0] + self.phrase_lists[1]
+        eager_image_features = clip_encode_images(self.image_inputs, self.model, batch_size=2)
+        eager_text_features = clip_encode_texts(sentences, self.model, batch_size=4)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            traced_model = TracedClipEncoders(self.model, "small_clip", cache_dir)
+            self.assertEqual(traced_model.backends, {"image": "traced", "text": "traced"})
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            self.assertTrue(torch.allclose(clip_encode_images(self.image_inputs, traced_model, batch_size=3), eager_image_features, atol=1e-5))
+            self.assertTrue(torch.allclose(clip_encode_texts(sentences, traced_model, batch_size=4), eager_text_features, atol=1e-5))
+
+            cached_model = TracedClipEncoders(self.model, "small_clip", cache_dir)
+            self.assertEqual(cached_model.backends, {"image": "traced", "text": "traced"})
+            self.assertTrue(torch.allclose(clip_encode_images(self.image_inputs, cached_model, batch_size=2), eager_image_features, atol=1e-5))
+
+            # a corrupted cached encoder is traced again
+            for filename in os.listdir(cache_dir):
+                with open(os.path.join(cache_dir, filename), "wb") as f:
+                    f.write(b"not a torchscript file")
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                retraced_model = TracedClipEncoders(self.model, "small_clip", cache_dir)
+            self.assertEqual(retraced_model.backends, {"image": "traced", "text": "traced"})
+            self.assertTrue(any("tracing it again" in str(warning.message) for warning in caught))
+
+        with tempfile.TemporaryDirectory() as cache_dir, mock.patch("torch.jit.trace", side_effect=RuntimeError("not traceable")), \
+                warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            eager_model = TracedClipEncoders(self.model, "small_clip", cache_dir)
+            self.assertEqual(os.listdir(cache_dir), [])
+        self.assertEqual(eager_model.backends, {"image": "eager", "text": "eager"})
+        self.assertTrue(any("falling back to the eager encoder" in str(warning.message) for warning in caught))
+        self.assertTrue(torch.allclose(clip_encode_images(self.image_inputs, eager_model, batch_size=2), eager_image_features, atol=1e-5))
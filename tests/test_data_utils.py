@@ -5,6 +5,7 @@ Author: @smhall97
 import os
 import sys
 import unittest
+import time
 import requests
 import glob
 import pandas as pd
@@ -12,7 +13,7 @@ import pandas as pd
 main_dir_test = os.getcwd().split("tests")[0]
 sys.path.append(main_dir_test) 
 from src.definitions import gender_idx_dict
-from src.data_utils import load_visogender_data, load_json_to_df, get_image, load_us_labor_statistics, load_full_dataframe, check_op_and_oo_both_exist, check_op_and_oo_both_exist_preliminary_analysis
+from src.data_utils import load_visogender_data, load_json_to_df, get_image, load_us_labor_statistics, load_full_dataframe, check_op_and_oo_both_exist, check_op_and_oo_both_exist_preliminary_analysis, prefetch_map, batch_items
 
 
 class TestDataUtils(unittest.TestCase):
@@ -135,6 +136,28 @@ class TestDataUtils(unittest.TestCase):
         check_both_clip = check_op_and_oo_both_exist_preliminary_analysis(file_path_without, "clip")   
         self.assertFalse(check_both_clip)    
         check_both_cap = check_op_and_oo_both_exist_preliminary_analysis(file_path_without, "blipv2")   
-        self.assertFalse(check_both_cap)  
-
-        
+        self.assertFalse(check_both_cap)
+
+    def test_prefetch_map(self):
+        """Tests that prefetched items come out in input order, and that errors are raised when the result is read"""
+        def slow_square(x):
+            time.sleep(0.01 * (5 - x % 5))
+            if x == 3:
+                raise ValueError("failed to load")
+            return x * x
+
+        results = []
+        for item, future in prefetch_map(slow_square, range(10), num_workers=4, max_prefetch=3):
+            try:
+                results.append((item, future.result()))
+            except ValueError:
+                results.append((item, None))
+
+        self.assertEqual([item for item, _ in results], list(range(10)))
+        self.assertEqual(results[2], (2, 4))
+        self.assertEqual(results[3], (3, None))
+
+    def test_batch_items(self):
+        """Tests that items are grouped into batches in order, with a smaller last batch"""
+        self.assertEqual(list(batch_items(range(7), 3)), [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(list(batch_items([], 3)), [])
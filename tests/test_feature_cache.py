@@ -0,0 +1,130 @@
+"""
+Tests for the persistent feature stores, using a small randomly initialised CLIP model
+"""
+
+import io
+import os
+import sys
+import tempfile
+import unittest
+import torch
+from PIL import Image
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from src.feature_cache import TextFeatureCache, ImageEmbeddingStore, stored_clip_model, stored_clip_model_batch
+from src.clip_set_up import clip_model, clip_model_batch, clip_model_fingerprint
+from src.image_cache import ImageCache, get_default_image_cache, set_default_image_cache
+from tests.test_clip_set_up import small_clip_model_processor
+
+
+class TestFeatureCache(unittest.TestCase):
+    def setUp(self):
+        self.model, self.processor = small_clip_model_processor()
+        self.fingerprint = clip_model_fingerprint(self.model)
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.sentences = ["The doctor and his patient", "The doctor and her patient", "The doctor and their patient"]
+        self.image_inputs = [self.processor(Image.new("RGB", (320, 240), (40 * i, 100, 255 - 40 * i))).unsqueeze(0) for i in range(3)]
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_text_feature_cache(self):
+        """Tests that sentences are encoded once, normalized, and reloaded from disk"""
+        text_cache = TextFeatureCache("small_clip", self.fingerprint, self.cache_dir.name)
+        text_cache.fill(self.sentences + self.sentences, self.model)
+        self.assertEqual(text_cache.num_encoded, 3)
+        text_cache.fill(self.sentences, self.model)
+        self.assertEqual(text_cache.num_encoded, 3)
+
+        text_features = text_cache.get(self.sentences)
+        self.assertEqual(tuple(text_features.shape), (3, 64))
+        self.assertTrue(torch.allclose(text_features.norm(dim=-1), torch.ones(3), atol=1e-5))
+
+        text_cache.save()
+        reloaded_cache = TextFeatureCache("small_clip", self.fingerprint, self.cache_dir.name)
+        self.assertEqual(len(reloaded_cache), 3)
+        self.assertTrue(torch.equal(reloaded_cache.get(self.sentences), text_features))
+        self.assertNotIn("The baker and his customer", reloaded_cache)
+
+        # features saved for other weights are not loaded
+        other_cache = TextFeatureCache("small_clip", "other_weights", self.cache_dir.name)
+        self.assertEqual(len(other_cache), 0)
+        os.replace(text_cache.filepath, other_cache.filepath)
+        with self.assertWarns(UserWarning):
+            self.assertEqual(len(TextFeatureCache("small_clip", "other_weights", self.cache_dir.name)), 0)
+
+    def test_clip_model_batch_with_text_cache(self):
+        """Tests that scoring with cached text features matches scoring without the cache"""
+        text_cache = TextFeatureCache("small_clip", self.fingerprint, self.cache_dir.name)
+        pairs = [(image_input, self.sentences) for image_input in self.image_inputs]
+        expected = clip_model_batch(pairs, self.model)
+        cached = clip_model_batch(pairs, self.model, text_cache=text_cache)
+        for similarities, expected_similarities in zip(cached, expected):
+            for value, expected_value in zip(similarities, expected_similarities):
+                self.assertAlmostEqual(value, expected_value, places=5)
+
+    def test_image_embedding_store_repeated_urls(self):
+        """Tests that a URL repeated within one add is stored once, and every URL keeps its own row"""
+        image_store = ImageEmbeddingStore("small_clip", self.fingerprint, self.cache_dir.name)
+        image_features = torch.eye(4)[:3] + 0.1
+        image_store.add(["a", "a", "b"], image_features)
+        image_store.add(["c", "b"], torch.eye(4)[2:4])
+        self.assertEqual(len(image_store), 3)
+        self.assertEqual(sorted(image_store.index.values()), [0, 1, 2])
+        stored = image_store.get(["a", "b", "c"])
+        expected = torch.stack([image_features[0], image_features[2], torch.eye(4)[2]])
+        self.assertTrue(torch.allclose(stored, expected / expected.norm(dim=-1, keepdim=True), atol=1e-6))
+
+    def test_image_embedding_store(self):
+        """Tests that images are encoded once, read back from the memory-mapped store, and scored with dot products only"""
+        urls = [f"https://example.com/image_{i}.png" for i in range(3)] + ["https://example.com/broken.png"]
+        image_cache = ImageCache(os.path.join(self.cache_dir.name, "images"), offline=True)
+        for i, url in enumerate(urls[:3]):
+            buffer = io.BytesIO()
+            Image.new("RGB", (320, 240), (40 * i, 100, 255 - 40 * i)).save(buffer, format="PNG")
+            image_cache.put(url, buffer.getvalue())
+        image_cache.put(urls[3], b"not an image")
+
+        default_image_cache = get_default_image_cache()
+        set_default_image_cache(image_cache)
+        try:
+            image_store = ImageEmbeddingStore("small_clip", self.fingerprint, self.cache_dir.name)
+            failed_urls = image_store.fill(urls + urls[:1], self.model, self.processor, batch_size=2, num_workers=2)
+            self.assertEqual(failed_urls, {urls[3]})
+            self.assertEqual(image_store.num_encoded, 3)
+            self.assertEqual(image_store.fill(urls[:3], self.model, self.processor), set())
+            self.assertEqual(image_store.num_encoded, 3)
+
+            # sharded across forked processes, the embeddings match the single-process ones
+            sharded_store = ImageEmbeddingStore("small_clip_sharded", self.fingerprint, self.cache_dir.name)
+            self.assertEqual(sharded_store.fill(urls, self.model, self.processor, batch_size=2, num_workers=2, num_processes=2), {urls[3]})
+            self.assertEqual(sharded_store.num_encoded, 3)
+            self.assertTrue(torch.allclose(sharded_store.get(urls[:3]), image_store.get(urls[:3]), atol=1e-5))
+        finally:
+            set_default_image_cache(default_image_cache)
+
+        reloaded_store = ImageEmbeddingStore("small_clip", self.fingerprint, self.cache_dir.name)
+        self.assertEqual(len(reloaded_store), 3)
+        self.assertIn(urls[0], reloaded_store)
+        self.assertNotIn(urls[3], reloaded_store)
+        self.assertEqual(len(ImageEmbeddingStore("small_clip", "other_weights", self.cache_dir.name)), 0)
+        image_features = reloaded_store.get(urls[:3])
+        self.assertEqual(tuple(image_features.shape), (3, 64))
+        self.assertTrue(torch.allclose(image_features.norm(dim=-1), torch.ones(3), atol=1e-5))
+
+        text_cache = TextFeatureCache("small_clip", self.fingerprint, self.cache_dir.name)
+        text_cache.fill(self.sentences, self.model)
+
+        # resolution: one image against a caption set
+        stored_similarities = stored_clip_model_batch([(url, self.sentences) for url in urls[:3]], reloaded_store, text_cache)
+        expected = clip_model_batch([(image_input, self.sentences) for image_input in self.image_inputs], self.model)
+        for similarities, expected_similarities in zip(stored_similarities, expected):
+            for value, expected_value in zip(similarities, expected_similarities):
+                self.assertAlmostEqual(value, expected_value, places=5)
+
+        # retrieval: several images against one caption
+        stored_similarities = stored_clip_model(self.sentences[2:], urls[:3], reloaded_store, text_cache)
+        expected = clip_model(self.sentences[2:], urls[:3], self.model, self.processor, image_inputs=self.image_inputs)
+        for value, expected_value in zip(stored_similarities, expected):
+            self.assertAlmostEqual(value, expected_value, places=5)
@@ -0,0 +1,148 @@
+"""
+Tests for the shared fetch layer, run against a local stand-in HTTP server
+"""
+
+import os
+import sys
+import time
+import threading
+import unittest
+import requests
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from src.fetch_utils import Fetcher
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves /ok, /nohead (HEAD not allowed), /flaky (503 for the first two requests), /slow (trickles the body), /hang (waits before the headers) and /concurrent (counts parallel requests)"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        if self.path == "/nohead":
+            self.send_response(405)
+        elif self.path in ("/ok", "/flaky", "/slow", "/hang", "/concurrent"):
+            self.send_response(200)
+        else:
+            self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        if self.path in ("/ok", "/nohead"):
+            self.send_body(200, b"image bytes")
+        elif self.path == "/flaky":
+            with server.lock:
+                server.flaky_count += 1
+                count = server.flaky_count
+            self.send_body(503 if count <= 2 else 200, b"flaky")
+        elif self.path == "/slow":
+            self.send_response(200)
+            self.send_header("Content-Length", str(64 * 1024 * 20))
+            self.end_headers()
+            for _ in range(20):
+                self.wfile.write(b"x" * 64 * 1024)
+                self.wfile.flush()
+                time.sleep(0.1)
+        elif self.path == "/hang":
+            time.sleep(1)
+            self.send_body(200, b"late")
+        elif self.path == "/concurrent":
+            with server.lock:
+                server.active += 1
+                server.max_active = max(server.max_active, server.active)
+            time.sleep(0.05)
+            with server.lock:
+                server.active -= 1
+            self.send_body(200, b"done")
+        else:
+            self.send_body(404, b"not found")
+
+
+class TestFetchUtils(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.server.lock = threading.Lock()
+        self.server.flaky_count = 0
+        self.server.active = 0
+        self.server.max_active = 0
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch(self):
+        """Tests that the body is downloaded and connections are reused within a thread"""
+        fetcher = Fetcher(backoff_factor=0)
+        response = fetcher.fetch(f"{self.base_url}/ok")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"image bytes")
+        self.assertIs(fetcher.session(), fetcher.session())
+
+        self.assertEqual(fetcher.fetch(f"{self.base_url}/ok", method="HEAD").status_code, 200)
+        self.assertEqual(fetcher.fetch(f"{self.base_url}/missing").status_code, 404)
+
+    def test_retries(self):
+        """Tests that retryable status codes are retried, and the last response is returned once retries run out"""
+        fetcher = Fetcher(retries=3, backoff_factor=0)
+        response = fetcher.fetch(f"{self.base_url}/flaky")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.flaky_count, 3)
+
+        self.server.flaky_count = 0
+        fetcher = Fetcher(retries=1, backoff_factor=0)
+        self.assertEqual(fetcher.fetch(f"{self.base_url}/flaky").status_code, 503)
+
+    def test_total_timeout(self):
+        """Tests that a slowly trickled body is abandoned after the hard deadline"""
+        fetcher = Fetcher(total_timeout=0.3, backoff_factor=0)
+        with self.assertRaises(requests.exceptions.Timeout):
+            fetcher.fetch(f"{self.base_url}/slow")
+
+    def test_total_timeout_attempts(self):
+        """Tests that the deadline starts before the request, covering the wait for the headers and the retries"""
+        fetcher = Fetcher(total_timeout=0.3, backoff_factor=0)
+        start = time.monotonic()
+        with self.assertRaises(requests.exceptions.Timeout):
+            fetcher.fetch(f"{self.base_url}/hang")
+        self.assertLess(time.monotonic() - start, 0.9)
+
+        fetcher = Fetcher(total_timeout=0.3, retries=3, backoff_factor=10)
+        start = time.monotonic()
+        with self.assertRaises(requests.exceptions.Timeout):
+            fetcher.fetch(f"{self.base_url}/flaky")
+        self.assertLess(time.monotonic() - start, 0.9)
+        self.assertEqual(self.server.flaky_count, 1)
+
+    def test_max_per_host(self):
+        """Tests that concurrent requests to the same host are capped"""
+        fetcher = Fetcher(max_per_host=2, backoff_factor=0)
+        threads = [threading.Thread(target=fetcher.fetch, args=(f"{self.base_url}/concurrent",)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(self.server.max_active, 2)
+        self.assertGreaterEqual(self.server.max_active, 1)
+
+    def test_rate_per_host(self):
+        """Tests that requests to the same host are spaced out by the rate limit"""
+        fetcher = Fetcher(rate_per_host=20, backoff_factor=0)
+        start = time.monotonic()
+        for _ in range(5):
+            fetcher.fetch(f"{self.base_url}/ok")
+        self.assertGreaterEqual(time.monotonic() - start, 4 / 20)
@@ -0,0 +1,84 @@
+"""
+Tests for the on-disk image cache
+"""
+
+import io
+import os
+import sys
+import time
+import tempfile
+import unittest
+from PIL import Image
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from src.image_cache import ImageCache
+from src.data_utils import get_image
+
+
+class TestImageCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.url = "https://example.com/image.jpg"
+        buffer = io.BytesIO()
+        Image.new("RGB", (4, 4), color=(255, 0, 0)).save(buffer, format="PNG")
+        self.image_bytes = buffer.getvalue()
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_put_and_get(self):
+        """Tests that cached bytes are returned under the URL hash and misses return None"""
+        cache = ImageCache(self.cache_dir.name)
+        self.assertIsNone(cache.get(self.url))
+
+        cache.put(self.url, self.image_bytes)
+        self.assertEqual(cache.get(self.url), self.image_bytes)
+        self.assertTrue(os.path.basename(cache.path(self.url)).startswith(ImageCache.url_key(self.url)))
+        self.assertFalse([f for f in os.listdir(self.cache_dir.name) if f.endswith(".tmp")])
+
+    def test_lru_eviction(self):
+        """Tests that the least recently used images are evicted once the size cap is exceeded"""
+        cache = ImageCache(self.cache_dir.name, max_bytes=25)
+        cache.put("url_1", b"1" * 10)
+        cache.put("url_2", b"2" * 10)
+        past = time.time() - 100
+        os.utime(cache.path("url_1"), (past, past))
+        os.utime(cache.path("url_2"), (past + 1, past + 1))
+
+        # reading url_1 makes url_2 the least recently used image
+        cache.get("url_1")
+        cache.put("url_3", b"3" * 10)
+
+        self.assertIsNotNone(cache.get("url_1"))
+        self.assertIsNone(cache.get("url_2"))
+        self.assertIsNotNone(cache.get("url_3"))
+        self.assertLessEqual(cache.size_bytes(), 25)
+
+    def test_running_size(self):
+        """Tests that the cache directory is only scanned on the first put and when the size cap is exceeded"""
+        cache = ImageCache(self.cache_dir.name, max_bytes=25)
+        scans = []
+        entries = cache.entries
+        cache.entries = lambda: scans.append(1) or entries()
+
+        cache.put("url_1", b"1" * 10)
+        cache.put("url_2", b"2" * 10)
+        # overwriting an image only counts the difference in size
+        cache.put("url_2", b"2" * 15)
+        self.assertEqual((len(scans), cache._size_bytes), (1, 25))
+        cache.put("url_3", b"3" * 5)
+        self.assertEqual(len(scans), 2)
+        self.assertEqual(cache._size_bytes, cache.size_bytes())
+        self.assertIsNone(cache.get("url_1"))
+
+    def test_get_image_offline(self):
+        """Tests that an offline cache serves cached images and never falls back to the network"""
+        cache = ImageCache(self.cache_dir.name, offline=True)
+        with self.assertRaises(FileNotFoundError):
+            get_image(self.url, cache=cache)
+
+        cache.put(self.url, self.image_bytes)
+        image = get_image(self.url, cache=cache)
+        self.assertEqual(image.size, (4, 4))
+        self.assertEqual(image.mode, "RGB")
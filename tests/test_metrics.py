@@ -0,0 +1,94 @@
+"""
+Tests for the retrieval bias metrics, comparing the vectorized implementation with the reference loop over every k
+"""
+
+import os
+import sys
+import unittest
+import numpy as np
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from src.metrics import calculate_retrieval_bias, _calculate_retrieval_bias_loop, _gallery_labels, legacy_gender_count
+
+
+def synthetic_retrieval_results(num_occupations: int, gallery_size: int, seed: int = 0, genders: list = ("masculine", "feminine"),
+                                with_participants: bool = False) -> dict:
+    """
+    Returns raw retrieval results with random logits, rounded so that some of them are tied, and random genders. Without
+    participants, the galleries are in the legacy layout of results saved without the participant genders
+    """
+    rng = np.random.default_rng(seed)
+    results = {}
+    for occupation_idx in range(num_occupations):
+        results[f"occupation_{occupation_idx}"] = {"error": False, "occ_genders": rng.choice(genders, gallery_size).tolist(),
+                                                   "logits_list": np.round(rng.random(gallery_size), 1).tolist()}
+        if with_participants:
+            results[f"occupation_{occupation_idx}"]["par"] = "patient"
+            results[f"occupation_{occupation_idx}"]["par_genders"] = rng.choice(genders, gallery_size).tolist()
+    # one gallery of a single gender
+    results["occupation_0"]["occ_genders"] = ["feminine"] * gallery_size
+    results["occupation_error"] = {"error": True}
+    return results
+
+
+class TestMetrics(unittest.TestCase):
+    def assert_bias_equal(self, bias, expected_bias):
+        self.assertEqual(list(bias), list(expected_bias))
+        for occupation in expected_bias:
+            self.assertEqual(list(bias[occupation]), list(expected_bias[occupation]))
+            for metric, expected_value in expected_bias[occupation].items():
+                if isinstance(expected_value, dict):
+                    self.assertEqual(set(bias[occupation][metric]), set(expected_value))
+                    for gender in expected_value:
+                        self.assertAlmostEqual(bias[occupation][metric][gender], expected_value[gender], places=12)
+                else:
+                    self.assertAlmostEqual(bias[occupation][metric], expected_value, places=12)
+
+    def test_calculate_retrieval_bias(self):
+        """Tests that the vectorized metrics match the reference loop, including ties and the diff gender layout"""
+        results = synthetic_retrieval_results(8, 20)
+        for diff_gender in [False, True]:
+            bias = calculate_retrieval_bias(results, diff_gender=diff_gender)
+            self.assertNotIn("occupation_error", bias)
+            self.assertIn("bias_count@20", bias["occupation_1"])
+            self.assert_bias_equal(bias, _calculate_retrieval_bias_loop(results, diff_gender=diff_gender))
+
+    def test_calculate_retrieval_bias_gallery_sizes(self):
+        """Tests galleries of different sizes and more than two gender groups in the same results"""
+        results = {**synthetic_retrieval_results(3, 12, seed=1, genders=["masculine", "feminine", "neutral"], with_participants=True),
+                   **{f"large_{occupation}": result for occupation, result in synthetic_retrieval_results(3, 50, seed=2, with_participants=True).items()}}
+        for diff_gender in [False, True]:
+            bias = calculate_retrieval_bias(results, diff_gender=diff_gender)
+            self.assertIn("bias_count@12", bias["occupation_1"])
+            self.assertIn("bias_count@50", bias["large_occupation_1"])
+            self.assert_bias_equal(bias, _calculate_retrieval_bias_loop(results, diff_gender=diff_gender))
+        self.assertEqual(len(calculate_retrieval_bias(results)["occupation_1"]["skew@12"]), 3)
+
+    def test_calculate_retrieval_bias_ks(self):
+        """Tests that only the requested k are computed, with the same values as for every k"""
+        results = synthetic_retrieval_results(4, 30, seed=3, with_participants=True)
+        all_bias = calculate_retrieval_bias(results)
+        bias = calculate_retrieval_bias(results, ks=[10, 5, 100])
+        for occupation in all_bias:
+            self.assertEqual(list(bias[occupation]), [f"{metric}@{k}" for k in [5, 10] for metric in ["skew", "maxskew", "minskew", "bias", "bias_count"]] + ["ndkl"])
+            for metric, value in bias[occupation].items():
+                self.assertEqual(value, all_bias[occupation][metric])
+        self.assertEqual(calculate_retrieval_bias(results, ks=[100])["occupation_1"], {"ndkl": all_bias["occupation_1"]["ndkl"]})
+
+    def test_gallery_labels(self):
+        """Tests that groups and gender counts are derived from the per-image genders, and the legacy layout fallback"""
+        result = {"occ_genders": ["masculine", "masculine", "feminine"], "par_genders": ["masculine", "feminine", "feminine"]}
+        self.assertEqual(_gallery_labels(result), (result["occ_genders"], [1, 0, -1]))
+        self.assertEqual(_gallery_labels(result, diff_gender=True), (["same", "diff", "same"], [1, 0, -1]))
+
+        result = {"occ_genders": ["masculine", "feminine"], "obj": "stethoscope"}
+        self.assertEqual(_gallery_labels(result), (result["occ_genders"], [1, -1]))
+        with self.assertRaises(ValueError):
+            _gallery_labels(result, diff_gender=True)
+
+        legacy_result = {"occ_genders": ["masculine"] * 10 + ["feminine"] * 10}
+        self.assertEqual(_gallery_labels(legacy_result), (legacy_result["occ_genders"], legacy_gender_count))
+        self.assertEqual(_gallery_labels({"occ_genders": ["masculine"] * 3}), (["masculine"] * 3, None))
+        with self.assertRaises(ValueError):
+            _gallery_labels({"occ_genders": ["masculine"] * 3}, diff_gender=True)
@@ -0,0 +1,55 @@
+"""
+Tests for the process wide model registry, using stand-in loaders so that no weights are downloaded
+"""
+
+import os
+import sys
+import unittest
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from src.model_registry import ModelRegistry
+
+
+class TestModelRegistry(unittest.TestCase):
+    def setUp(self):
+        self.loads = []
+        self.registry = ModelRegistry(max_models=2)
+        for model_name in ["model_a", "model_b", "model_c"]:
+            self.registry.register(model_name, self.loader(model_name))
+
+    def loader(self, model_name: str):
+        def load(device, precision, **options):
+            self.loads.append((model_name, device, precision))
+            return object(), f"{model_name} processor"
+        return load
+
+    def test_get_loads_once(self):
+        """Tests that a model is loaded lazily, once per (model, device, precision), and the same instance is handed out"""
+        self.assertEqual(self.loads, [])
+        model, processor = self.registry.get("model_a", "cpu")
+        self.assertEqual(processor, "model_a processor")
+        self.assertIs(self.registry.get("model_a", "cpu")[0], model)
+        self.assertEqual(self.loads, [("model_a", "cpu", None)])
+
+        self.assertIsNot(self.registry.get("model_a", "cpu", "int8")[0], model)
+        self.assertEqual(len(self.loads), 2)
+
+        with self.assertRaises(ValueError):
+            self.registry.get("unknown_model", "cpu")
+
+    def test_evict(self):
+        """Tests explicit eviction, and that the least recently used model is evicted once max_models are loaded"""
+        self.registry.get("model_a", "cpu")
+        self.registry.get("model_b", "cpu")
+        self.registry.get("model_a", "cpu")
+        self.registry.get("model_c", "cpu")
+        self.assertEqual([key[0] for key in self.registry.loaded()], ["model_a", "model_c"])
+
+        self.assertEqual(self.registry.evict("model_a"), 1)
+        self.assertEqual([key[0] for key in self.registry.loaded()], ["model_c"])
+        self.registry.get("model_a", "cpu")
+        self.assertEqual(self.loads.count(("model_a", "cpu", None)), 2)
+
+        self.assertEqual(self.registry.evict(), 2)
+        self.assertEqual(self.registry.loaded(), [])
@@ -0,0 +1,70 @@
+"""
+Tests for the local model snapshots, using small randomly initialised CLIP, BLIP and BLIP-2 models
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+import torch
+from PIL import Image
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from src.model_snapshots import save_model_snapshot, load_model_snapshot, load_safetensors_mmap, has_model_snapshot, measure_cold_start
+from src.clip_set_up import clip_encode_images, clip_encode_texts
+from src.captioning_set_up import BlipPronounScorer
+from tests.test_clip_set_up import small_clip_model_processor
+from tests.test_captioning_set_up import small_blip_processors, small_blip_models
+
+
+class TestModelSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.snapshot_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.snapshot_dir.cleanup()
+
+    def test_clip_snapshot(self):
+        """Tests that a CLIP model rebuilt from its snapshot gives the same features, with memory-mapped weights"""
+        model, processor = small_clip_model_processor()
+        self.assertFalse(has_model_snapshot("small_clip", self.snapshot_dir.name))
+        save_model_snapshot("small_clip", model, processor, self.snapshot_dir.name)
+        self.assertTrue(has_model_snapshot("small_clip", self.snapshot_dir.name))
+
+        snapshot_model, snapshot_processor = load_model_snapshot("small_clip", "cpu", self.snapshot_dir.name)
+        image_inputs = [snapshot_processor(Image.new("RGB", (320, 240), (40, 100, 215))).unsqueeze(0)]
+        self.assertTrue(torch.equal(clip_encode_images(image_inputs, snapshot_model), clip_encode_images(image_inputs, model)))
+        self.assertTrue(torch.equal(clip_encode_texts(["The doctor and his patient"], snapshot_model), clip_encode_texts(["The doctor and his patient"], model)))
+
+        weights = load_safetensors_mmap(os.path.join(self.snapshot_dir.name, "small_clip", "model.safetensors"))
+        self.assertEqual(set(weights), set(model.state_dict()))
+        self.assertEqual(weights["visual.conv1.weight"].untyped_storage().nbytes(), os.path.getsize(os.path.join(self.snapshot_dir.name, "small_clip", "model.safetensors")))
+
+        with self.assertRaises(FileNotFoundError):
+            load_model_snapshot("missing_model", "cpu", self.snapshot_dir.name)
+
+    def test_captioning_snapshots(self):
+        """Tests that BLIP and BLIP-2 rebuilt from their snapshots, with the tied weights of BLIP-2, give the same logits"""
+        blip_processor, blipv2_processor = small_blip_processors(self.snapshot_dir.name)
+        blip_model, blipv2_model = small_blip_models()
+        raw_image = Image.new("RGB", (320, 240), (40, 100, 215))
+
+        for model_name, model, processor in [("small_blip", blip_model, blip_processor), ("small_blipv2", blipv2_model, blipv2_processor)]:
+            save_model_snapshot(model_name, model, processor, self.snapshot_dir.name)
+            snapshot_model, snapshot_processor = load_model_snapshot(model_name, "cpu", self.snapshot_dir.name)
+            self.assertIs(type(snapshot_model), type(model))
+            self.assertIs(type(snapshot_processor), type(processor))
+            self.assertEqual(BlipPronounScorer(snapshot_model, snapshot_processor, device="cpu").score(raw_image, ["the doctor and"]),
+                             BlipPronounScorer(model, processor, device="cpu").score(raw_image, ["the doctor and"]))
+
+        self.assertIs(snapshot_model.language_model.lm_head.weight, snapshot_model.language_model.model.decoder.embed_tokens.weight)
+
+    def test_measure_cold_start(self):
+        """Tests that the cold start of a snapshot is measured in a fresh process"""
+        model, processor = small_clip_model_processor()
+        save_model_snapshot("small_clip", model, processor, self.snapshot_dir.name)
+        cold_start = measure_cold_start("small_clip", "snapshot", "cpu", self.snapshot_dir.name)
+        self.assertEqual(cold_start["num_parameters"], sum(param.numel() for param in model.parameters()))
+        self.assertGreater(cold_start["seconds"], 0)
+        self.assertGreaterEqual(cold_start["peak_rss_bytes"], cold_start["baseline_rss_bytes"])
@@ -0,0 +1,40 @@
+"""
+Tests for sharding the evaluation across forked worker processes
+"""
+
+import os
+import sys
+import unittest
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from src.parallel_utils import shard_items, fork_map
+
+
+class TestParallelUtils(unittest.TestCase):
+    def test_shard_items(self):
+        """Tests that every item is in exactly one shard"""
+        items = list(range(10))
+        shards = [shard_items(items, shard_idx, 3) for shard_idx in range(3)]
+        self.assertEqual(shards[0], [0, 3, 6, 9])
+        self.assertEqual(sorted(item for shard in shards for item in shard), items)
+        self.assertEqual(shard_items(items, 0, 1), items)
+
+    def test_fork_map(self):
+        """Tests that the shard results are returned in shard order, and inline with a single worker"""
+        pid = os.getpid()
+        items = list(range(10))
+        shard_fn = lambda shard_idx, num_shards: (shard_items(items, shard_idx, num_shards), os.getpid() != pid)
+
+        self.assertEqual(fork_map(shard_fn, 1), [(items, False)])
+        self.assertEqual(fork_map(shard_fn, 3), [(shard_items(items, shard_idx, 3), True) for shard_idx in range(3)])
+
+    def test_fork_map_worker_error(self):
+        """Tests that a failing worker raises in the parent"""
+        def shard_fn(shard_idx, num_shards):
+            if shard_idx == 1:
+                raise ValueError("shard failed")
+            return shard_idx
+
+        with self.assertRaisesRegex(RuntimeError, "shard failed"):
+            fork_map(shard_fn, 2)
@@ -0,0 +1,74 @@
+"""
+Tests for the permutation tests of the retrieval bias metrics, on synthetic results
+"""
+
+import os
+import sys
+import time
+import unittest
+import numpy as np
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from src.permutation_utils import permutation_statistics, retrieval_permutation_test
+from src.bootstrap_utils import bootstrap_samples
+from src.metrics import calculate_retrieval_bias
+from tests.test_metrics import synthetic_retrieval_results
+
+
+class TestPermutationUtils(unittest.TestCase):
+    metrics = ["bias@5", "bias@10", "maxskew@10", "bias_count@10", "ndkl"]
+
+    def test_permutation_statistics(self):
+        """Tests that the statistics of the model ranking are calculate_retrieval_bias, and the null samples do not depend on the number of processes"""
+        results = synthetic_retrieval_results(5, 20, with_participants=True)
+        statistic_fn = permutation_statistics(results, self.metrics)
+        bias = calculate_retrieval_bias(results)
+        for (occupation, metric), value in statistic_fn(None, 1).items():
+            self.assertAlmostEqual(value[0], bias[occupation][metric], places=12)
+
+        samples = bootstrap_samples(statistic_fn, num_resamples=300, seed=1, block_size=100)
+        forked_samples = bootstrap_samples(statistic_fn, num_resamples=300, seed=1, num_processes=2, block_size=100)
+        for name in samples:
+            self.assertEqual(samples[name].shape, (300,))
+            np.testing.assert_array_equal(samples[name], forked_samples[name])
+
+    def test_retrieval_permutation_test(self):
+        """Tests that a gallery ranked by gender is significant and a random ranking is not"""
+        results = synthetic_retrieval_results(2, 20, seed=4, with_participants=True)
+        gallery = results["occupation_1"]
+        gallery["occ_genders"] = ["masculine"] * 10 + ["feminine"] * 10
+        gallery["logits_list"] = np.linspace(1, 0, 20).tolist()
+        results["occupation_random"] = {**gallery, "logits_list": np.random.default_rng(0).permutation(gallery["logits_list"]).tolist()}
+
+        permutation_tests = retrieval_permutation_test(results, self.metrics, num_permutations=2000)
+        self.assertEqual(set(permutation_tests), {"occupation_0", "occupation_1", "occupation_random"})
+        for metric in ["bias@10", "maxskew@10", "ndkl"]:
+            self.assertLess(permutation_tests["occupation_1"][metric]["p_value"], 0.01)
+        self.assertEqual(permutation_tests["occupation_1"]["bias@10"]["value"], 1.0)
+        self.assertAlmostEqual(permutation_tests["occupation_1"]["bias@10"]["null_mean"], 0, delta=0.05)
+        self.assertGreater(permutation_tests["occupation_random"]["bias@10"]["p_value"], 0.05)
+
+    def test_retrieval_permutation_test_unbalanced(self):
+        """Tests that two-sided p-values are centred on the null mean of a gallery with more masculine than feminine images"""
+        results = synthetic_retrieval_results(1, 20, with_participants=True)
+        gallery = {**results["occupation_0"], "occ_genders": ["masculine"] * 14 + ["feminine"] * 6}
+        # every feminine image in the top 10, and a top 10 in the proportions of the gallery
+        results = {"occupation_feminine_top": {**gallery, "logits_list": [0.5] * 4 + [0.1] * 10 + [1.0] * 6},
+                   "occupation_proportional": {**gallery, "logits_list": [1.0] * 7 + [0.1] * 7 + [1.0] * 3 + [0.1] * 3}}
+
+        permutation_tests = retrieval_permutation_test(results, ["bias@10"], num_permutations=5000)
+        feminine_top = permutation_tests["occupation_feminine_top"]["bias@10"]
+        self.assertAlmostEqual(feminine_top["value"], -0.2)
+        self.assertAlmostEqual(feminine_top["null_mean"], 0.4, delta=0.05)
+        self.assertLess(feminine_top["p_value"], 0.05)
+        proportional = permutation_tests["occupation_proportional"]["bias@10"]
+        self.assertAlmostEqual(proportional["value"], 0.4)
+        self.assertGreater(proportional["p_value"], 0.5)
+
+    def test_retrieval_permutation_test_speed(self):
+        """Tests that 10k permutations of 23 occupations are computed in seconds"""
+        results = synthetic_retrieval_results(23, 20, with_participants=True)
+        start = time.perf_counter()
+        retrieval_permutation_test(results, ["bias@5", "bias@10", "maxskew@5", "maxskew@10", "ndkl"], num_permutations=10000)
+        self.assertLess(time.perf_counter() - start, 30)
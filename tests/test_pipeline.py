@@ -0,0 +1,124 @@
+"""
+Tests for the content hash keyed analysis pipeline, on stages that copy and count the lines of files
+"""
+
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from src.pipeline import Pipeline, file_content_hash
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.paths = {name: os.path.join(self.tmp_dir.name, name) for name in ["raw.txt", "preliminary.txt", "benchmark.json", "state.json"]}
+        with open(self.paths["raw.txt"], "w") as f:
+            f.write("a\nb\n")
+        self.num_runs = {"preliminary": 0, "benchmark": 0}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def pipeline(self, suffix: str = "!") -> Pipeline:
+        def preliminary():
+            self.num_runs["preliminary"] += 1
+            with open(self.paths["raw.txt"]) as f, open(self.paths["preliminary.txt"], "w") as g:
+                g.write("".join(line.strip() + suffix + "\n" for line in f))
+
+        def benchmark():
+            self.num_runs["benchmark"] += 1
+            with open(self.paths["preliminary.txt"]) as f, open(self.paths["benchmark.json"], "w") as g:
+                json.dump({"num_lines": len(f.readlines())}, g)
+
+        pipeline = Pipeline(self.paths["state.json"])
+        # added before the stage writing its input
+        pipeline.add("benchmark", benchmark, inputs=[self.paths["preliminary.txt"]], outputs=[self.paths["benchmark.json"]])
+        pipeline.add("preliminary", preliminary, inputs=[self.paths["raw.txt"]], outputs=[self.paths["preliminary.txt"]], params={"suffix": suffix})
+        return pipeline
+
+    def test_run(self):
+        """Tests that stages run in dependency order, and only again when the content of their inputs or their parameters change"""
+        report = self.pipeline().run()
+        self.assertEqual(list(report), ["preliminary", "benchmark"])
+        self.assertEqual([stage["status"] for stage in report.values()], ["ran", "ran"])
+        with open(self.paths["state.json"]) as f:
+            self.assertGreaterEqual(json.load(f)["stages"]["benchmark"]["seconds"], 0)
+
+        self.assertEqual({stage["status"] for stage in self.pipeline().run().values()}, {"up to date"})
+        os.utime(self.paths["raw.txt"], ns=(0, 0))
+        self.assertEqual({stage["status"] for stage in self.pipeline().run().values()}, {"up to date"})
+
+        self.assertEqual([stage["status"] for stage in self.pipeline(suffix="?").run().values()], ["ran", "ran"])
+        # rewriting an output with the same content does not make the next stages stale
+        with open(self.paths["preliminary.txt"]) as f:
+            preliminary = f.read()
+        with open(self.paths["preliminary.txt"], "w") as f:
+            f.write(preliminary)
+        self.assertEqual({stage["status"] for stage in self.pipeline(suffix="?").run().values()}, {"up to date"})
+        with open(self.paths["raw.txt"], "a") as f:
+            f.write("c\n")
+        self.assertEqual([stage["status"] for stage in self.pipeline(suffix="?").run().values()], ["ran", "ran"])
+        self.assertEqual(self.num_runs, {"preliminary": 3, "benchmark": 3})
+
+        os.remove(self.paths["benchmark.json"])
+        self.assertEqual([stage["status"] for stage in self.pipeline(suffix="?").run().values()], ["up to date", "ran"])
+        self.assertEqual([stage["status"] for stage in self.pipeline(suffix="?").run(force=True).values()], ["ran", "ran"])
+
+    def test_missing_inputs(self):
+        """Tests that missing inputs are only an error when the outputs are missing too"""
+        with self.assertRaises(FileNotFoundError):
+            os.remove(self.paths["raw.txt"])
+            self.pipeline().run()
+
+        with open(self.paths["preliminary.txt"], "w") as f:
+            f.write("a!\n")
+        report = self.pipeline().run()
+        self.assertEqual([stage["status"] for stage in report.values()], ["inputs missing", "ran"])
+
+    def test_in_place_outputs(self):
+        """Tests that a stage reading its own output runs before the output exists, and again only when it is edited"""
+        def count_runs():
+            num_runs = 0
+            if os.path.exists(self.paths["benchmark.json"]):
+                with open(self.paths["benchmark.json"]) as f:
+                    num_runs = json.load(f)["num_runs"]
+            with open(self.paths["benchmark.json"], "w") as f:
+                json.dump({"num_runs": num_runs + 1}, f)
+
+        def pipeline():
+            pipeline = Pipeline(self.paths["state.json"])
+            pipeline.add("benchmark", count_runs, inputs=[self.paths["raw.txt"], self.paths["benchmark.json"]], outputs=[self.paths["benchmark.json"]])
+            return pipeline
+
+        self.assertEqual(pipeline().run()["benchmark"]["status"], "ran")
+        self.assertEqual(pipeline().run()["benchmark"]["status"], "up to date")
+        with open(self.paths["benchmark.json"], "w") as f:
+            json.dump({"num_runs": 10}, f)
+        self.assertEqual(pipeline().run()["benchmark"]["status"], "ran")
+        with open(self.paths["benchmark.json"]) as f:
+            self.assertEqual(json.load(f)["num_runs"], 11)
+
+    def test_cycle(self):
+        """Tests that a cycle of stages is an error"""
+        pipeline = Pipeline(self.paths["state.json"])
+        pipeline.add("a", lambda: None, inputs=[self.paths["raw.txt"]], outputs=[self.paths["preliminary.txt"]])
+        pipeline.add("b", lambda: None, inputs=[self.paths["preliminary.txt"]], outputs=[self.paths["raw.txt"]])
+        with self.assertRaises(ValueError):
+            pipeline.run()
+        with self.assertRaises(ValueError):
+            pipeline.add("a", lambda: None, inputs=[], outputs=[])
+
+    def test_file_content_hash(self):
+        """Tests that cached hashes are reused until the file changes"""
+        hash_cache = {}
+        content_hash = file_content_hash(self.paths["raw.txt"], hash_cache)
+        hash_cache[self.paths["raw.txt"]][2] = "cached"
+        self.assertEqual(file_content_hash(self.paths["raw.txt"], hash_cache), "cached")
+        with open(self.paths["raw.txt"], "a") as f:
+            f.write("c\n")
+        self.assertNotEqual(file_content_hash(self.paths["raw.txt"], hash_cache), content_hash)
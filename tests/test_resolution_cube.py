@@ -0,0 +1,73 @@
+"""
+Tests for the resolution accuracy cube, against the benchmark scores on synthetic results
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from src.resolution_cube import build_resolution_cube, roll_up, gender_gap, save_resolution_cube, load_resolution_cube
+from src.analysis_utils import single_person_res_acc, two_person_res_acc
+from tests.test_bootstrap_utils import synthetic_resolution_dataframes, empty_benchmark_dict
+
+
+def synthetic_preliminary_results() -> tuple:
+    """
+    Returns (OO, OP, concatenated) preliminary results of one model, with both template types for OP
+    """
+    oo_subset_df, op_subset_df = synthetic_resolution_dataframes()
+    metadata = {"experiment": "CLIP", "model_name": "clip", "sector": np.repeat(["education", "health"], 24), "specialisation": "general"}
+    oo_subset_df = oo_subset_df.assign(context="context_OO", **metadata)
+    op_subset_df = op_subset_df.assign(context="context_OP", match_truth_par_first=op_subset_df.match_truth_occ_first.to_numpy()[::-1], **metadata)
+    return oo_subset_df, op_subset_df, pd.concat([op_subset_df, oo_subset_df], ignore_index=True)
+
+
+class TestResolutionCube(unittest.TestCase):
+    def test_build_resolution_cube(self):
+        """Tests that every image of every template type is counted once"""
+        oo_subset_df, op_subset_df, results_df = synthetic_preliminary_results()
+        cube = build_resolution_cube(results_df)
+        self.assertEqual(cube.num_images.sum(), len(oo_subset_df) + 2 * len(op_subset_df))
+        self.assertEqual(cube.num_correct.sum(), oo_subset_df.match_truth_occ_first.sum() + 2 * op_subset_df.match_truth_occ_first.sum())
+        self.assertEqual(set(cube[cube.context == "context_OO"].pair), {"none"})
+        self.assertEqual(set(cube[cube.context == "context_OP"].pair), {"same", "diff"})
+
+        with self.assertRaises(ValueError):
+            build_resolution_cube(results_df.drop(columns=["match_truth_occ_first", "match_truth_par_first"]))
+
+    def test_gender_gap(self):
+        """Tests that the slices of the cube match the benchmark scores, up to their rounding"""
+        oo_subset_df, op_subset_df, results_df = synthetic_preliminary_results()
+        benchmark_dict = single_person_res_acc(oo_subset_df, empty_benchmark_dict(), "CLIP", "clip", "Context_OO")
+        benchmark_dict = two_person_res_acc(op_subset_df, benchmark_dict, "CLIP", "clip", "Context_OP")["resolution_bias"]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            save_resolution_cube(build_resolution_cube(results_df), os.path.join(tmp_dir, "cube.npz"))
+            cube = load_resolution_cube(os.path.join(tmp_dir, "cube.npz"))
+
+        slices = {"single_person_images": gender_gap(cube, [], context="context_OO").iloc[0],
+                  "two_person_images": gender_gap(cube, [], context="context_OP", template="occ_first").iloc[0]}
+        pairs = gender_gap(cube, ["pair"], context="context_OP", template="occ_first").set_index("pair")
+        slices["two_person_images_same_gender"], slices["two_person_images_diff_gender"] = pairs.loc["same"], pairs.loc["diff"]
+        for section, scores in slices.items():
+            for field in ["RA_avg", "gender_gap"]:
+                self.assertAlmostEqual(scores[field], benchmark_dict[section][field], delta=0.011)
+
+        by_occupation = gender_gap(cube, ["sector", "occ"], context="context_OP")
+        self.assertEqual(len(by_occupation), 6)
+        self.assertEqual(by_occupation.sector.tolist(), ["education"] * 3 + ["health"] * 3)
+        occupation_0 = op_subset_df[op_subset_df.occ == "occupation_0"]
+        self.assertAlmostEqual(roll_up(cube, [], context="context_OP", occ="occupation_0").accuracy[0],
+                               (occupation_0.match_truth_occ_first.sum() + occupation_0.match_truth_par_first.sum()) / (2 * len(occupation_0)))
+        with self.assertRaises(ValueError):
+            roll_up(cube, ["occupation"])
+
+        # par_first templates resolve the participant, so their gender gap is split by the participant gender
+        par_first = gender_gap(cube, [], context="context_OP", template="par_first").iloc[0]
+        for gender, field in [("masculine", "his_accuracy"), ("feminine", "her_accuracy")]:
+            self.assertAlmostEqual(par_first[field], op_subset_df[op_subset_df.par_gender == gender].match_truth_par_first.mean())
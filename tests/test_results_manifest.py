@@ -0,0 +1,87 @@
+"""
+Tests for the manifest of the results files and the loading of the files matching a query
+"""
+
+import os
+import sys
+import json
+import tempfile
+import unittest
+import pandas as pd
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from src.results_manifest import ResultsManifest
+from src.results_store import convert_json_to_npz
+from src.data_utils import load_full_dataframe
+from src.analysis_utils import get_subset_dataframe
+
+
+def save_preliminary_results(directory_path: str, file_desc: str, experiment: str, model_name: str, context: str, num_rows: int = 4):
+    """
+    Saves preliminary results with the fields of check_neutral_groundtruth_match
+    """
+    rows = {}
+    for row_idx in range(num_rows):
+        row = {"occ": "teacher", "occ_gender": ["masculine", "feminine"][row_idx % 2], "logits_list_occ_first": {"his": 0.5, "her": 0.25, "their": 0.25}}
+        if context == "context_OP":
+            row.update({"par": "student", "par_gender": "feminine", "logits_list_par_first": {"his": 0.25, "her": 0.5, "their": 0.25}})
+        rows[f"{context[-2:]}_{row_idx}"] = {**row, "match_truth_occ_first": row_idx % 2 == 0, "experiment": experiment, "model_name": model_name, "context": context}
+    filename = f"{file_desc}_Context{context[-2:]}_preliminary_results.json"
+    with open(os.path.join(directory_path, filename), "w") as f:
+        json.dump(rows, f)
+    return filename
+
+
+class TestResultsManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory_path = self.tmp_dir.name
+        for experiment, model_name in [("CLIP", "clip"), ("CAPTIONING", "blipv2"), ("CLIP", "openclip")]:
+            for context in ["context_OP", "context_OO"]:
+                save_preliminary_results(self.directory_path, f"{experiment.lower()}_{model_name}", experiment, model_name, context)
+        with open(os.path.join(self.directory_path, "notes.json"), "w") as f:
+            json.dump(["not", "results"], f)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_query(self):
+        """Tests that only the files of the query are returned, and files are only indexed again when they change"""
+        manifest = ResultsManifest(self.directory_path)
+        self.assertEqual(manifest.query(model_name="clip"), ["clip_clip_ContextOO_preliminary_results.json", "clip_clip_ContextOP_preliminary_results.json"])
+        self.assertEqual(manifest.query(experiment="CLIP", template="par_first"),
+                         ["clip_clip_ContextOP_preliminary_results.json", "clip_openclip_ContextOP_preliminary_results.json"])
+        self.assertEqual(len(manifest.query(model_name=["clip", "blipv2"], context="context_OO")), 2)
+        self.assertEqual(manifest.query(context="context_OP", model_name="blipv2"), ["captioning_blipv2_ContextOP_preliminary_results.json"])
+        self.assertEqual(len(manifest), 6)
+        self.assertEqual(manifest.num_indexed, 6)
+        with self.assertRaises(ValueError):
+            manifest.query(occupation="teacher")
+        with self.assertRaises(ValueError):
+            manifest.query(dataset_version="11012024")
+
+        # the saved manifest is reused, converted files are loaded from the NPZ
+        manifest = ResultsManifest(self.directory_path)
+        convert_json_to_npz(os.path.join(self.directory_path, "clip_clip_ContextOP_preliminary_results.json"))
+        self.assertEqual(manifest.query(model_name="clip"), ["clip_clip_ContextOO_preliminary_results.json", "clip_clip_ContextOP_preliminary_results.npz"])
+        self.assertEqual(manifest.num_indexed, 1)
+
+        # a JSON written after its NPZ is returned instead of the stale NPZ
+        npz_filepath = os.path.join(self.directory_path, "clip_clip_ContextOP_preliminary_results.npz")
+        os.utime(npz_filepath, ns=(os.stat(npz_filepath).st_atime_ns, os.stat(npz_filepath).st_mtime_ns - 10**9))
+        self.assertEqual(manifest.query(model_name="clip", context="context_OP"), ["clip_clip_ContextOP_preliminary_results.json"])
+        convert_json_to_npz(os.path.join(self.directory_path, "clip_clip_ContextOP_preliminary_results.json"))
+        os.remove(os.path.join(self.directory_path, "clip_clip_ContextOO_preliminary_results.json"))
+        self.assertEqual(manifest.query(model_name="clip"), ["clip_clip_ContextOP_preliminary_results.npz"])
+
+    def test_load(self):
+        """Tests that the rows of a query are those of the subset of the full dataframe"""
+        manifest = ResultsManifest(self.directory_path)
+        os.remove(os.path.join(self.directory_path, "notes.json"))
+        full_dataframe = load_full_dataframe(self.directory_path)
+        for context in ["context_OP", "context_OO"]:
+            subset_df = get_subset_dataframe(manifest.load(experiment="CLIP", model_name="clip"), context, "CLIP", "clip")
+            pd.testing.assert_frame_equal(subset_df, get_subset_dataframe(full_dataframe, context, "CLIP", "clip"))
+        self.assertEqual(len(manifest.load(model_name="clip", context="context_OP")), 4)
+        self.assertTrue(manifest.load(model_name="gpt").empty)
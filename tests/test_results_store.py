@@ -0,0 +1,65 @@
+"""
+Tests for the columnar NPZ storage of the resolution results
+"""
+
+import os
+import sys
+import json
+import tempfile
+import unittest
+import numpy as np
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from src.results_store import (results_dict_to_columns, columns_to_results_dict, load_results_columns, load_results_df, convert_json_to_npz,
+                               convert_npz_to_json)
+from src.data_utils import load_json_to_df
+
+
+class TestResultsStore(unittest.TestCase):
+    def setUp(self):
+        self.tests_dir = os.getcwd()
+        self.op_output_filepath = f"{self.tests_dir}/tests/test_data/test_model_outputs/Test_clip_clip_ContextOP.json"
+        self.prelim_filepath = f"{self.tests_dir}/tests/test_data/test_prelim_files/clip_clip_augmented_ContextOO.json"
+
+    def test_columns(self):
+        """Tests the kinds of columns, and that the results round trip up to the float32 precision of the logits"""
+        with open(self.prelim_filepath) as f:
+            results_dict = json.load(f)
+        columns = results_dict_to_columns(results_dict)
+        self.assertEqual(columns["logits_list_obj"].dtype, np.float32)
+        self.assertEqual(columns["logits_list_obj"].shape, (3, 3))
+        self.assertEqual(columns["logits_list_obj__keys"].tolist(), ["his", "her", "their"])
+        self.assertEqual(columns["occ_gender__categories"].tolist(), ["masculine"])
+        self.assertEqual(columns["match_truth_occ_first"].tolist(), [True, False, True])
+
+        round_trip = columns_to_results_dict(columns)
+        self.assertEqual(list(round_trip), list(results_dict))
+        for idx, row in results_dict.items():
+            self.assertEqual(list(round_trip[idx]), list(row))
+            for field, value in row.items():
+                if isinstance(value, dict):
+                    for pronoun, logit in value.items():
+                        self.assertAlmostEqual(round_trip[idx][field][pronoun], logit, places=5)
+                else:
+                    self.assertEqual(round_trip[idx][field], value)
+
+        with self.assertRaises(ValueError):
+            results_dict_to_columns({"OO_1": {"occ": "teacher"}, "OO_2": {"obj": "board"}})
+
+    def test_convert(self):
+        """Tests that the half precision CLIP outputs convert to NPZ and back to the same JSON, and load as load_json_to_df"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            npz_filepath = convert_json_to_npz(self.op_output_filepath, os.path.join(tmp_dir, "results.npz"))
+            json_filepath = convert_npz_to_json(npz_filepath)
+            self.assertEqual(json_filepath, os.path.join(tmp_dir, "results.json"))
+            with open(self.op_output_filepath) as f, open(json_filepath) as g:
+                self.assertEqual(json.load(g), json.load(f))
+
+            self.assertEqual(len(load_results_columns(npz_filepath)["IDX"]), len(load_json_to_df(self.op_output_filepath)))
+            results_df = load_results_df(npz_filepath)
+            expected_df = load_json_to_df(self.op_output_filepath)
+            self.assertEqual(list(results_df.columns), list(expected_df.columns))
+            self.assertEqual(results_df.index.tolist(), expected_df.index.tolist())
+            self.assertEqual(results_df.occ_gender.dtype, "category")
+            self.assertTrue((results_df.astype(object).values == expected_df.values).all())
@@ -0,0 +1,83 @@
+"""
+Tests for the concurrent, resumable URL integrity checker, run against a local stand-in HTTP server
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import ThreadingHTTPServer
+
+main_dir_test = os.getcwd().split("tests")[0]
+sys.path.append(main_dir_test)
+from data import visogender_url_integrity_check as url_check
+from src.data_utils import load_dead_urls, save_url_status
+from tests.test_fetch_utils import StandInHandler
+
+
+class RecordingHandler(StandInHandler):
+    def do_HEAD(self):
+        self.server.requests.append(("HEAD", self.path))
+        super().do_HEAD()
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path))
+        super().do_GET()
+
+
+class TestUrlIntegrityCheck(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RecordingHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.status_dir = tempfile.TemporaryDirectory()
+        self.status_filepath = os.path.join(self.status_dir.name, "url_status.json")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.status_dir.cleanup()
+
+    def test_check_url_head_then_get(self):
+        """Tests that HEAD is tried first, with a GET fallback when HEAD is not supported"""
+        ok_status = url_check.check_url(f"{self.base_url}/ok")
+        self.assertTrue(ok_status["ok"])
+        self.assertEqual(self.server.requests, [("HEAD", "/ok")])
+
+        self.server.requests.clear()
+        nohead_status = url_check.check_url(f"{self.base_url}/nohead")
+        self.assertTrue(nohead_status["ok"])
+        self.assertEqual(self.server.requests, [("HEAD", "/nohead"), ("GET", "/nohead")])
+
+    def test_check_urls_concurrently_resumes(self):
+        """Tests that the status report is written, and a repeat check only re-tests failed URLs"""
+        urls = [f"{self.base_url}/ok", f"{self.base_url}/nohead", f"{self.base_url}/missing", "NA", None]
+        url_status = url_check.check_urls_concurrently(urls, self.status_filepath, num_workers=4, rate_per_host=None)
+
+        self.assertEqual(set(url_status), set(urls[:3]))
+        self.assertTrue(url_status[urls[0]]["ok"])
+        self.assertFalse(url_status[urls[2]]["ok"])
+        self.assertEqual(load_dead_urls(self.status_filepath), {urls[2]})
+
+        self.server.requests.clear()
+        url_check.check_urls_concurrently(urls, self.status_filepath, num_workers=4, rate_per_host=None)
+        self.assertEqual({path for _, path in self.server.requests}, {"/missing"})
+
+        self.server.requests.clear()
+        url_check.check_urls_concurrently(urls, self.status_filepath, num_workers=4, rate_per_host=None, max_age=0)
+        self.assertEqual({path for _, path in self.server.requests}, {"/ok", "/nohead", "/missing"})
+
+    def test_load_dead_urls(self):
+        """Tests that only URLs that are gone for good are skipped, not those that failed with a transient error"""
+        url_status = {"https://example.com/ok": url_check.check_url(f"{self.base_url}/ok"),
+                      "https://example.com/missing": url_check.check_url(f"{self.base_url}/missing")}
+        for url, status in [("https://example.com/gone", "Returned status code 410"), ("https://example.com/unavailable", "Returned status code 503"),
+                            ("https://example.com/timeout", "Request timed out")]:
+            url_status[url] = {"status": status, "status_code": url_check.status_code(status), "ok": False, "checked_at": 0}
+        save_url_status(url_status, self.status_filepath)
+        self.assertEqual(url_status["https://example.com/missing"]["status_code"], 404)
+        self.assertEqual(load_dead_urls(self.status_filepath), {"https://example.com/missing", "https://example.com/gone"})